@@ -6,7 +6,6 @@
 import os
 
 import dotenv
-import jwt
 from flask import (
     Flask, request, current_app, redirect,
     jsonify, make_response, abort
@@ -16,14 +15,22 @@ import socialauth
 
 
 app = Flask(__name__)
+app.secret_key = os.urandom(24)
+
+# Signed-in users starting another login are answered from their session
+# token, without visiting the provider, for a day after they last did.
+sessions = socialauth.Sessions(app.secret_key, max_age = 24 * 60 * 60)
 
 
 @app.route('/whoami')
 def whoami():
     # User IDs are likely protected values, so exposing this value wouldn't
     # be typically recommended in production.
-    res = jwt.decode(request.cookies.get('jwt'), current_app.secret_key)
-    return res.get('user_id')
+    session = sessions.decode(request.cookies.get('jwt'))
+    if session is None:
+        abort(401)
+
+    return session.get('user_id')
 
 
 # GET /auth/facebook?login=start
@@ -35,7 +42,8 @@ def authenticate(provider):
         request.base_url,           # Callback URL
         request.args,               # GET parameters/query string
         current_app.secret_key,
-        request.cookies.get('jwt')  # Currently stored token
+        request.cookies.get('jwt'), # Currently stored token
+        sessions = sessions
     )
 
     if res.get('status') == 302:
@@ -48,11 +56,7 @@ def authenticate(provider):
     if res.get('status') == 200:
         resp = make_response(jsonify({ 'status': 'success' }))
 
-        token = jwt.encode(
-            { 'user_id': res.get('provider_user_id') },
-            current_app.secret_key,
-            algorithm = 'HS256'
-        )
+        token = sessions.encode_result(provider, res)
         resp.set_cookie('jwt', token, httponly = True)
 
         return resp
@@ -63,6 +67,5 @@ def authenticate(provider):
 
 if __name__ == '__main__':
     dotenv.load_dotenv('.env')
-    app.secret_key = os.urandom(24)
     app.debug = True
     app.run(host = '0.0.0.0')
@@ -14,6 +14,7 @@ setup(
     packages = [
         'socialauth',
         'socialauth.providers',
+        'socialauth.bench',
     ],
 
     description = 'A framework- and backend-independent social login provider.',
@@ -28,15 +29,16 @@ setup(
 
     install_requires = [
         'httplib2>=0.9.2',
-        'oauth2>=1.9.0.post1',
         'PyJWT>=1.4.0'
     ],
 
     classifiers = [
         'Development Status :: 4 - Beta',
 
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
     ],
+
+    python_requires = '>=3.7',
 )
@@ -1,4 +1,7 @@
 class Error(Exception):
+    # The status the auth apps answer with. Most errors come from upstream.
+    status_code = 502
+
     def __init__(self, message):
         Exception.__init__(self)
         self.message = message
@@ -7,6 +10,13 @@ class Error(Exception):
         return repr(self.message)
 
 
+class ClientError(Error):
+    '''The request cannot succeed as sent, for instance because its state
+    cookie is missing or forged, or its code was already rejected.'''
+
+    status_code = 400
+
+
 class InvalidUsage(Exception):
     def __init__(self, message, status_code = 400):
         Exception.__init__(self)
@@ -24,4 +34,65 @@ class InvalidUsage(Exception):
             }]
         }
 
-from .authentication import http_get_provider
+
+# Everything below is imported on first access, so processes that only catch
+# socialauth.Error, or only use one provider, never load the rest.
+LAZY_ATTRIBUTES = {
+    'http_get_provider':           'authentication',
+    'async_http_get_provider':     'authentication',
+    'http_get_provider_many':      'batch',
+    'DeadlineExceeded':            'batch',
+    'LoginResult':                 'handlers',
+    'ProviderRegistry':            'registry',
+    'Sessions':                    'sessions',
+    'Tenants':                     'tenants',
+    'Transport':                   'transport',
+    'AsyncTransport':              'transport',
+    'get_default_transport':       'transport',
+    'set_default_transport':       'transport',
+    'get_default_async_transport': 'transport',
+    'set_default_async_transport': 'transport',
+    'StateCodec':                  'state',
+    'KeyRing':                     'state',
+    'TTLCache':                    'cache',
+    'SingleFlight':                'singleflight',
+    'AsyncSingleFlight':           'singleflight',
+    'CircuitOpenError':            'breaker',
+    'CircuitBreaker':              'breaker',
+    'CircuitBreakers':             'breaker',
+    'Instrumentation':             'instrumentation',
+    'get_instrumentation':         'instrumentation',
+    'set_instrumentation':         'instrumentation',
+    'RequestTokenPool':            'prefetch',
+    'warmup':                      'boot',
+    'async_warmup':                'boot',
+}
+
+SUBMODULES = (
+    'asgi', 'authentication', 'batch', 'bench', 'boot', 'breaker', 'cache',
+    'endpoint', 'handlers', 'hedge', 'instrumentation', 'jwks', 'oauth1',
+    'prefetch', 'protocol', 'providers', 'ratelimit', 'registry',
+    'sessions', 'singleflight', 'state', 'stores', 'tenants', 'transport',
+    'wsgi',
+)
+
+__all__ = ['Error', 'InvalidUsage'] + sorted(LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    from importlib import import_module
+
+    if name in SUBMODULES:
+        return import_module('.' + name, __name__)
+
+    if name not in LAZY_ATTRIBUTES:
+        raise AttributeError(
+            'module {!r} has no attribute {!r}'.format(__name__, name))
+
+    value = getattr(import_module('.' + LAZY_ATTRIBUTES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(LAZY_ATTRIBUTES) | set(SUBMODULES))
@@ -0,0 +1,100 @@
+'''An ASGI application serving ``/auth/<provider>``.
+
+Serve it on its own::
+
+    application = socialauth.asgi.AsyncAuthApp(os.environ['TOKEN_SECRET'])
+
+or in front of another ASGI application, which receives every other scope::
+
+    application = socialauth.asgi.AsyncAuthApp(secret, app = starlette_app)
+
+Upstream calls go through the registry's
+:class:`~socialauth.AsyncTransport`, so the event loop is never blocked.
+'''
+
+from .endpoint import AuthEndpoint
+from .wsgi import NOT_FOUND
+
+
+class AsyncAuthApp:
+    '''The ASGI counterpart of :class:`socialauth.wsgi.AuthApp`.
+
+    :param token_secret: Signs the state and session cookies. A ``str`` or a
+        :class:`~socialauth.KeyRing`.
+    :param app: An ASGI application for every other path and scope type.
+        Without one, other paths get a 404.
+    '''
+
+    def __init__(self, token_secret, app = None, **options):
+        self.endpoint = AuthEndpoint(token_secret, **options)
+        self.app      = app
+
+    async def __call__(self, scope, receive, send):
+        provider = None
+        if scope['type'] == 'http':
+            provider = self.endpoint.route(scope['path'])
+
+        if provider is None:
+            if self.app is not None:
+                return await self.app(scope, receive, send)
+
+            if scope['type'] == 'lifespan':
+                return await lifespan(receive, send)
+
+            status, headers, body = NOT_FOUND
+        else:
+            headers = header_map(scope)
+            status, headers, body = await self.endpoint.async_handle(
+                provider,
+                request_url(scope, headers),
+                scope.get('query_string', b'').decode('latin-1'),
+                headers.get(b'cookie', b'').decode('latin-1'),
+                scope.get('scheme') == 'https')
+
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1'),)
+                   for name, value in headers]
+        headers.append((b'content-length', str(len(body)).encode('latin-1'),))
+        await send({
+            'type':    'http.response.start',
+            'status':  status,
+            'headers': headers,
+        })
+        await send({ 'type': 'http.response.body', 'body': body })
+
+    def read_session(self, scope):
+        '''Decode the request's session cookie. See
+        :meth:`socialauth.endpoint.AuthEndpoint.read_session`.'''
+        cookie = header_map(scope).get(b'cookie', b'').decode('latin-1')
+        return self.endpoint.read_session(cookie)
+
+
+def header_map(scope):
+    headers = {}
+    for name, value in scope.get('headers') or ():
+        if name == b'cookie' and name in headers:
+            # HTTP/2 clients may send each cookie in a header of its own.
+            value = headers[name] + b'; ' + value
+
+        headers[name] = value
+
+    return headers
+
+
+def request_url(scope, headers):
+    host = headers.get(b'host', b'').decode('latin-1')
+    if not host and scope.get('server'):
+        host = '{}:{}'.format(*scope['server'])
+
+    return '{}://{}{}{}'.format(scope.get('scheme', 'http'), host,
+                                scope.get('root_path', ''), scope['path'])
+
+
+async def lifespan(receive, send):
+    # Nothing to set up, but servers expect the protocol to be answered.
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({ 'type': 'lifespan.startup.complete' })
+        elif message['type'] == 'lifespan.shutdown':
+            await send({ 'type': 'lifespan.shutdown.complete' })
+            return
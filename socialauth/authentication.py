@@ -1,18 +1,43 @@
-import jwt
+import os
+import threading
 
 import socialauth.providers
 from . import InvalidUsage
 
 
+# Provider names and their classes in socialauth.providers.
+PROVIDERS = {
+    'twitter':  'Twitter',
+    'facebook': 'Facebook',
+    'oidc':     'OIDC',
+}
+
+# OpenID Connect needs an issuer, so it is only enabled when asked for.
+DEFAULT_PROVIDERS = (
+    'twitter',
+    'facebook',
+)
+
+
 def validate_provider(provider):
-    return provider in (
-        'twitter',
-        'facebook',
-    )
+    return provider in PROVIDERS
+
+
+def provider_class(provider, asynchronous = False):
+    '''The provider class for ``provider``, or its asyncio counterpart.'''
+    prefix = 'Async' if asynchronous else ''
+    return getattr(socialauth.providers, prefix + PROVIDERS[provider])
+
+
+def handler_class(provider):
+    '''The :class:`~socialauth.handlers.Handler` class for ``provider``.'''
+    return getattr(socialauth.providers, PROVIDERS[provider] + 'Handler')
 
 
 def http_get_provider(provider,
-                      request_url, params, token_secret, token_cookie = None):
+                      request_url, params, token_secret, token_cookie = None,
+                      transport = None, tenant = None, tenants = None,
+                      sessions = None, session_token = None):
     '''Handle HTTP GET requests on an authentication endpoint.
 
     Authentication flow begins when ``params`` has a ``login`` key with a value
@@ -21,8 +46,20 @@ def http_get_provider(provider,
     :param str provider: An provider to obtain a user ID from.
     :param str request_url: The authentication endpoint/callback.
     :param dict params: GET parameters from the query string.
-    :param str token_secret: An app secret to encode/decode JSON web tokens.
+    :param token_secret: An app secret to encode/decode JSON web tokens, or a
+        :class:`socialauth.KeyRing` of them.
     :param str token_cookie: The current JSON web token, if available.
+    :param transport: A :class:`socialauth.Transport` to reach the provider
+        with. Defaults to the process-wide pooled transport.
+    :param tenant: The tenant whose credentials to use, from ``tenants``.
+    :param tenants: A :class:`socialauth.Tenants` credential map. Without
+        one, credentials are read from the environment.
+    :param sessions: :class:`socialauth.Sessions` enabling the returning-user
+        fast path: a ``login=start`` with a valid session token for
+        ``provider`` and ``tenant`` returns a 200 result without calling the
+        provider. Issue tokens with the same ``tenant``.
+    :param str session_token: The session token, if it is not kept in
+        ``token_cookie``.
     :return: A dict containing any of the following possible keys:
 
         ``status``: an HTTP status code the server should sent
@@ -35,26 +72,115 @@ def http_get_provider(provider,
         ``provider_user_id``: the user ID from the login provider
 
         ``provider_user_name``: the user name from the login provider
+
+        ``returning``: ``True`` when answered from the session token
+
+        ``auth_time``: when a returning user signed in with the provider
     '''
 
     if not validate_provider(provider):
         raise InvalidUsage('Provider not supported')
 
-    klass    = getattr(socialauth.providers, provider.capitalize())
-    provider = klass(request_url, params, token_secret, token_cookie)
-    if provider.status == 302:
-        ret = dict(status = 302, redirect = provider.redirect)
-        tc  = getattr(provider, 'set_token_cookie', None)
-        if tc is not None:
-            ret['set_token_cookie'] = tc
+    result = returning_user(provider, params, token_cookie, sessions,
+                            session_token, tenant)
+    if result is not None:
+        return result
+
+    handler = default_handler(provider, token_secret, tenant, tenants)
+    return handler.handle(request_url, params, token_cookie,
+                          transport = transport).to_dict()
+
+
+async def async_http_get_provider(provider,
+                                  request_url, params, token_secret,
+                                  token_cookie = None, transport = None,
+                                  tenant = None, tenants = None,
+                                  sessions = None, session_token = None):
+    '''Coroutine counterpart of :func:`http_get_provider`.
+
+    Upstream calls are made over an :class:`~socialauth.AsyncTransport`
+    without blocking the event loop. Takes the same arguments and returns the
+    same dict as :func:`http_get_provider`.
+    '''
+
+    if not validate_provider(provider):
+        raise InvalidUsage('Provider not supported')
+
+    result = returning_user(provider, params, token_cookie, sessions,
+                            session_token, tenant)
+    if result is not None:
+        return result
+
+    handler = default_handler(provider, token_secret, tenant, tenants)
+    result  = await handler.async_handle(request_url, params, token_cookie,
+                                         transport = transport)
+    return result.to_dict()
 
-        return ret
 
-    if provider.status == 200 and provider.user_id is not None:
-        ret = dict(status = 200, provider_user_id = provider.user_id)
-        if provider.user_name is not None:
-            ret['provider_user_name'] = provider.user_name
+def returning_user(provider, params, token_cookie, sessions, session_token,
+                   tenant = None):
+    if sessions is None:
+        return None
 
-        return ret
+    if session_token is None:
+        session_token = token_cookie
 
-    raise InvalidUsage('Invalid request')  # pragma: no cover
+    return sessions.returning_user(provider, params, session_token, tenant)
+
+
+# Handlers for the module-level functions, by provider and token secret.
+_handlers = {}
+
+
+def default_handler(provider, token_secret, tenant = None, tenants = None):
+    '''The handler the module-level functions use.
+
+    Without ``tenants``, one handler per provider and token secret is kept,
+    as a :class:`~socialauth.ProviderRegistry` would. Tenant configs are
+    already cached by ``tenants``, so a light handler is built around them.
+    '''
+    klass  = handler_class(provider)
+    config = tenant_config(klass, tenant, tenants)
+    if tenants is not None:
+        return klass(token_secret, config = config)
+
+    key     = (provider, token_secret,)
+    handler = _handlers.get(key)
+    if handler is None or handler.config is not config:
+        # The environment's credentials changed since it was built.
+        handler = _handlers[key] = klass(token_secret, config = config)
+
+    return handler
+
+
+def tenant_config(klass, tenant, tenants):
+    if tenants is None:
+        if tenant is not None:
+            raise InvalidUsage('No tenants given')
+
+        return environ_config(klass)
+
+    return tenants.config(klass, tenant)
+
+
+# Configs read from os.environ, by provider and the values they were read
+# from, so a change of credentials gives a new config.
+_environ_configs = {}
+_environ_lock    = threading.Lock()
+
+
+def environ_config(klass):
+    '''The config of ``klass`` read from :data:`os.environ`.
+
+    Configs keep what they learn, such as OpenID discovery and signing keys,
+    so calls without a registry share one per set of credentials.
+    '''
+    key = (klass.name,) + tuple(os.environ.get(name)
+                                for name in klass.config_class.environ_keys)
+    config = _environ_configs.get(key)
+    if config is None:
+        config = klass.config_class.from_environ()
+        with _environ_lock:
+            config = _environ_configs.setdefault(key, config)
+
+    return config
@@ -0,0 +1,72 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from . import Error
+from .authentication import http_get_provider
+from .transport import get_default_transport
+
+
+class DeadlineExceeded(Error):
+    '''A batched request did not finish before the batch deadline.'''
+
+
+def http_get_provider_many(requests, token_secret, concurrency = 8,
+                           deadline = None, transport = None, registry = None):
+    '''Run many :func:`socialauth.http_get_provider` calls concurrently.
+
+    The calls share one pooled transport and run on at most ``concurrency``
+    threads. When ``deadline`` passes, requests that have not started are
+    cancelled and requests still in flight are abandoned; both are reported
+    as :class:`DeadlineExceeded`.
+
+    :param requests: ``(provider, request_url, params, token_cookie)``
+        tuples. ``token_cookie`` may be omitted.
+    :param str token_secret: The app secret used for every request.
+    :param int concurrency: The most requests in flight at once.
+    :param float deadline: Seconds the whole batch may take. ``None`` waits
+        for every request.
+    :param transport: A :class:`~socialauth.Transport` shared by the batch.
+        Defaults to the process-wide pooled transport.
+    :param registry: A :class:`~socialauth.ProviderRegistry` to dispatch
+        through instead, using its own transport.
+    :return: A list in the order of ``requests``. Each item is the result
+        dict or the exception that request raised.
+    '''
+    requests = list(requests)
+    if not requests:
+        return []
+
+    if registry is not None:
+        def call(provider, request_url, params, token_cookie = None):
+            return registry.http_get_provider(provider, request_url, params,
+                                              token_secret, token_cookie)
+    else:
+        transport = transport or get_default_transport()
+
+        def call(provider, request_url, params, token_cookie = None):
+            return http_get_provider(provider, request_url, params,
+                                     token_secret, token_cookie,
+                                     transport = transport)
+
+    executor = ThreadPoolExecutor(max_workers = min(concurrency, len(requests)))
+    try:
+        futures = [executor.submit(call, *request) for request in requests]
+        done, pending = wait(futures, timeout = deadline)
+        for future in pending:
+            future.cancel()
+    finally:
+        # Abandoned calls finish in the background, bounded by the
+        # transport's timeout.
+        executor.shutdown(wait = False)
+
+    return [outcome(future, future in done) for future in futures]
+
+
+def outcome(future, done):
+    if not done:
+        return DeadlineExceeded('Batch deadline exceeded')
+
+    error = future.exception()
+    if error is not None:
+        return error
+
+    return future.result()
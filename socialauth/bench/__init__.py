@@ -0,0 +1,6 @@
+'''Benchmarks for socialauth.
+
+Each module can be run directly, for instance::
+
+    $ python -m socialauth.bench.state
+'''
@@ -0,0 +1,45 @@
+'''Load-test both login legs against a local fake provider.
+
+    $ python -m socialauth.bench --provider facebook --logins 2000 \\
+        --concurrency 32 --latency 20
+'''
+
+import argparse
+
+from socialauth.bench import load
+from socialauth.bench.servers import FakeProviderServer
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'python -m socialauth.bench')
+    parser.add_argument('--provider', choices = ('twitter', 'facebook'),
+                        default = 'twitter')
+    parser.add_argument('--logins', type = int, default = 1000)
+    parser.add_argument('--concurrency', type = int, default = 16)
+    parser.add_argument('--latency', type = float, default = 0.0,
+                        help = 'upstream latency in milliseconds')
+    parser.add_argument('--error-rate', type = float, default = 0.0,
+                        help = 'fraction of upstream requests that fail')
+    parser.add_argument('--certfile', help = 'serve the fake provider over TLS')
+    parser.add_argument('--keyfile')
+    args = parser.parse_args(argv)
+
+    server = FakeProviderServer(latency    = args.latency / 1000.0,
+                                error_rate = args.error_rate,
+                                certfile   = args.certfile,
+                                keyfile    = args.keyfile)
+    with server:
+        transport = server.transport(max_idle_per_host = args.concurrency,
+                                     ca_certs = args.certfile)
+        report = load.run(args.provider,
+                          logins      = args.logins,
+                          concurrency = args.concurrency,
+                          transport   = transport)
+
+    print(load.format_report(report))
+    print('{} upstream requests over {} connections'.format(
+        server.requests, server.connections))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+'''Measure the memory a login allocates, per-request objects against a
+long-lived handler.
+
+Each login runs both legs through one of two paths:
+
+``per_request``
+    A config read from the environment and a handler built for every
+    request, with the result turned into a dict, which is the work
+    :func:`socialauth.http_get_provider` did per call before handlers were
+    kept.
+
+``handler``
+    One long-lived :class:`~socialauth.handlers.Handler` per provider,
+    returning a :class:`~socialauth.LoginResult`.
+
+Upstream responses are replayed in-process from the
+:class:`~socialauth.bench.servers.FakeProviderServer` bodies, so only
+socialauth's own allocations are traced. ``tracemalloc`` reports the peak
+bytes held while each login runs.
+
+    $ python -m socialauth.bench.alloc [logins]
+'''
+
+import sys
+import tracemalloc
+
+import httplib2
+
+from socialauth.authentication import handler_class
+from socialauth.bench.load import CALLBACK_URL, CREDENTIALS, TOKEN_SECRET
+from socialauth.bench.servers import (
+    ACCESS_TOKEN, GRAPH_ME, GRAPH_TOKEN, REQUEST_TOKEN
+)
+
+
+PROVIDERS = ('twitter', 'facebook',)
+
+CALLBACK_PARAMS = {
+    'twitter':  { 'oauth_token': 'foo', 'oauth_verifier': 'bar' },
+    'facebook': { 'code': 'bench' },
+}
+
+
+class ReplayTransport:
+    '''Answers every request with the stand-in server's body for its path,
+    built once.'''
+
+    def __init__(self):
+        ok = httplib2.Response(dict(status = 200))
+        self.responses = {
+            '/oauth/request_token':     (ok, REQUEST_TOKEN,),
+            '/oauth/access_token':      (ok, ACCESS_TOKEN,),
+            '/v2.5/oauth/access_token': (ok, GRAPH_TOKEN,),
+            '/me':                      (ok, GRAPH_ME,),
+        }
+
+    def request(self, uri, method = 'GET', body = None, headers = None):
+        path = uri.split('?', 1)[0].split('/', 3)[3]
+        return self.responses['/' + path]
+
+
+def per_request_login(klass, transport):
+    def leg(url, params, cookie):
+        handler = klass(TOKEN_SECRET,
+                        config    = klass.config_class.from_environ(CREDENTIALS),
+                        transport = transport)
+        return handler.handle(url, params, cookie).to_dict()
+
+    return leg
+
+
+def handler_login(handler):
+    def leg(url, params, cookie):
+        return handler.handle(url, params, cookie)
+
+    return leg
+
+
+def login(leg, provider):
+    url = CALLBACK_URL.format(provider)
+    res = leg(url, { 'login': 'start' }, None)
+    cookie = (res.get('set_token_cookie') if isinstance(res, dict)
+              else res.set_token_cookie)
+    return leg(url, CALLBACK_PARAMS[provider], cookie)
+
+
+def measure(leg, provider, logins):
+    '''The mean peak bytes traced while each of ``logins`` logins ran.'''
+    login(leg, provider)
+
+    total = 0
+    tracemalloc.start()
+    try:
+        for _ in range(logins):
+            tracemalloc.clear_traces()
+            login(leg, provider)
+            total += tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return total / logins
+
+
+def run(logins = 200):
+    '''Measure ``logins`` logins per provider along each path.
+
+    :return: A dict keyed by provider, holding the mean ``per_request`` and
+        ``handler`` peak bytes per login.
+    '''
+    transport = ReplayTransport()
+    results   = {}
+    for provider in PROVIDERS:
+        klass   = handler_class(provider)
+        config  = klass.config_class.from_environ(CREDENTIALS)
+        handler = klass(TOKEN_SECRET, config = config, transport = transport)
+        results[provider] = dict(
+            per_request = measure(per_request_login(klass, transport),
+                                  provider, logins),
+            handler     = measure(handler_login(handler), provider, logins),
+        )
+
+    return results
+
+
+def main(argv = None):
+    argv    = sys.argv[1:] if argv is None else argv
+    logins  = int(argv[0]) if argv else 200
+    results = run(logins)
+    for provider, result in sorted(results.items()):
+        saved = 1 - result['handler'] / result['per_request']
+        print('{:<9} per request {:>7,.0f} B  handler {:>7,.0f} B  '
+              '{:>4.0%} less per login'.format(
+                  provider, result['per_request'], result['handler'], saved))
+
+
+if __name__ == '__main__':
+    main()
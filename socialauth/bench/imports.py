@@ -0,0 +1,71 @@
+'''Measure what importing socialauth costs a freshly started worker.
+
+Every target is imported in its own interpreter, so nothing is already cached
+in :data:`sys.modules`. The report lists the wall time of the import and the
+heavy dependencies it pulled in.
+
+    $ python -m socialauth.bench.imports [repeat]
+'''
+
+import json
+import subprocess
+import sys
+
+
+TARGETS = (
+    'socialauth',
+    'socialauth.providers.facebook',
+    'socialauth.providers.twitter',
+)
+
+# Third-party and standard library modules that dominate startup time.
+HEAVY = ('asyncio', 'httplib2', 'jwt', 'oauth2',)
+
+PROBE = '''
+import json, sys, time
+began = time.perf_counter()
+__import__({target!r})
+elapsed = time.perf_counter() - began
+print(json.dumps(dict(
+    seconds = elapsed,
+    loaded  = sorted(name for name in {heavy!r} if name in sys.modules),
+)))
+'''
+
+
+def measure(target, executable = None):
+    '''Import ``target`` in a new interpreter.
+
+    :return: A dict with ``seconds`` and the ``loaded`` heavy modules.
+    '''
+    code = PROBE.format(target = target, heavy = HEAVY)
+    out  = subprocess.check_output([executable or sys.executable, '-c', code])
+    return json.loads(out.decode('utf-8'))
+
+
+def run(repeat = 5, targets = TARGETS):
+    '''Import each target ``repeat`` times, keeping the fastest.
+
+    :return: A dict keyed by target, with ``seconds`` and ``loaded``.
+    '''
+    results = {}
+    for target in targets:
+        samples = [measure(target) for _ in range(repeat)]
+        results[target] = min(samples, key = lambda sample: sample['seconds'])
+
+    return results
+
+
+def main(argv = None):
+    argv    = sys.argv[1:] if argv is None else argv
+    repeat  = int(argv[0]) if argv else 5
+    results = run(repeat)
+    for target in TARGETS:
+        result = results[target]
+        print('{:<32} {:>8.1f} ms  {}'.format(
+            target, result['seconds'] * 1000,
+            ', '.join(result['loaded']) or '-'))
+
+
+if __name__ == '__main__':
+    main()
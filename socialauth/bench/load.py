@@ -0,0 +1,126 @@
+'''Drive complete logins through the ``http_get_provider`` flow.
+
+Every login runs the ``login=start`` leg and then the callback leg, exactly
+as a web app would, against whatever hosts the transport points at. Calls go
+through :meth:`socialauth.ProviderRegistry.http_get_provider` so the
+benchmark needs no credentials in the environment.
+'''
+
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from socialauth.registry import ProviderRegistry
+
+
+CREDENTIALS = {
+    'TWITTER_CONSUMER_KEY': 'bench',
+    'TWITTER_CONSUMER_SECRET': 'bench',
+    'FACEBOOK_APP_ID': '1234',
+    'FACEBOOK_APP_SECRET': 'bench',
+}
+
+CALLBACK_URL = 'https://bench.socialauth.test/auth/{}'
+TOKEN_SECRET = 'bench secret'
+
+
+def percentile(ordered, fraction):
+    '''Nearest-rank percentile of an already sorted list.'''
+    if not ordered:
+        return None
+
+    rank = max(int(math.ceil(fraction * len(ordered))), 1)
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    ordered = sorted(latencies)
+    return dict(
+        count      = len(ordered),
+        errors     = errors,
+        throughput = len(ordered) / elapsed if elapsed else 0.0,
+        p50        = percentile(ordered, 0.50),
+        p95        = percentile(ordered, 0.95),
+        p99        = percentile(ordered, 0.99),
+    )
+
+
+def login(get_provider, provider):
+    '''Run one login and return ``(start_seconds, finish_seconds)``.'''
+    url = CALLBACK_URL.format(provider)
+
+    began = time.perf_counter()
+    res   = get_provider(provider, url, { 'login': 'start' }, TOKEN_SECRET)
+    started = time.perf_counter()
+
+    if provider == 'twitter':
+        params = { 'oauth_token': 'foo', 'oauth_verifier': 'bar' }
+    else:
+        params = { 'code': 'bench' }
+
+    get_provider(provider, url, params, TOKEN_SECRET,
+                 res.get('set_token_cookie'))
+    return (started - began, time.perf_counter() - started,)
+
+
+def run(provider = 'twitter', logins = 1000, concurrency = 16,
+        transport = None, registry = None):
+    '''Run ``logins`` logins with ``concurrency`` worker threads.
+
+    :param str provider: ``twitter`` or ``facebook``.
+    :param transport: The :class:`~socialauth.Transport` to reach the
+        provider with, typically from
+        :meth:`~socialauth.bench.servers.FakeProviderServer.transport`.
+    :param registry: A :class:`~socialauth.ProviderRegistry` to log in
+        through. Defaults to one with placeholder credentials.
+    :return: A dict with ``login``, ``start`` and ``finish`` summaries. Each
+        has ``count``, ``errors``, ``throughput`` (per second) and ``p50``,
+        ``p95`` and ``p99`` latencies in seconds.
+    '''
+    if registry is None:
+        registry = ProviderRegistry(environ   = CREDENTIALS,
+                                    transport = transport)
+
+    lock    = threading.Lock()
+    samples = dict(login = [], start = [], finish = [])
+    errors  = [0]
+
+    def worker():
+        try:
+            start, finish = login(registry.http_get_provider, provider)
+        except Exception:
+            with lock:
+                errors[0] += 1
+            return
+
+        with lock:
+            samples['start'].append(start)
+            samples['finish'].append(finish)
+            samples['login'].append(start + finish)
+
+    began = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = concurrency) as executor:
+        for i in range(logins):
+            executor.submit(worker)
+
+    elapsed = time.perf_counter() - began
+    return dict(
+        (phase, summarize(latencies, errors[0], elapsed))
+        for phase, latencies in samples.items()
+    )
+
+
+def format_report(report):
+    lines = ['{:<8} {:>7} {:>7} {:>10} {:>9} {:>9} {:>9}'.format(
+        'phase', 'count', 'errors', 'per sec', 'p50 ms', 'p95 ms', 'p99 ms')]
+    for phase in ('start', 'finish', 'login'):
+        summary = report[phase]
+        millis  = [
+            (summary[key] or 0.0) * 1000 for key in ('p50', 'p95', 'p99')
+        ]
+        lines.append('{:<8} {:>7} {:>7} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            phase, summary['count'], summary['errors'], summary['throughput'],
+            *millis))
+
+    return '\n'.join(lines)
@@ -0,0 +1,83 @@
+'''Compare :class:`socialauth.oauth1.Signer` with the ``oauth2`` package.
+
+Each operation signs the Twitter ``access_token`` request, the signature the
+callback leg of a login computes. ``oauth2`` is optional; without it only the
+built-in signer is timed.
+
+    $ python -m socialauth.bench.oauth1 [number]
+'''
+
+import sys
+import timeit
+
+from socialauth.oauth1 import Signer
+
+
+URL      = 'https://api.twitter.com/oauth/access_token'
+CONSUMER = (
+    'xvz1evFS4wEEPTGEFPHBog',
+    'kAcSOqF21Fu85e7zjz7ZN2U4ZRhfV3WpwPAoE3Z7kBw',
+)
+TOKEN    = (
+    '370773112-GmHxMAgYyLbNEtIKZeRNFsMKPR9EyMZeS9weJAEb',
+    'LswwdoUaIvS8ltyTt5jkRh4J50vUPVVHtR2YPi5kE',
+)
+VERIFIER = 'uw7NjWHT6OJ1MpJOXsHfNxoAhPKpgI8BlYDhxEjIBY'
+
+
+def signer_sign(signer = Signer(*CONSUMER)):
+    return signer.sign(URL, 'POST', TOKEN[0], TOKEN[1], VERIFIER)
+
+
+def oauth2_sign():
+    import oauth2
+
+    consumer = oauth2.Consumer(*CONSUMER)
+    token    = oauth2.Token(*TOKEN)
+    token.set_verifier(VERIFIER)
+    req = oauth2.Request.from_consumer_and_token(
+        consumer,
+        token           = token,
+        http_method     = 'POST',
+        http_url        = URL,
+        is_form_encoded = True)
+    req.sign_request(oauth2.SignatureMethod_HMAC_SHA1(), consumer, token)
+    return req.to_postdata()
+
+
+def run(number = 20000):
+    '''Time ``number`` signatures with each implementation available.
+
+    :return: A dict keyed by implementation, with ``ops_per_second``.
+    '''
+    implementations = [('Signer', signer_sign)]
+    try:
+        import oauth2  # noqa: F401
+        implementations.append(('oauth2', oauth2_sign))
+    except ImportError:
+        pass
+
+    results = {}
+    for name, func in implementations:
+        elapsed = min(timeit.repeat(func, number = number, repeat = 3))
+        results[name] = dict(ops_per_second = number / elapsed)
+
+    return results
+
+
+def main(argv = None):
+    argv    = sys.argv[1:] if argv is None else argv
+    number  = int(argv[0]) if argv else 20000
+    results = run(number)
+    for name, result in sorted(results.items()):
+        print('{:<12} {:>12,.0f} signatures/s'.format(
+            name, result['ops_per_second']))
+
+    if 'oauth2' in results:
+        speedup = (results['Signer']['ops_per_second'] /
+                   results['oauth2']['ops_per_second'])
+        print('Signer is {:.1f}x faster'.format(speedup))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+'''Local stand-in servers for the Twitter, Facebook and OpenID endpoints.
+
+One :class:`FakeProviderServer` answers every endpoint the providers call, so
+point all upstream hosts at it with :meth:`FakeProviderServer.transport`::
+
+    with FakeProviderServer(latency = 0.05) as server:
+        transport = server.transport()
+'''
+
+import json
+import random
+import secrets
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qsl
+
+from socialauth.jwks import b64encode, pkcs1_encode
+from socialauth.transport import Transport
+
+
+TWITTER_HOST  = 'api.twitter.com'
+FACEBOOK_HOST = 'graph.facebook.com'
+ISSUER_HOST   = 'accounts.example.com'
+ISSUER        = 'https://' + ISSUER_HOST
+
+REQUEST_TOKEN = (b'oauth_token=foo&oauth_token_secret=bar'
+                 b'&oauth_callback_confirmed=true')
+ACCESS_TOKEN  = (b'oauth_token=foo&oauth_token_secret=bar'
+                 b'&user_id=987&screen_name=test')
+GRAPH_TOKEN   = (b'{"access_token":"foobar","token_type":"bearer",'
+                 b'"expires_in":5117097}')
+GRAPH_ME      = b'{"id":"987","name":"test"}'
+
+DISCOVERY = json.dumps({
+    'issuer':                 ISSUER,
+    'authorization_endpoint': ISSUER + '/authorize',
+    'token_endpoint':         ISSUER + '/token',
+    'jwks_uri':               ISSUER + '/jwks',
+}).encode('utf-8')
+
+
+SMALL_PRIMES = [p for p in range(3, 2000, 2)
+                if all(p % q for q in range(3, int(p ** 0.5) + 1, 2))]
+
+
+def is_probable_prime(n, rounds = 20):
+    '''Miller-Rabin.'''
+    for p in SMALL_PRIMES:
+        if n % p == 0:
+            return n == p
+
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    for _ in range(rounds):
+        x = pow(secrets.randbelow(n - 3) + 2, d, n)
+        if x in (1, n - 1):
+            continue
+
+        for _ in range(s - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+
+    return True
+
+
+def random_prime(bits):
+    while True:
+        candidate = secrets.randbits(bits) | (3 << (bits - 2)) | 1
+        if is_probable_prime(candidate):
+            return candidate
+
+
+def inverse(a, m):
+    '''The inverse of ``a`` modulo ``m``, by the extended Euclidean
+    algorithm. (``pow(a, -1, m)`` needs Python 3.8.)'''
+    x, last_x, r, last_r = 0, 1, m, a
+    while r:
+        quotient = last_r // r
+        last_r, r = r, last_r - quotient * r
+        last_x, x = x, last_x - quotient * x
+
+    return last_x % m
+
+
+class IssuerKey:
+    '''An RSA signing key of the fake OpenID issuer.
+
+    Keys are 1024 bits so a test run generates them quickly; the verifier
+    accepts any size.
+    '''
+
+    def __init__(self, kid, bits = 1024):
+        self.kid = kid
+        self.e   = 65537
+        while True:
+            p, q = random_prime(bits // 2), random_prime(bits // 2)
+            phi  = (p - 1) * (q - 1)
+            if p != q and phi % self.e:
+                break
+
+        self.n    = p * q
+        self.d    = inverse(self.e, phi)
+        self.size = (self.n.bit_length() + 7) // 8
+
+    def jwk(self):
+        return {
+            'kty': 'RSA',
+            'use': 'sig',
+            'alg': 'RS256',
+            'kid': self.kid,
+            'n':   b64encode(self.n.to_bytes(self.size, 'big')),
+            'e':   b64encode(self.e.to_bytes(3, 'big')),
+        }
+
+    def sign(self, claims):
+        '''An RS256 JSON web token carrying ``claims``.'''
+        header  = { 'alg': 'RS256', 'typ': 'JWT', 'kid': self.kid }
+        message = '.'.join(
+            b64encode(json.dumps(part).encode('utf-8'))
+            for part in (header, claims)
+        ).encode('ascii')
+        encoded   = int.from_bytes(pkcs1_encode('RS256', message, self.size),
+                                   'big')
+        signature = pow(encoded, self.d, self.n).to_bytes(self.size, 'big')
+        return (message + b'.' + b64encode(signature).encode('ascii')).decode(
+            'ascii')
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Send each response in one segment so Nagle's algorithm and delayed
+    # ACKs do not show up as upstream latency.
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def route(self):
+        path = urlsplit(self.path).path
+        if path == '/oauth/request_token':
+            return (200, REQUEST_TOKEN,)
+
+        if path == '/oauth/access_token' and self.command == 'POST':
+            return (200, ACCESS_TOKEN,)
+
+        if path.endswith('/oauth/access_token'):
+            if 'code=bad' in self.path:
+                return (400, b'{"error":{"message":"Invalid code",'
+                             b'"type":"OAuthException","code":100}}',)
+
+            return (200, GRAPH_TOKEN,)
+
+        if path == '/me':
+            return (200, GRAPH_ME,)
+
+        if path == '/.well-known/openid-configuration':
+            return (200, DISCOVERY,)
+
+        if path == '/authorize':
+            location = self.server.authorize(self.path)
+            self.response_headers.append(('Location', location,))
+            return (302, b'',)
+
+        if path == '/token' and self.command == 'POST':
+            id_token = self.server.id_token(dict(parse_qsl(
+                self.body.decode('utf-8'))))
+            if id_token is None:
+                return (400, b'{"error":"invalid_grant"}',)
+
+            return (200, json.dumps({
+                'access_token': 'foobar',
+                'token_type':   'Bearer',
+                'id_token':     id_token,
+            }).encode('utf-8'),)
+
+        if path == '/jwks':
+            return (200, self.server.jwks(),)
+
+        return (404, b'',)
+
+    def respond(self):
+        self.body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.response_headers = []
+
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            fail = server.random.random() < server.error_rate
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        status, body = (500, b'',) if fail else self.route()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in self.response_headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET     = respond
+    do_POST    = respond
+    do_HEAD    = respond
+    do_OPTIONS = respond
+
+
+class FakeProviderServer(ThreadingMixIn, HTTPServer):
+    '''A threaded HTTP/1.1 server impersonating Twitter and Facebook.
+
+    Implements ``oauth/request_token`` and ``oauth/access_token`` for Twitter
+    and the Graph ``oauth/access_token`` and ``/me`` endpoints for Facebook.
+    The Graph token exchange answers 400 for ``code=bad``.
+
+    It is also an OpenID issuer at :data:`ISSUER`, serving discovery, an
+    ``/authorize`` endpoint that redirects straight back with a code, the
+    code exchange and the signing keys. ID tokens are for user ``987``.
+
+    :param float latency: Seconds to sleep before every response.
+    :param float error_rate: Fraction of requests answered with a 500.
+    :param str certfile: Serve HTTPS with this PEM certificate chain.
+    :param str keyfile: The private key for ``certfile``.
+    :param int seed: Seed for the error injection.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, latency = 0.0, error_rate = 0.0, certfile = None,
+                 keyfile = None, seed = None, port = 0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeProviderHandler)
+        self.latency     = latency
+        self.error_rate  = error_rate
+        self.random      = random.Random(seed)
+        self.lock        = threading.Lock()
+        self.connections = 0
+        self.requests    = 0
+
+        # The issuer's signing keys, newest last, made on first use.
+        self.issuer_keys = []
+        self.codes       = {}
+
+        scheme = 'http'
+        if certfile is not None:
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(certfile, keyfile)
+            self.socket = context.wrap_socket(self.socket, server_side = True)
+            scheme = 'https'
+
+        self.url = '{}://127.0.0.1:{}'.format(scheme, self.server_address[1])
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        '''Serve from a daemon thread.'''
+        threading.Thread(target = self.serve_forever,
+                         kwargs = { 'poll_interval': 0.05 },
+                         daemon = True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    @property
+    def hosts(self):
+        '''A :attr:`socialauth.Transport.hosts` mapping onto this server.'''
+        return {
+            TWITTER_HOST:  self.url,
+            FACEBOOK_HOST: self.url,
+            ISSUER_HOST:   self.url,
+        }
+
+    def transport(self, transport_class = Transport, **kwargs):
+        '''Build a transport whose upstream hosts point at this server.'''
+        return transport_class(hosts = self.hosts, **kwargs)
+
+    def signing_key(self):
+        with self.lock:
+            if not self.issuer_keys:
+                self.issuer_keys.append(IssuerKey('key-1'))
+
+            return self.issuer_keys[-1]
+
+    def rotate_key(self):
+        '''Sign with a new key from now on, still publishing the old ones.'''
+        self.signing_key()
+        key = IssuerKey('key-{}'.format(len(self.issuer_keys) + 1))
+        with self.lock:
+            self.issuer_keys.append(key)
+
+        return key
+
+    def jwks(self):
+        self.signing_key()
+        with self.lock:
+            keys = [key.jwk() for key in self.issuer_keys]
+
+        return json.dumps({ 'keys': keys }).encode('utf-8')
+
+    def authorize(self, url):
+        '''Approve an authorization request at once, as a browser would see
+        it, and return the callback URL carrying the code.'''
+        params = dict(parse_qsl(urlsplit(url).query))
+        code   = secrets.token_urlsafe(12)
+        with self.lock:
+            self.codes[code] = params.get('nonce')
+
+        redirect_uri = params['redirect_uri']
+        separator    = '&' if '?' in redirect_uri else '?'
+        return redirect_uri + separator + 'code=' + code
+
+    def id_token(self, form):
+        '''The ID token for a code exchange, or ``None`` if the code is
+        unknown or already used.'''
+        with self.lock:
+            if form.get('code') not in self.codes:
+                return None
+
+            nonce = self.codes.pop(form['code'])
+
+        now    = int(time.time())
+        claims = {
+            'iss':  ISSUER,
+            'sub':  '987',
+            'aud':  form.get('client_id'),
+            'iat':  now,
+            'exp':  now + 300,
+            'name': 'test',
+        }
+        if nonce is not None:
+            claims['nonce'] = nonce
+
+        return self.signing_key().sign(claims)
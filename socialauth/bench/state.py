@@ -0,0 +1,69 @@
+'''Compare :class:`socialauth.StateCodec` with the PyJWT token cookie.
+
+Each round encodes an ``oauth_token_secret`` and decodes it again, which is
+the work a Twitter login does across its two legs.
+
+    $ python -m socialauth.bench.state [number]
+'''
+
+import sys
+import timeit
+
+import jwt
+
+from socialauth.state import StateCodec
+
+
+SECRET             = 'app secret'
+OAUTH_TOKEN_SECRET = 'Z6eEdO8MOmk394WozF5oKyuAv855l4Mlqo7hhlSLik'
+
+
+def codec_round_trip(codec = StateCodec(SECRET)):
+    token = codec.encode(OAUTH_TOKEN_SECRET.encode('utf-8'))
+    codec.decode(token)
+    return token
+
+
+def jwt_round_trip():
+    payload = { 'data': {
+        'type': 'oauth_token_secret',
+        'id': OAUTH_TOKEN_SECRET
+    } }
+    token = jwt.encode(payload, SECRET, algorithm = 'HS256')
+    jwt.decode(token, SECRET, algorithms = ['HS256'])
+    return token
+
+
+def run(number = 20000):
+    '''Time ``number`` round trips of each implementation.
+
+    :return: A dict keyed by implementation, with ``ops_per_second`` and
+        ``token_bytes`` for each.
+    '''
+    results = {}
+    for name, func in (('StateCodec', codec_round_trip),
+                       ('PyJWT', jwt_round_trip)):
+        elapsed = min(timeit.repeat(func, number = number, repeat = 3))
+        results[name] = dict(
+            ops_per_second = number / elapsed,
+            token_bytes    = len(func()),
+        )
+
+    return results
+
+
+def main(argv = None):
+    argv    = sys.argv[1:] if argv is None else argv
+    number  = int(argv[0]) if argv else 20000
+    results = run(number)
+    for name, result in sorted(results.items()):
+        print('{:<12} {:>12,.0f} round trips/s {:>6} byte token'.format(
+            name, result['ops_per_second'], result['token_bytes']))
+
+    speedup = (results['StateCodec']['ops_per_second'] /
+               results['PyJWT']['ops_per_second'])
+    print('StateCodec is {:.1f}x faster'.format(speedup))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+'''Compare :class:`socialauth.wsgi.AuthApp` with the Flask example in
+``app.py``.
+
+Both applications are called in-process through WSGI, one request at a
+time, and reach a local :class:`~socialauth.bench.servers.FakeProviderServer`
+through the same registry. The difference is the cost of routing, cookies and
+building the response. Flask and PyJWT are optional; without them only
+:class:`~socialauth.wsgi.AuthApp` is timed.
+
+    $ python -m socialauth.bench.wsgi [requests]
+'''
+
+import sys
+import time
+from wsgiref.util import setup_testing_defaults
+
+from socialauth.bench.load import CREDENTIALS
+from socialauth.bench.servers import FakeProviderServer
+from socialauth.registry import ProviderRegistry
+from socialauth.wsgi import AuthApp
+
+
+SECRET = 'app secret'
+
+FLOWS = (
+    ('twitter.start',   '/auth/twitter', 'login=start'),
+    ('facebook.finish', '/auth/facebook', 'code=foo'),
+)
+
+
+def flask_app(registry):
+    '''The route from ``app.py``, dispatching through ``registry``.'''
+    import jwt
+    from flask import Flask, request, redirect, jsonify, make_response, abort
+
+    app = Flask(__name__)
+    app.secret_key = SECRET
+
+    @app.route('/auth/<provider>')
+    def authenticate(provider):
+        res = registry.http_get_provider(
+            provider,
+            request.base_url,
+            request.args,
+            app.secret_key,
+            request.cookies.get('jwt'))
+
+        if res.get('status') == 302:
+            resp = make_response(redirect(res.get('redirect')))
+            if res.get('set_token_cookie') is not None:
+                resp.set_cookie('jwt', res.get('set_token_cookie'),
+                                httponly = True)
+
+            return resp
+
+        if res.get('status') == 200:
+            resp  = make_response(jsonify({ 'status': 'success' }))
+            token = jwt.encode({ 'user_id': res.get('provider_user_id') },
+                               app.secret_key,
+                               algorithm = 'HS256')
+            if isinstance(token, bytes):
+                token = token.decode('ascii')
+
+            resp.set_cookie('jwt', token, httponly = True)
+            return resp
+
+        abort(400)
+
+    return app.wsgi_app
+
+
+def call(app, path, query_string):
+    environ = dict(PATH_INFO = path, QUERY_STRING = query_string)
+    setup_testing_defaults(environ)
+    statuses = []
+    body = b''.join(app(environ, lambda status, headers: statuses.append(status)))
+    if statuses[0][:3] not in ('200', '302'):
+        raise AssertionError('{} from {}'.format(statuses[0], path))
+
+    return body
+
+
+def run(requests = 2000, server = None):
+    '''Time ``requests`` calls of each flow on each application.
+
+    :return: A dict keyed by application, then by flow, of requests per
+        second.
+    '''
+    own_server = server is None
+    if own_server:
+        server = FakeProviderServer().start()
+
+    try:
+        registry = ProviderRegistry(environ   = CREDENTIALS,
+                                    transport = server.transport())
+        apps = [('AuthApp', AuthApp(SECRET, registry = registry))]
+        try:
+            apps.append(('Flask', flask_app(registry)))
+        except ImportError:
+            pass
+
+        results = {}
+        for name, app in apps:
+            results[name] = {}
+            for flow, path, query_string in FLOWS:
+                call(app, path, query_string)
+                began = time.perf_counter()
+                for _ in range(requests):
+                    call(app, path, query_string)
+                results[name][flow] = requests / (time.perf_counter() - began)
+
+        return results
+    finally:
+        if own_server:
+            server.stop()
+
+
+def main(argv = None):
+    argv    = sys.argv[1:] if argv is None else argv
+    number  = int(argv[0]) if argv else 2000
+    results = run(number)
+    for name, flows in sorted(results.items()):
+        for flow, per_second in sorted(flows.items()):
+            print('{:<10} {:<18} {:>10,.0f} requests/s'.format(
+                name, flow, per_second))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+'''Warming a process up before it takes its first login.
+
+The first login in a fresh worker pays for importing the provider modules,
+resolving the upstream hosts and the TCP and TLS handshakes. :func:`warmup`
+does all three at boot, so that cost is not paid by a user.
+'''
+
+import socket
+import time
+from contextlib import contextmanager
+from importlib import import_module
+from urllib.parse import urlsplit
+
+from . import InvalidUsage
+from .authentication import DEFAULT_PROVIDERS, validate_provider
+
+
+# The upstream base URL each provider calls.
+UPSTREAM_URLS = {
+    'facebook': 'https://graph.facebook.com/',
+    'twitter':  'https://api.twitter.com/',
+}
+
+
+def warmup(providers = None, transport = None, connections = 1):
+    '''Import ``providers``, resolve their upstream hosts and open
+    ``connections`` keep-alive connections to each, left idle in the pool
+    of ``transport``.
+
+    Failures are reported rather than raised, so a worker still boots
+    while a provider is unreachable.
+
+    :param providers: Names of the providers to warm. Defaults to Twitter
+        and Facebook. The OpenID Connect issuer is read from ``OIDC_ISSUER``.
+    :param transport: The :class:`~socialauth.Transport` to fill. Defaults
+        to the process-wide transport.
+    :param int connections: Connections to open per upstream host.
+    :return: A report, see :func:`new_report`.
+    :raises socialauth.InvalidUsage: If a provider is not supported.
+    '''
+    if transport is None:
+        from .transport import get_default_transport
+        transport = get_default_transport()
+
+    providers = check_providers(providers)
+    report    = new_report()
+    began     = time.perf_counter()
+
+    import_providers(providers, report)
+
+    with step(report, 'resolve') as details:
+        for provider in providers:
+            host, port = address(transport, provider)
+            try:
+                details['addresses'][host] = addresses(
+                    socket.getaddrinfo(host, port, type = socket.SOCK_STREAM))
+            except OSError as e:
+                details['errors'][host] = str(e)
+
+    with step(report, 'connect') as details:
+        for provider in providers:
+            try:
+                opened = transport.preconnect(upstream_url(provider),
+                                              connections)
+            except Exception as e:
+                details['errors'][provider] = str(e)
+            else:
+                details['connections'][provider] = opened
+
+    report['seconds'] = time.perf_counter() - began
+    return report
+
+
+async def async_warmup(providers = None, transport = None, connections = 1):
+    '''Coroutine counterpart of :func:`warmup`, filling an
+    :class:`~socialauth.AsyncTransport`. Hosts are resolved and connections
+    opened concurrently.'''
+    import asyncio
+
+    if transport is None:
+        from .transport import get_default_async_transport
+        transport = get_default_async_transport()
+
+    providers = check_providers(providers)
+    report    = new_report()
+    began     = time.perf_counter()
+    loop      = asyncio.get_running_loop()
+
+    import_providers(providers, report)
+
+    with step(report, 'resolve') as details:
+        targets = [address(transport, provider) for provider in providers]
+        results = await asyncio.gather(
+            *[loop.getaddrinfo(host, port, type = socket.SOCK_STREAM)
+              for host, port in targets],
+            return_exceptions = True)
+        for (host, port), result in zip(targets, results):
+            if isinstance(result, OSError):
+                details['errors'][host] = str(result)
+            else:
+                details['addresses'][host] = addresses(result)
+
+    with step(report, 'connect') as details:
+        results = await asyncio.gather(
+            *[transport.preconnect(upstream_url(provider), connections)
+              for provider in providers],
+            return_exceptions = True)
+        for provider, result in zip(providers, results):
+            if isinstance(result, Exception):
+                details['errors'][provider] = str(result)
+            else:
+                details['connections'][provider] = result
+
+    report['seconds'] = time.perf_counter() - began
+    return report
+
+
+def new_report():
+    '''A warmup report. Each step records the seconds it took::
+
+        {
+            'imports': { 'seconds': ..., 'modules': [module] },
+            'resolve': { 'seconds': ..., 'addresses': { host: [ip] },
+                         'errors': { host: message } },
+            'connect': { 'seconds': ..., 'connections': { provider: opened },
+                         'errors': { provider: message } },
+            'seconds': ...,
+        }
+
+    Hosts are the ones actually contacted, after
+    :attr:`~socialauth.Transport.hosts` is applied.
+    '''
+    return {
+        'imports': { 'seconds': 0.0, 'modules': [] },
+        'resolve': { 'seconds': 0.0, 'addresses': {}, 'errors': {} },
+        'connect': { 'seconds': 0.0, 'connections': {}, 'errors': {} },
+        'seconds': 0.0,
+    }
+
+
+def check_providers(providers):
+    providers = list(providers or DEFAULT_PROVIDERS)
+    for name in providers:
+        if not validate_provider(name):
+            raise InvalidUsage('Provider not supported')
+
+        # Fail before any step when the OpenID issuer is not configured.
+        upstream_url(name)
+
+    return providers
+
+
+def import_providers(providers, report):
+    with step(report, 'imports') as details:
+        for provider in providers:
+            module = import_module('socialauth.providers.' + provider)
+            details['modules'].append(module.__name__)
+
+
+def upstream_url(provider):
+    if provider == 'oidc':
+        from .providers.oidc import OIDCConfig
+        return OIDCConfig.from_environ().issuer
+
+    return UPSTREAM_URLS[provider]
+
+
+def address(transport, provider):
+    parts = urlsplit(transport.resolve(upstream_url(provider)))
+    port  = parts.port or (443 if parts.scheme == 'https' else 80)
+    return (parts.hostname, port,)
+
+
+def addresses(infos):
+    return sorted(set(info[4][0] for info in infos))
+
+
+@contextmanager
+def step(report, name):
+    '''Time the step ``name`` of ``report``, yielding its details.'''
+    details = report[name]
+    began   = time.perf_counter()
+    try:
+        yield details
+    finally:
+        details['seconds'] = time.perf_counter() - began
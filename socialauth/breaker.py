@@ -0,0 +1,191 @@
+import threading
+import time
+
+from . import Error
+
+
+CLOSED    = 'closed'
+OPEN      = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(Error):
+    '''Raised instead of calling an upstream endpoint whose circuit is open.
+
+    :ivar float retry_after: Seconds until the circuit lets a probe through.
+    '''
+
+    status_code = 503
+
+    def __init__(self, message, retry_after = 0.0):
+        Error.__init__(self, message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    '''Fails fast while an upstream endpoint is degraded.
+
+    The circuit opens after ``failure_threshold`` consecutive failures. A
+    failure is an exception from the transport (including timeouts), a 5xx
+    response, or a call slower than ``latency_threshold``. While open, calls
+    raise :class:`CircuitOpenError` without touching the network. Once
+    ``reset_timeout`` has passed the circuit is half-open: up to
+    ``half_open_probes`` calls go through, and the first result decides
+    whether it closes again or reopens.
+
+    :param str name: Used in error messages, e.g. ``'facebook.user_information'``.
+    :param int failure_threshold: Consecutive failures that open the circuit.
+    :param float latency_threshold: Seconds after which a successful call
+        still counts as a failure. ``None`` disables the latency check.
+    :param float reset_timeout: Seconds the circuit stays open.
+    :param int half_open_probes: Concurrent calls allowed while half-open.
+    '''
+
+    def __init__(self, name = 'upstream', failure_threshold = 5,
+                 latency_threshold = None, reset_timeout = 30.0,
+                 half_open_probes = 1):
+        self.name              = name
+        self.failure_threshold = failure_threshold
+        self.latency_threshold = latency_threshold
+        self.reset_timeout     = reset_timeout
+        self.half_open_probes  = half_open_probes
+
+        self.state     = CLOSED
+        self.failures  = 0
+        self.opened_at = None
+        self.probes    = 0
+        self.rejected  = 0
+
+        self._lock = threading.Lock()
+
+    def before(self):
+        '''Admit a call or raise :class:`CircuitOpenError`.'''
+        with self._lock:
+            if self.state == CLOSED:
+                return
+
+            elapsed = time.monotonic() - self.opened_at
+            if self.state == OPEN and elapsed >= self.reset_timeout:
+                self.state  = HALF_OPEN
+                self.probes = 0
+
+            if self.state == HALF_OPEN and self.probes < self.half_open_probes:
+                self.probes += 1
+                return
+
+            self.rejected += 1
+            retry_after = max(self.reset_timeout - elapsed, 0.0)
+
+        raise CircuitOpenError('{} circuit is open'.format(self.name),
+                               retry_after)
+
+    def success(self, seconds = 0.0):
+        if self.latency_threshold is not None and seconds > self.latency_threshold:
+            return self.failure()
+
+        with self._lock:
+            self.state    = CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state     = OPEN
+                self.opened_at = time.monotonic()
+
+    def guard(self):
+        '''A context manager wrapping one upstream call.
+
+        Call :meth:`Guard.observe` with the response so 5xx statuses count as
+        failures.
+        '''
+        return Guard(self)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                state    = self.state,
+                failures = self.failures,
+                rejected = self.rejected,
+            )
+
+
+class Guard:
+    __slots__ = ('breaker', 'began', 'status')
+
+    def __init__(self, breaker):
+        self.breaker = breaker
+        self.status  = None
+
+    def __enter__(self):
+        self.breaker.before()
+        self.began = time.monotonic()
+        return self
+
+    def observe(self, resp):
+        self.status = resp.status
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None or (self.status or 0) >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success(time.monotonic() - self.began)
+
+        return False
+
+
+class NullGuard:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def observe(self, resp):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_GUARD = NullGuard()
+
+
+class CircuitBreakers:
+    '''One :class:`CircuitBreaker` per provider and endpoint, created on
+    first use with shared settings.
+
+    Assign it to a provider config's ``breakers`` attribute, for instance
+    with :meth:`socialauth.ProviderRegistry.configure`. Keyword arguments are
+    passed to every :class:`CircuitBreaker`.
+    '''
+
+    def __init__(self, **settings):
+        self.settings = settings
+        self.breakers = {}
+        self._lock    = threading.Lock()
+
+    def get(self, provider, endpoint):
+        key     = (provider, endpoint,)
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            with self._lock:
+                breaker = self.breakers.get(key)
+                if breaker is None:
+                    breaker = self.breakers[key] = CircuitBreaker(
+                        '{}.{}'.format(provider, endpoint), **self.settings)
+
+        return breaker
+
+    def states(self):
+        '''Map ``'provider.endpoint'`` to each circuit's state.'''
+        return dict(
+            (breaker.name, breaker.state) for breaker in self.breakers.values()
+        )
+
+
+def guard(breakers, provider, endpoint):
+    if breakers is None:
+        return NULL_GUARD
+
+    return breakers.get(provider, endpoint).guard()
@@ -0,0 +1,96 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    '''A bounded, thread-safe mapping whose entries expire.
+
+    Entries live for ``ttl`` seconds. Once ``maxsize`` entries are held, the
+    least recently used one is evicted to make room.
+
+    :param int maxsize: The most entries to hold.
+    :param float ttl: Seconds an entry stays valid after it was set.
+    '''
+
+    def __init__(self, maxsize = 1024, ttl = 60.0):
+        self.maxsize = maxsize
+        self.ttl     = ttl
+
+        self.hits        = 0
+        self.misses      = 0
+        self.evictions   = 0
+        self.expirations = 0
+
+        self._entries = OrderedDict()
+        self._lock    = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default = None):
+        '''Return the live value for ``key``, or ``default``.'''
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+
+                del self._entries[key]
+                self.expirations += 1
+
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl = None):
+        '''Store ``value`` under ``key`` for ``ttl`` (default :attr:`ttl`)
+        seconds.'''
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires, value,)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last = False)
+                self.evictions += 1
+
+    def pop(self, key, default = None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+        if entry is None or entry[0] <= time.monotonic():
+            return default
+
+        return entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        '''Counters for hits, misses, evictions and expirations.'''
+        with self._lock:
+            return dict(
+                size        = len(self._entries),
+                hits        = self.hits,
+                misses      = self.misses,
+                evictions   = self.evictions,
+                expirations = self.expirations,
+            )
+
+
+def hash_key(*parts):
+    '''A fixed-size cache key for secrets such as access tokens, so the
+    secrets themselves are never kept in memory by a cache.'''
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+
+        digest.update(part)
+        digest.update(b'\0')
+
+    return digest.digest()
@@ -0,0 +1,188 @@
+import json
+import math
+from urllib.parse import parse_qsl
+
+from . import Error, InvalidUsage
+from .registry import ProviderRegistry
+from .sessions import Sessions
+
+
+JSON_HEADER = ('Content-Type', 'application/json',)
+
+SUCCESS_BODY = b'{"status":"success"}'
+
+
+class AuthEndpoint:
+    '''The protocol-independent half of :class:`socialauth.wsgi.AuthApp` and
+    :class:`socialauth.asgi.AsyncAuthApp`.
+
+    Turns a request on ``<prefix><provider>`` into a status, headers and a
+    body. The token cookie of the OAuth flow is kept in ``state_cookie``.
+    Once a login succeeds, ``session_cookie`` holds a signed token naming the
+    provider and user; read it back with :meth:`read_session`.
+
+    :param token_secret: Signs the state and session cookies. A ``str`` or a
+        :class:`~socialauth.KeyRing`.
+    :param registry: A :class:`~socialauth.ProviderRegistry`. Defaults to one
+        reading credentials from the environment.
+    :param str prefix: The path the provider name follows.
+    :param str state_cookie: The name of the token cookie.
+    :param str session_cookie: The name of the session cookie.
+    :param int session_ttl: Seconds a session cookie stays valid.
+    :param bool secure: Mark cookies ``Secure``. ``None`` does so for HTTPS
+        requests only.
+    :param sessions: :class:`~socialauth.Sessions` issuing the session
+        cookie. Passing them also enables the returning-user fast path, and
+        ``session_ttl`` is then taken from them.
+    '''
+
+    def __init__(self, token_secret, registry = None, prefix = '/auth/',
+                 state_cookie = 'socialauth_state',
+                 session_cookie = 'socialauth_session',
+                 session_ttl = 30 * 24 * 60 * 60, secure = None,
+                 sessions = None):
+        self.token_secret   = token_secret
+        self.registry       = registry or ProviderRegistry()
+        self.prefix         = prefix
+        self.state_cookie   = state_cookie
+        self.session_cookie = session_cookie
+        self.secure         = secure
+        self.fast_path      = sessions is not None
+        self.sessions       = sessions or Sessions(token_secret, ttl = session_ttl)
+        self.session_ttl    = self.sessions.ttl
+
+    def route(self, path):
+        '''The provider named by ``path``, or ``None`` if it is not ours.'''
+        if not path.startswith(self.prefix):
+            return None
+
+        provider = path[len(self.prefix):]
+        if not provider or '/' in provider:
+            return None
+
+        return provider
+
+    def parse(self, query_string, cookie_header):
+        params       = dict(parse_qsl(query_string))
+        token_cookie = cookie_value(cookie_header, self.state_cookie)
+        return (params, token_cookie,)
+
+    def session_options(self, cookie_header):
+        if not self.fast_path:
+            return {}
+
+        return dict(sessions      = self.sessions,
+                    session_token = cookie_value(cookie_header,
+                                                 self.session_cookie))
+
+    def handle(self, provider, request_url, query_string, cookie_header,
+               https = False):
+        '''Run one request through the registry.
+
+        :return: ``(status, headers, body)`` with ``headers`` a list of
+            ``(name, value)`` pairs.
+        '''
+        params, token_cookie = self.parse(query_string, cookie_header)
+        try:
+            result = self.registry.http_get_provider(
+                provider, request_url, params, self.token_secret, token_cookie,
+                **self.session_options(cookie_header))
+        except (Error, InvalidUsage) as e:
+            return self.error(e)
+
+        return self.respond(provider, result, https)
+
+    async def async_handle(self, provider, request_url, query_string,
+                           cookie_header, https = False):
+        '''Coroutine counterpart of :meth:`handle`.'''
+        params, token_cookie = self.parse(query_string, cookie_header)
+        try:
+            result = await self.registry.async_http_get_provider(
+                provider, request_url, params, self.token_secret, token_cookie,
+                **self.session_options(cookie_header))
+        except (Error, InvalidUsage) as e:
+            return self.error(e)
+
+        return self.respond(provider, result, https)
+
+    def respond(self, provider, result, https):
+        secure = https if self.secure is None else self.secure
+
+        if result['status'] == 302:
+            headers = [('Location', result['redirect'],)]
+            if 'set_token_cookie' in result:
+                headers.append(('Set-Cookie', set_cookie(
+                    self.state_cookie, result['set_token_cookie'], secure)))
+
+            return (302, headers, b'',)
+
+        headers = [
+            JSON_HEADER,
+            ('Set-Cookie', set_cookie(self.session_cookie,
+                                      self.encode_session(provider, result),
+                                      secure,
+                                      max_age = self.session_ttl)),
+            ('Set-Cookie', set_cookie(self.state_cookie, '', secure,
+                                      max_age = 0)),
+        ]
+        return (200, headers, SUCCESS_BODY,)
+
+    def error(self, e):
+        '''The response to ``e``. Each :class:`~socialauth.Error` has its
+        ``status_code``: 502 for upstream failures, 400 for a
+        :class:`~socialauth.ClientError`, 429 when rate limited and 503
+        while a circuit is open. The last two carry ``Retry-After``.'''
+        headers = [JSON_HEADER]
+        if isinstance(e, InvalidUsage):
+            status, body = e.status_code, e.to_dict()
+        else:
+            status, body = e.status_code, { 'errors': [{
+                'status': e.status_code,
+                'title': e.message,
+            }] }
+
+        retry_after = getattr(e, 'retry_after', None)
+        if retry_after is not None:
+            headers.append(('Retry-After', str(int(math.ceil(retry_after))),))
+
+        return (status, headers, json.dumps(body).encode('utf-8'),)
+
+    def encode_session(self, provider, result):
+        return self.sessions.encode_result(provider, result)
+
+    def read_session(self, cookie):
+        '''Decode a session cookie.
+
+        :param str cookie: The cookie's value, or a whole ``Cookie`` header
+            containing it.
+        :return: A dict with ``provider``, ``tenant``, ``user_id``,
+            ``user_name`` and ``auth_time``, or ``None`` if the cookie is
+            missing, expired or forged.
+        '''
+        if cookie and '=' in cookie:
+            cookie = cookie_value(cookie, self.session_cookie)
+
+        return self.sessions.decode(cookie)
+
+
+def cookie_value(header, name):
+    '''The value of cookie ``name`` in a ``Cookie`` header, if present.'''
+    if not header:
+        return None
+
+    for pair in header.split(';'):
+        key, sep, value = pair.strip().partition('=')
+        if sep and key == name:
+            return value
+
+    return None
+
+
+def set_cookie(name, value, secure, max_age = None):
+    cookie = '{}={}; Path=/; HttpOnly; SameSite=Lax'.format(name, value)
+    if max_age is not None:
+        cookie += '; Max-Age={}'.format(max_age)
+    if secure:
+        cookie += '; Secure'
+
+    return cookie
@@ -0,0 +1,309 @@
+'''Long-lived, stateless login handlers.
+
+A provider class such as :class:`~socialauth.providers.Twitter` is built for
+every request and keeps the request, its tokens and its result as
+attributes. A handler is built once per provider and token secret and keeps
+nothing per request: each call works in local variables and returns a
+:class:`LoginResult` of five slots. One handler serves every thread, and a
+login allocates little beyond the upstream responses themselves.
+
+Handlers do no I/O of their own. Each leg is a flow of steps, see
+:mod:`socialauth.protocol`, which :meth:`Handler.run` drives over a blocking
+transport and :meth:`Handler.async_run` over an asyncio one.
+'''
+
+from . import ClientError, InvalidUsage
+from .breaker import guard
+from .cache import hash_key
+from .instrumentation import get_instrumentation
+from .protocol import drive, async_drive
+from .transport import get_default_transport, get_default_async_transport
+
+
+class LoginResult:
+    '''The outcome of a login step.
+
+    A redirect has ``status`` 302, ``redirect`` and usually
+    ``set_token_cookie``. A finished login has ``status`` 200, ``user_id``
+    and ``user_name``, which may be ``None``.
+    '''
+
+    __slots__ = ('status', 'redirect', 'set_token_cookie', 'user_id',
+                 'user_name')
+
+    def __init__(self, status, redirect = None, set_token_cookie = None,
+                 user_id = None, user_name = None):
+        self.status           = status
+        self.redirect         = redirect
+        self.set_token_cookie = set_token_cookie
+        self.user_id          = user_id
+        self.user_name        = user_name
+
+    def __repr__(self):
+        return 'LoginResult({})'.format(', '.join(
+            '{}={!r}'.format(name, getattr(self, name))
+            for name in self.__slots__ if getattr(self, name) is not None))
+
+    def to_dict(self):
+        '''The result as returned by :func:`socialauth.http_get_provider`.'''
+        if self.status == 302:
+            ret = dict(status = 302, redirect = self.redirect)
+            if self.set_token_cookie is not None:
+                ret['set_token_cookie'] = self.set_token_cookie
+
+            return ret
+
+        if self.status == 200 and self.user_id is not None:
+            ret = dict(status = 200, provider_user_id = self.user_id)
+            if self.user_name is not None:
+                ret['provider_user_name'] = self.user_name
+
+            return ret
+
+        raise InvalidUsage('Invalid request')  # pragma: no cover
+
+
+class Handler:
+    '''The shared part of the provider handlers.
+
+    Subclasses write each leg as a flow of steps, see
+    :mod:`socialauth.protocol`. The methods here run those flows over a
+    transport.
+
+    :param token_secret: An app secret to encode/decode state cookies, or a
+        :class:`~socialauth.KeyRing`.
+    :param config: The provider config. Defaults to one read from the
+        environment.
+    :param transport: A :class:`~socialauth.Transport` to reach the
+        provider with. Defaults to the process-wide pooled transport.
+    :param async_transport: An :class:`~socialauth.AsyncTransport` for the
+        coroutine methods. Defaults to the running event loop's transport.
+    :raises socialauth.Error: If credentials are missing.
+    '''
+
+    name         = None
+    config_class = None
+
+    # The config attribute rate limits are keyed by.
+    credential = 'client_id'
+
+    def __init__(self, token_secret, config = None, transport = None,
+                 async_transport = None):
+        self.token_secret    = token_secret
+        self.config          = config or self.config_class.from_environ()
+        self.transport       = transport
+        self.async_transport = async_transport
+        self.client_key      = getattr(self.config, self.credential)
+
+    @property
+    def instrumentation(self):
+        return self.config.instrumentation or get_instrumentation()
+
+    def leg(self, params):
+        '''``'start'`` or ``'finish'``, whichever ``params`` asks for.
+
+        :raises socialauth.InvalidUsage: If ``params`` is neither.
+        '''
+        if params.get('login') == 'start':
+            return 'start'
+
+        if self.is_callback(params):
+            return 'finish'
+
+        raise InvalidUsage('Invalid request')
+
+    def is_callback(self, params):
+        return 'code' in params
+
+    def steps(self, leg, request_url, params, cookie = None):
+        '''The flow of steps for ``leg``, see :mod:`socialauth.protocol`.'''
+        if leg == 'start':
+            return self.start_steps(request_url)
+
+        return self.finish_steps(request_url, params, cookie)
+
+    def start_steps(self, request_url):
+        raise NotImplementedError
+
+    def finish_steps(self, request_url, params, cookie = None):
+        raise NotImplementedError
+
+    def run(self, leg, steps, transport = None):
+        '''Drive ``steps`` over a blocking transport.'''
+        transport = transport or self.transport or get_default_transport()
+        with self.instrumentation.span(self.name + '.' + leg):
+            return drive(self, steps, transport)
+
+    async def async_run(self, leg, steps, transport = None):
+        '''Drive ``steps`` over an asynchronous transport.'''
+        transport = (transport or self.async_transport or
+                     get_default_async_transport())
+        with self.instrumentation.span(self.name + '.' + leg):
+            return await async_drive(self, steps, transport)
+
+    def handle(self, request_url, params, cookie = None, transport = None):
+        '''Start the login when ``params`` has ``login=start``, otherwise
+        finish it.
+
+        :param transport: Overrides the handler's transport for this call.
+        :rtype: LoginResult
+        :raises socialauth.InvalidUsage: If ``params`` is neither.
+        '''
+        leg = self.leg(params)
+        return self.run(leg, self.steps(leg, request_url, params, cookie),
+                        transport)
+
+    async def async_handle(self, request_url, params, cookie = None,
+                           transport = None):
+        '''Coroutine counterpart of :meth:`handle`.'''
+        leg = self.leg(params)
+        return await self.async_run(
+            leg, self.steps(leg, request_url, params, cookie), transport)
+
+    def start(self, request_url):
+        '''Begin the login, redirecting to the provider.
+
+        :param str request_url: The authentication endpoint/callback.
+        :rtype: LoginResult
+        '''
+        return self.run('start', self.start_steps(request_url))
+
+    def finish(self, request_url, params, cookie = None):
+        '''Complete the login from the provider's callback.
+
+        :param str request_url: The authentication endpoint/callback.
+        :param dict params: GET parameters from the query string.
+        :param str cookie: The token cookie set by :meth:`start`.
+        :rtype: LoginResult
+        :raises socialauth.InvalidUsage: If ``params`` is not a callback.
+        '''
+        if not self.is_callback(params):
+            raise InvalidUsage('Invalid request')
+
+        return self.run('finish', self.finish_steps(request_url, params, cookie))
+
+    def guard(self, endpoint):
+        return guard(self.config.breakers, self.name, endpoint)
+
+    def throttle(self):
+        limiter = self.config.rate_limiter
+        if limiter is not None:
+            limiter.acquire(self.name, self.client_key)
+
+    async def async_throttle(self):
+        limiter = self.config.rate_limiter
+        if limiter is not None:
+            await limiter.async_acquire(self.name, self.client_key)
+
+    def observe(self, endpoint, resp):
+        self.count_status(endpoint, resp)
+        limiter = self.config.rate_limiter
+        if limiter is not None:
+            limiter.observe(self.name, self.client_key, resp)
+
+    async def async_observe(self, endpoint, resp):
+        self.count_status(endpoint, resp)
+        limiter = self.config.rate_limiter
+        if limiter is not None:
+            await limiter.async_observe(self.name, self.client_key, resp)
+
+    def count_status(self, endpoint, resp):
+        self.instrumentation.count(self.name + '.status',
+                                   endpoint = endpoint,
+                                   status   = resp.status)
+
+    def check_rejected(self, *credential):
+        '''Fail without calling the provider if it recently rejected
+        ``credential``, such as a replayed authorization code.
+
+        :raises socialauth.ClientError: If the credential is in the config's
+            ``rejected_cache``.
+        '''
+        cache = self.config.rejected_cache
+        if cache is not None and cache.get(hash_key(self.name, *credential)):
+            raise ClientError('{} credential was already rejected'.format(
+                self.name))
+
+    def note_rejection(self, resp, content, *credential):
+        '''Remember ``credential`` if the provider refused it for good, as
+        :meth:`rejects` decides. Throttling, timeouts and server errors may
+        pass, so they are never remembered.'''
+        cache = self.config.rejected_cache
+        if (cache is not None and resp.status not in (408, 429,) and
+                self.rejects(resp, content)):
+            cache.set(hash_key(self.name, *credential), True)
+
+    def rejects(self, resp, content):
+        '''Whether a response refuses the credential itself, so that
+        sending it again can only fail.'''
+        return False
+
+
+class Provider:
+    '''One login request, run as the object is built.
+
+    The result is left in ``status``, ``redirect``, ``set_token_cookie``,
+    ``user_id`` and ``user_name``. The protocol work is done by a
+    :class:`Handler`, which long-lived code should use directly.
+    '''
+
+    name          = None
+    config_class  = None
+    handler_class = None
+
+    def __init__(self, request_url, params, token_secret, token_cookie,
+                 transport = None, config = None):
+        self.configure(request_url, params, token_secret, token_cookie,
+                       transport or get_default_transport(), config)
+        self.run()
+
+    def configure(self, request_url, params, token_secret, token_cookie,
+                  transport, config = None):
+        self.request_url  = request_url
+        self.params       = params
+        self.token_secret = token_secret
+        self.token_cookie = token_cookie
+        self.transport    = transport
+
+        self.status           = False
+        self.redirect         = None
+        self.set_token_cookie = None
+        self.user_id          = None
+        self.user_name        = None
+
+        self.handler = self.handler_class(token_secret, config)
+        self.config  = self.handler.config
+        self.flow    = self.handler.leg(params)
+
+    def steps(self):
+        return self.handler.steps(self.flow, self.request_url, self.params,
+                                  self.token_cookie)
+
+    def run(self):
+        self.finished(self.handler.run(self.flow, self.steps(),
+                                       self.transport))
+
+    def finished(self, result):
+        self.status           = result.status
+        self.redirect         = result.redirect
+        self.set_token_cookie = result.set_token_cookie
+        self.user_id          = result.user_id
+        self.user_name        = result.user_name
+
+
+class AsyncProvider(Provider):
+    '''Non-blocking :class:`Provider` for asyncio.
+
+    Construction validates the request without any I/O. ``await``
+    :meth:`run` to perform the flow over an
+    :class:`~socialauth.AsyncTransport`.
+    '''
+
+    def __init__(self, request_url, params, token_secret, token_cookie,
+                 transport = None, config = None):
+        self.configure(request_url, params, token_secret, token_cookie,
+                       transport or get_default_async_transport(), config)
+
+    async def run(self):
+        self.finished(await self.handler.async_run(self.flow, self.steps(),
+                                                   self.transport))
@@ -0,0 +1,374 @@
+'''Hedged requests for idempotent upstream calls.
+
+Most slow logins are slow because of one rare, slow response. A
+:class:`Hedger` sends a second copy of a request that has not answered
+within the usual latency of its endpoint, and takes whichever copy answers
+first. With the delay at the 95th percentile, about one request in twenty
+is duplicated and the tail beyond it mostly disappears.
+
+Only calls that are safe to repeat are hedged: the Graph ``/me`` lookup and
+the Twitter ``request_token`` call. Code and verifier exchanges are never
+hedged, since the second copy would find the code already used.
+'''
+
+import math
+import threading
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
+)
+
+
+class LatencyHistogram:
+    '''Latencies over a rolling window, counted in log-spaced buckets.
+
+    The window is split into ``slices``; recording into a slice whose time
+    has come round again clears it first, so old latencies age out without
+    being stored. Bucket bounds grow by ``growth``, which keeps quantiles
+    within that factor of the true value.
+
+    :param float window: Seconds of latencies kept.
+    :param int slices: Parts the window is aged out in.
+    :param float base: The upper bound of the first bucket, in seconds.
+    :param float growth: The ratio between consecutive bucket bounds.
+    :param int buckets: The number of buckets. The last holds everything
+        above ``base * growth ** (buckets - 2)``.
+    '''
+
+    def __init__(self, window = 60.0, slices = 6, base = 0.0005,
+                 growth = 2 ** 0.25, buckets = 72):
+        self.slice_seconds = window / slices
+        self.base          = base
+        self.growth        = growth
+        self.counts        = [[0] * buckets for _ in range(slices)]
+        self.epochs        = [None] * slices
+
+        self._lock = threading.Lock()
+
+    def bucket(self, seconds):
+        if seconds <= self.base:
+            return 0
+
+        index = int(math.log(seconds / self.base, self.growth)) + 1
+        return min(index, len(self.counts[0]) - 1)
+
+    def upper_bound(self, bucket):
+        return self.base * self.growth ** bucket
+
+    def record(self, seconds, now = None):
+        now    = time.monotonic() if now is None else now
+        epoch  = int(now / self.slice_seconds)
+        index  = epoch % len(self.counts)
+        bucket = self.bucket(seconds)
+        with self._lock:
+            if self.epochs[index] != epoch:
+                self.epochs[index] = epoch
+                self.counts[index] = [0] * len(self.counts[index])
+
+            self.counts[index][bucket] += 1
+
+    def quantile(self, q, now = None):
+        '''The ``q`` quantile of the window and the number of samples it is
+        based on, as ``(seconds, samples)``. ``seconds`` is ``None`` when
+        there are no samples.'''
+        now    = time.monotonic() if now is None else now
+        oldest = int(now / self.slice_seconds) - len(self.counts) + 1
+        with self._lock:
+            totals = [0] * len(self.counts[0])
+            for epoch, counts in zip(self.epochs, self.counts):
+                if epoch is not None and epoch >= oldest:
+                    totals = [a + b for a, b in zip(totals, counts)]
+
+        samples = sum(totals)
+        if not samples:
+            return (None, 0,)
+
+        target     = q * samples
+        cumulative = 0
+        for bucket, count in enumerate(totals):
+            cumulative += count
+            if cumulative >= target:
+                break
+
+        return (self.upper_bound(bucket), samples,)
+
+
+class Hedger:
+    '''Sends a second copy of a slow idempotent request.
+
+    Each endpoint's latency is kept in a :class:`LatencyHistogram`. A
+    request still unanswered after the ``quantile`` of that histogram,
+    bounded by ``min_delay`` and ``max_delay``, is sent again. Until an
+    endpoint has ``min_samples`` latencies, ``max_delay`` is used.
+
+    Hedges are paid for from a budget: every request adds ``budget`` to it,
+    up to ``burst``, and every hedge takes one. An upstream that slows down
+    across the board therefore sees at most ``budget`` more traffic, not
+    twice as much. The rate limiter does not count hedges; the budget
+    bounds them instead.
+
+    Synchronous requests run on a thread pool of ``max_workers`` threads
+    while they may be hedged, and the delay counts from when a request
+    starts on a worker. When every worker is busy, requests are made on the
+    calling thread without a hedge. The losing copy of a synchronous
+    request finishes in the background; an asynchronous one is cancelled.
+
+    Attach a hedger as ``hedger`` on a provider config, or to every config
+    with :meth:`socialauth.ProviderRegistry.configure`.
+
+    :param float quantile: The latency quantile to hedge after.
+    :param float min_delay: The shortest wait before hedging.
+    :param float max_delay: The longest wait before hedging.
+    :param int min_samples: Latencies needed before the quantile is used.
+    :param float budget: Hedges allowed per request, on average.
+    :param float burst: Hedges that may be saved up.
+    :param float window: Seconds of latencies the quantile is taken over.
+    :param int max_workers: Threads for synchronous requests.
+    '''
+
+    def __init__(self, quantile = 0.95, min_delay = 0.005, max_delay = 1.0,
+                 min_samples = 50, budget = 0.05, burst = 10.0,
+                 window = 60.0, max_workers = 32):
+        self.quantile    = quantile
+        self.min_delay   = min_delay
+        self.max_delay   = max_delay
+        self.min_samples = min_samples
+        self.budget      = budget
+        self.burst       = burst
+        self.window      = window
+        self.max_workers = max_workers
+
+        self.histograms = {}
+        self.tokens     = burst
+        self.executor   = None
+        self.running    = 0
+
+        self.requests = 0
+        self.hedged   = 0
+        self.wins     = 0
+        self.denied   = 0
+
+        self._lock = threading.Lock()
+
+    def histogram(self, provider, endpoint):
+        key = (provider, endpoint,)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(
+                    key, LatencyHistogram(window = self.window))
+
+        return histogram
+
+    def delay(self, histogram):
+        '''Seconds to wait before hedging a request.'''
+        seconds, samples = histogram.quantile(self.quantile)
+        if samples < self.min_samples:
+            return self.max_delay
+
+        return min(max(seconds, self.min_delay), self.max_delay)
+
+    def admit(self):
+        '''Take a hedge from the budget, if there is one.'''
+        with self._lock:
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                self.hedged += 1
+                return True
+
+            self.denied += 1
+            return False
+
+    def begin(self):
+        with self._lock:
+            self.requests += 1
+            self.tokens    = min(self.tokens + self.budget, self.burst)
+
+    def won(self):
+        with self._lock:
+            self.wins += 1
+
+    def request(self, provider, endpoint, send):
+        '''Call ``send()``, and call it again if it is slow.
+
+        :param send: Makes the request and returns ``(response, content)``.
+            It is called once per copy, so it can sign each copy afresh.
+        :return: The first successful ``(response, content)``.
+        '''
+        histogram = self.histogram(provider, endpoint)
+        delay     = self.delay(histogram)
+        self.begin()
+
+        if not self.reserve():
+            # Every worker is busy. Time queued for one would pass for a
+            # slow upstream and set off hedges, so call it here, unhedged.
+            return timed(histogram, send)
+
+        primary, started = self.start(histogram, send)
+        started.wait()
+        try:
+            return primary.result(timeout = delay)
+        except TimeoutError:
+            pass
+
+        if not self.reserve():
+            return primary.result()
+
+        if not self.admit():
+            self.release()
+            return primary.result()
+
+        hedge, _ = self.start(histogram, send)
+        pending  = set((primary, hedge,))
+        error    = None
+        while pending:
+            done, pending = wait(pending, return_when = FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self.won()
+                    return future.result()
+
+                error = error or future.exception()
+
+        raise error
+
+    async def async_request(self, provider, endpoint, send):
+        '''Coroutine counterpart of :meth:`request`. ``send()`` returns an
+        awaitable.'''
+        import asyncio
+
+        histogram = self.histogram(provider, endpoint)
+        delay     = self.delay(histogram)
+        self.begin()
+
+        primary = asyncio.ensure_future(async_timed(histogram, send))
+        hedge   = None
+        try:
+            done, pending = await asyncio.wait((primary,), timeout = delay)
+            if done or not self.admit():
+                return await primary
+
+            hedge   = asyncio.ensure_future(async_timed(histogram, send))
+            pending = set((primary, hedge,))
+            error   = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when = asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.won()
+                        return task.result()
+
+                    error = error or task.exception()
+
+            raise error
+        finally:
+            for task in (primary, hedge,):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def reserve(self):
+        '''Claim a worker, if one is free.'''
+        with self._lock:
+            if self.running >= self.max_workers:
+                return False
+
+            self.running += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.running -= 1
+
+    def start(self, histogram, send):
+        '''Run ``send()`` on a claimed worker.
+
+        :return: The future and an event set once the call begins.
+        '''
+        started = threading.Event()
+
+        def run():
+            started.set()
+            try:
+                return timed(histogram, send)
+            finally:
+                self.release()
+
+        try:
+            return (self.get_executor().submit(run), started,)
+        except BaseException:
+            self.release()
+            raise
+
+    def get_executor(self):
+        if self.executor is None:
+            with self._lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(
+                        max_workers        = self.max_workers,
+                        thread_name_prefix = 'socialauth-hedge')
+
+        return self.executor
+
+    def close(self):
+        '''Stop the thread pool once running requests finish.'''
+        if self.executor is not None:
+            self.executor.shutdown(wait = False)
+            self.executor = None
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                requests = self.requests,
+                hedged   = self.hedged,
+                wins     = self.wins,
+                denied   = self.denied,
+            )
+
+
+def timed(histogram, send):
+    began  = time.monotonic()
+    result = send()
+    histogram.record(time.monotonic() - began)
+    return result
+
+
+async def async_timed(histogram, send):
+    import asyncio
+
+    began = time.monotonic()
+    try:
+        result = await send()
+    except asyncio.CancelledError:
+        # A cancelled loser took at least this long. Leaving it out would
+        # pull the learned quantile below the real one.
+        histogram.record(time.monotonic() - began)
+        raise
+
+    histogram.record(time.monotonic() - began)
+    return result
+
+
+def hedged(hedger, provider, endpoint, transport, make_request):
+    '''Send the request ``make_request()`` describes over ``transport``,
+    hedged if ``hedger`` is set.'''
+    def send():
+        return transport.request(*make_request())
+
+    if hedger is None:
+        return send()
+
+    return hedger.request(provider, endpoint, send)
+
+
+async def async_hedged(hedger, provider, endpoint, transport, make_request):
+    '''Coroutine counterpart of :func:`hedged`.'''
+    def send():
+        return transport.request(*make_request())
+
+    if hedger is None:
+        return await send()
+
+    return await hedger.async_request(provider, endpoint, send)
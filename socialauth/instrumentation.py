@@ -0,0 +1,100 @@
+import time
+
+
+class Instrumentation:
+    '''Receives timings and counters from the providers.
+
+    Subclass it and override :meth:`record` and :meth:`count` to feed a
+    metrics pipeline, then install it with :func:`set_instrumentation` or on a
+    provider config's ``instrumentation`` attribute.
+
+    Span names are ``<provider>.<phase>``:
+
+    ``start``, ``finish``
+        A whole leg of the login flow.
+
+    ``access_token``, ``user_information``, ``request_token``
+        An upstream call, including parsing its response.
+
+    ``sign``
+        OAuth 1.0a request signing (Twitter).
+
+    ``state_encode``, ``state_decode``
+        Encoding and verifying the token cookie (Twitter).
+
+    Every upstream response also counts ``<provider>.status`` with
+    ``endpoint`` and ``status`` tags.
+    '''
+
+    def span(self, name, **tags):
+        '''A context manager timing ``name``.'''
+        return Span(self, name, tags)
+
+    def record(self, name, seconds, error = None, **tags):
+        '''Called when a span ends.
+
+        :param str name: The span name.
+        :param float seconds: How long the span took.
+        :param str error: The exception class name, if the span raised.
+        '''
+
+    def count(self, name, value = 1, **tags):
+        '''Increment counter ``name`` by ``value``.'''
+
+
+class Span:
+    __slots__ = ('instrumentation', 'name', 'tags', 'began')
+
+    def __init__(self, instrumentation, name, tags):
+        self.instrumentation = instrumentation
+        self.name            = name
+        self.tags            = tags
+
+    def __enter__(self):
+        self.began = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        error = exc_type.__name__ if exc_type is not None else None
+        self.instrumentation.record(self.name,
+                                    time.perf_counter() - self.began,
+                                    error = error,
+                                    **self.tags)
+        return False
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class NullInstrumentation(Instrumentation):
+    '''The default: discards everything without timing anything.'''
+
+    def span(self, name, **tags):
+        return NULL_SPAN
+
+
+_instrumentation = NullInstrumentation()
+
+
+def get_instrumentation():
+    '''Return the process-wide :class:`Instrumentation`.'''
+    return _instrumentation
+
+
+def set_instrumentation(instrumentation):
+    '''Install ``instrumentation`` for every provider without its own.
+
+    Pass ``None`` to restore the no-op default.
+    '''
+    global _instrumentation
+    _instrumentation = instrumentation or NullInstrumentation()
@@ -0,0 +1,216 @@
+'''Local verification of OpenID Connect ID tokens.
+
+An ID token is a JSON web token signed by the issuer with one of the keys
+it publishes at its ``jwks_uri``. :class:`KeySet` caches those keys by
+``kid``, so verifying a token is a dict lookup and an RSA public-key
+operation, without calling the issuer.
+
+Only the RSASSA-PKCS1-v1_5 algorithms (``RS256``, ``RS384`` and ``RS512``)
+are accepted; they are the ones every OpenID provider supports.
+'''
+
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
+
+from . import ClientError, Error
+
+
+# The DER DigestInfo prefix of each algorithm's hash (RFC 8017, 9.2).
+ALGORITHMS = {
+    'RS256': (hashlib.sha256,
+              bytes.fromhex('3031300d060960864801650304020105000420'),),
+    'RS384': (hashlib.sha384,
+              bytes.fromhex('3041300d060960864801650304020205000430'),),
+    'RS512': (hashlib.sha512,
+              bytes.fromhex('3051300d060960864801650304020305000440'),),
+}
+
+
+def b64decode(value):
+    if isinstance(value, str):
+        value = value.encode('ascii')
+
+    return base64.urlsafe_b64decode(value + b'=' * (-len(value) % 4))
+
+
+def b64encode(value):
+    return base64.urlsafe_b64encode(value).rstrip(b'=').decode('ascii')
+
+
+def pkcs1_encode(alg, message, size):
+    '''The EMSA-PKCS1-v1_5 encoding of ``message`` for a ``size``-byte
+    modulus.'''
+    digest, prefix = ALGORITHMS[alg]
+    info = prefix + digest(message).digest()
+    if size < len(info) + 11:
+        raise Error('RSA key is too small')
+
+    return b'\x00\x01' + b'\xff' * (size - len(info) - 3) + b'\x00' + info
+
+
+class RSAKey:
+    '''An RSA public key from a JWK.'''
+
+    __slots__ = ('n', 'e', 'size')
+
+    def __init__(self, n, e):
+        self.n    = n
+        self.e    = e
+        self.size = (n.bit_length() + 7) // 8
+
+    @classmethod
+    def from_jwk(cls, jwk):
+        return cls(int.from_bytes(b64decode(jwk['n']), 'big'),
+                   int.from_bytes(b64decode(jwk['e']), 'big'))
+
+    def verify(self, alg, message, signature):
+        '''Whether ``signature`` is this key's ``alg`` signature of
+        ``message``.'''
+        if alg not in ALGORITHMS or len(signature) != self.size:
+            return False
+
+        s = int.from_bytes(signature, 'big')
+        if s >= self.n:
+            return False
+
+        encoded = pow(s, self.e, self.n).to_bytes(self.size, 'big')
+        return hmac.compare_digest(encoded,
+                                   pkcs1_encode(alg, message, self.size))
+
+
+class KeySet:
+    '''The signing keys of an issuer, indexed by ``kid``.
+
+    Keys are refetched once ``ttl`` seconds have passed, and sooner when a
+    token names a ``kid`` that is not known yet, which is how issuers roll
+    keys over. Those early refetches happen at most once every
+    ``refresh_interval`` seconds, so tokens with made-up ``kid`` values
+    cannot make every login call the issuer.
+
+    The key set does no I/O itself: when :meth:`needs_refresh` says so, the
+    caller fetches :attr:`url` over its transport and passes the response to
+    :meth:`load`.
+
+    :param str url: The issuer's ``jwks_uri``.
+    :param float ttl: Seconds the keys are used before being refetched.
+    :param float refresh_interval: The least seconds between refetches.
+    '''
+
+    def __init__(self, url, ttl = 3600.0, refresh_interval = 60.0):
+        self.url              = url
+        self.ttl              = ttl
+        self.refresh_interval = refresh_interval
+
+        self.keys       = {}
+        self.fetched_at = None
+        self.fetches    = 0
+
+        self._lock = threading.Lock()
+
+    def needs_refresh(self, kid, now = None):
+        '''Whether the keys should be fetched before verifying a token
+        signed with ``kid``.'''
+        if self.fetched_at is None:
+            return True
+
+        now = time.monotonic() if now is None else now
+        age = now - self.fetched_at
+        if age >= self.ttl:
+            return True
+
+        return kid not in self.keys and age >= self.refresh_interval
+
+    def load(self, resp, content, now = None):
+        '''Replace the keys with those in a ``jwks_uri`` response.
+
+        :raises socialauth.Error: If the response is not a key set.
+        '''
+        if resp.status != 200:
+            raise Error('{} from the JWKS endpoint'.format(resp.status))
+
+        try:
+            jwks = json.loads(content.decode('utf-8'))
+            keys = dict(
+                (jwk.get('kid'), RSAKey.from_jwk(jwk))
+                for jwk in jwks['keys']
+                if jwk.get('kty') == 'RSA' and jwk.get('use', 'sig') == 'sig'
+            )
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise Error('Malformed JWKS')
+
+        with self._lock:
+            self.keys       = keys
+            self.fetched_at = time.monotonic() if now is None else now
+            self.fetches   += 1
+
+    def get(self, kid):
+        '''The key for ``kid``.
+
+        :raises socialauth.Error: If no such key is known.
+        '''
+        key = self.keys.get(kid)
+        if key is None:
+            raise Error('Unknown ID token signing key')
+
+        return key
+
+
+def split_token(token):
+    '''Parse a compact JWS into ``(header, claims, message, signature)``.
+
+    Nothing is verified.
+
+    :raises socialauth.Error: If the token is malformed.
+    '''
+    try:
+        message, signature = token.encode('ascii').rsplit(b'.', 1)
+        header, claims = message.split(b'.')
+        header = json.loads(b64decode(header).decode('utf-8'))
+        claims = json.loads(b64decode(claims).decode('utf-8'))
+        signature = b64decode(signature)
+    except (ValueError, AttributeError):
+        raise Error('Malformed ID token')
+
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        raise Error('Malformed ID token')
+
+    return (header, claims, message, signature,)
+
+
+def check_claims(claims, issuer, audience, nonce = None, leeway = 60,
+                 now = None):
+    '''Validate the claims of a verified ID token.
+
+    :param str issuer: The expected ``iss``.
+    :param str audience: The client ID, which must be in ``aud``.
+    :param str nonce: The expected ``nonce``, if one was sent.
+    :param float leeway: Seconds of clock skew to tolerate.
+    :raises socialauth.Error: If a claim does not hold.
+    '''
+    if claims.get('iss') != issuer:
+        raise Error('ID token has the wrong issuer')
+
+    aud = claims.get('aud')
+    if audience != aud and (not isinstance(aud, list) or audience not in aud):
+        raise Error('ID token has the wrong audience')
+
+    if isinstance(aud, list) and len(aud) > 1 and claims.get('azp') != audience:
+        raise Error('ID token has the wrong authorized party')
+
+    now = time.time() if now is None else now
+    exp = claims.get('exp')
+    if not isinstance(exp, (int, float)) or now > exp + leeway:
+        raise Error('Expired ID token')
+
+    if nonce is not None and not hmac.compare_digest(
+            str(claims.get('nonce', '')).encode('utf-8'), nonce.encode('utf-8')):
+        raise ClientError('ID token has the wrong nonce')
+
+    if not claims.get('sub'):
+        raise Error('ID token has no subject')
+
+    return claims
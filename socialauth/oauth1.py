@@ -0,0 +1,157 @@
+'''OAuth 1.0a request signing with HMAC-SHA1 (:rfc:`5849`).
+
+Only what the Twitter flows need: the signature is computed over the URL's
+query parameters and the protocol parameters, and the signed parameters are
+returned in the query string for ``GET`` or a form body for ``POST``. No I/O
+is done here, so the result works with any transport.
+'''
+
+import base64
+import binascii
+import hmac
+import os
+import re
+import time
+from functools import lru_cache
+from hashlib import sha1
+from urllib.parse import parse_qsl, quote, urlsplit, urlunsplit
+
+
+# Characters outside the unreserved set of RFC 3986, section 2.3.
+RESERVED = re.compile('[^A-Za-z0-9._~-]')
+
+DEFAULT_PORTS = { 'http': 80, 'https': 443 }
+
+FORM_HEADERS = { 'Content-Type': 'application/x-www-form-urlencoded' }
+
+
+def escape(value):
+    '''Percent-encode ``value`` as :rfc:`5849#section-3.6` requires.
+
+    Values made only of unreserved characters, which covers keys, tokens,
+    nonces and timestamps, are returned unchanged without being copied.
+    '''
+    if RESERVED.search(value) is None:
+        return value
+
+    return quote(value, safe = '~')
+
+
+@lru_cache(maxsize = 256)
+def split_url(url):
+    '''Split ``url`` into its escaped base string URI and its decoded query
+    parameters (:rfc:`5849#section-3.4.1.2`).
+
+    Providers sign the same few endpoint URLs over and over, so the result
+    is cached.
+    '''
+    parts  = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.hostname.lower()
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = '{}:{}'.format(netloc, parts.port)
+
+    base  = urlunsplit((scheme, netloc, parts.path or '/', '', '',))
+    query = tuple(parse_qsl(parts.query, keep_blank_values = True))
+    return (escape(base), query,)
+
+
+def base_string(method, url, params):
+    '''The signature base string for a request (:rfc:`5849#section-3.4.1`).
+
+    :param str method: The HTTP method.
+    :param str url: The request URL, including any query string.
+    :param params: ``(name, value)`` pairs from the protocol parameters and
+        a form-encoded body. Query parameters are read from ``url``.
+    '''
+    escaped_url, query = split_url(url)
+    pairs = sorted(
+        (escape(name), escape(value),) for name, value in query + tuple(params)
+    )
+    # Every name and value is already escaped, so only the separators and
+    # percent signs are left to encode a second time.
+    normalized = '%26'.join(
+        name.replace('%', '%25') + '%3D' + value.replace('%', '%25')
+        for name, value in pairs
+    )
+    return '&'.join((method.upper(), escaped_url, normalized,))
+
+
+class Signer:
+    '''Signs requests for one OAuth consumer.
+
+    The consumer half of the HMAC key is escaped once, and the key for
+    requests without a token secret is kept as a ready HMAC object.
+
+    :param str consumer_key: The client identifier.
+    :param str consumer_secret: The client shared secret.
+    '''
+
+    signature_method = 'HMAC-SHA1'
+
+    def __init__(self, consumer_key, consumer_secret):
+        self.consumer_key = consumer_key
+        self.key_prefix   = (escape(consumer_secret) + '&').encode('utf-8')
+
+        self._consumer_mac = hmac.new(self.key_prefix, digestmod = sha1)
+
+    def signature(self, method, url, params, token_secret = None):
+        '''The base64 HMAC-SHA1 signature (:rfc:`5849#section-3.4.2`).
+
+        :param params: See :func:`base_string`.
+        '''
+        if token_secret:
+            key = self.key_prefix + escape(token_secret).encode('utf-8')
+            mac = hmac.new(key, digestmod = sha1)
+        else:
+            mac = self._consumer_mac.copy()
+
+        mac.update(base_string(method, url, params).encode('utf-8'))
+        return base64.b64encode(mac.digest()).decode('ascii')
+
+    def protocol_params(self, token = None, verifier = None, timestamp = None,
+                        nonce = None):
+        params = [
+            ('oauth_consumer_key',     self.consumer_key),
+            ('oauth_nonce',            nonce or new_nonce()),
+            ('oauth_signature_method', self.signature_method),
+            ('oauth_timestamp',        str(timestamp or int(time.time()))),
+            ('oauth_version',          '1.0'),
+        ]
+        if token is not None:
+            params.append(('oauth_token', token))
+        if verifier is not None:
+            params.append(('oauth_verifier', verifier))
+
+        return params
+
+    def sign(self, url, method = 'GET', token = None, token_secret = None,
+             verifier = None, timestamp = None, nonce = None):
+        '''Sign a request with no body of its own.
+
+        The protocol parameters travel in the query string for ``GET`` and
+        in a form-encoded body otherwise.
+
+        :param str token: The request or access token, if any.
+        :param str token_secret: The secret belonging to ``token``.
+        :param str verifier: The ``oauth_verifier`` from the callback.
+        :param int timestamp: Defaults to the current time.
+        :param str nonce: Defaults to a random value.
+        :return: ``(url, method, body, headers)``, ready for a transport.
+        '''
+        params = self.protocol_params(token, verifier, timestamp, nonce)
+        params.append(('oauth_signature',
+                       self.signature(method, url, params, token_secret)))
+        encoded = '&'.join(
+            escape(name) + '=' + escape(value) for name, value in params
+        )
+
+        if method == 'GET':
+            separator = '&' if '?' in url else '?'
+            return (url + separator + encoded, method, None, None,)
+
+        return (url, method, encoded, dict(FORM_HEADERS),)
+
+
+def new_nonce():
+    return binascii.hexlify(os.urandom(16)).decode('ascii')
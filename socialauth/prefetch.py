@@ -0,0 +1,202 @@
+import threading
+import time
+from collections import deque
+
+from .providers.twitter import parse_request_token
+from .transport import get_default_transport
+
+
+class RequestTokenPool:
+    '''A bounded pool of fresh Twitter request tokens, refilled in the
+    background.
+
+    ``login=start`` normally waits on a ``oauth/request_token`` round trip
+    before it can redirect. With a pool attached to a
+    :class:`~socialauth.providers.TwitterConfig`, the start of a login pops a
+    token that was fetched earlier and only calls Twitter itself when the pool
+    is empty.
+
+    Request tokens are only issued for the app's registered callback, so one
+    pool serves every login for a consumer key. Use :func:`prefetch` to get
+    the pool for a config.
+
+    :param config: A :class:`~socialauth.providers.TwitterConfig`.
+    :param transport: A :class:`~socialauth.Transport` for refills. Defaults
+        to the process-wide pooled transport.
+    :param int size: The most tokens to hold.
+    :param float ttl: Seconds a token is handed out for after it was fetched.
+    :param float min_interval: The least number of seconds between refill
+        calls, to stay clear of Twitter's rate limits.
+    :param float max_backoff: The longest wait after consecutive refill
+        failures. The wait doubles with each failure, from ``min_interval``.
+    '''
+
+    def __init__(self, config, transport = None, size = 8, ttl = 300.0,
+                 min_interval = 0.5, max_backoff = 60.0):
+        self.config       = config
+        self.transport    = transport
+        self.size         = size
+        self.ttl          = ttl
+        self.min_interval = min_interval
+        self.max_backoff  = max_backoff
+
+        self.hits    = 0
+        self.misses  = 0
+        self.expired = 0
+        self.refills = 0
+        self.errors  = 0
+
+        self._tokens    = deque()
+        self._condition = threading.Condition()
+        self._thread    = None
+        self._stopped   = False
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def pop(self):
+        '''Take the oldest fresh token.
+
+        :return: ``(oauth_token, oauth_token_secret)``, or ``None`` when the
+            pool has nothing fresh to give.
+        '''
+        now = time.monotonic()
+        with self._condition:
+            while self._tokens:
+                fetched, tokens = self._tokens.popleft()
+                if now - fetched <= self.ttl:
+                    self.hits += 1
+                    self._condition.notify()
+                    return tokens
+
+                self.expired += 1
+
+            self.misses += 1
+            self._condition.notify()
+            return None
+
+    def fill(self):
+        '''Fetch one request token from Twitter and add it to the pool.'''
+        config    = self.config
+        transport = self.transport or get_default_transport()
+        limiter   = config.rate_limiter
+        if limiter is not None:
+            # Refills never wait for a token; the pool backs off instead.
+            limiter.acquire('twitter', config.consumer_key, queue = False)
+
+        resp, content = transport.request(*config.sign(config.request_token_url,
+                                                       'GET'))
+        if limiter is not None:
+            limiter.observe('twitter', config.consumer_key, resp)
+
+        tokens = parse_request_token(resp, content)
+        with self._condition:
+            self.refills += 1
+            self._tokens.append((time.monotonic(), tokens,))
+            while len(self._tokens) > self.size:
+                self._tokens.popleft()
+
+        return tokens
+
+    def start(self):
+        '''Start refilling in a daemon thread.'''
+        with self._condition:
+            if self._thread is not None:
+                return self
+
+            self._stopped = False
+            self._thread  = threading.Thread(target = self.run,
+                                             name   = 'socialauth-prefetch',
+                                             daemon = True)
+            self._thread.start()
+
+        return self
+
+    def stop(self):
+        '''Stop the refill thread. Tokens already in the pool are kept.'''
+        with self._condition:
+            thread        = self._thread
+            self._stopped = True
+            self._thread  = None
+            self._condition.notify_all()
+
+        if thread is not None:
+            thread.join()
+
+    def run(self):
+        delay = self.min_interval
+        while True:
+            with self._condition:
+                self.discard_expired()
+                while not self._stopped and len(self._tokens) >= self.size:
+                    # Wake up in time to replace the oldest token.
+                    wait = self.ttl - (time.monotonic() - self._tokens[0][0])
+                    self._condition.wait(max(wait, self.min_interval))
+                    self.discard_expired()
+
+                if self._stopped:
+                    return
+
+            try:
+                self.fill()
+                delay = self.min_interval
+            except Exception:
+                with self._condition:
+                    self.errors += 1
+
+                delay = min(max(delay, self.min_interval) * 2, self.max_backoff)
+
+            # Pops wake the condition, so wait out the full delay.
+            deadline = time.monotonic() + delay
+            with self._condition:
+                while not self._stopped:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+
+                    self._condition.wait(remaining)
+
+    def discard_expired(self):
+        now = time.monotonic()
+        while self._tokens and now - self._tokens[0][0] > self.ttl:
+            self.expired += 1
+            self._tokens.popleft()
+
+    def stats(self):
+        '''Counters for hits, misses, expired tokens, refills and errors.'''
+        with self._condition:
+            return dict(
+                size    = len(self._tokens),
+                hits    = self.hits,
+                misses  = self.misses,
+                expired = self.expired,
+                refills = self.refills,
+                errors  = self.errors,
+            )
+
+
+_pools     = {}
+_pool_lock = threading.Lock()
+
+
+def prefetch(config, transport = None, start = True, **kwargs):
+    '''Attach the :class:`RequestTokenPool` for ``config``'s consumer key.
+
+    Configs sharing a consumer key share one pool. Remaining keyword
+    arguments are passed to :class:`RequestTokenPool` when it is created.
+
+    :param config: A :class:`~socialauth.providers.TwitterConfig`.
+    :param bool start: Whether to start the background refill thread.
+    :return: The pool.
+    '''
+    with _pool_lock:
+        pool = _pools.get(config.consumer_key)
+        if pool is None:
+            pool = _pools[config.consumer_key] = RequestTokenPool(
+                config, transport = transport, **kwargs)
+
+    config.prefetcher = pool
+    if start:
+        pool.start()
+
+    return pool
@@ -0,0 +1,152 @@
+'''The login protocol, without I/O.
+
+Each :class:`~socialauth.handlers.Handler` describes a login leg as a
+generator of steps. A step yields a :class:`Request` when the flow needs the
+provider, or a :class:`Call` for local work that may block, such as a state
+store lookup. It is sent back the outcome, and the generator finally
+returns a :class:`~socialauth.LoginResult`. The flows never touch a socket
+or a lock that may be held for long, so the same protocol code runs under
+:func:`drive` with a blocking :class:`~socialauth.Transport`, under
+:func:`async_drive` with an :class:`~socialauth.AsyncTransport`, or under
+any other driver.
+
+A driver only has to do what :func:`drive` does::
+
+    result = None
+    while True:
+        try:
+            step = steps.send(result)
+        except StopIteration as stop:
+            return stop.value               # the LoginResult
+
+        if isinstance(step, Call):
+            result = step.func(*step.args)
+        else:
+            resp, content = transport.request(*step.make())
+            result = step.parse(resp, content)
+
+The drivers here also apply the handler's rate limiter, circuit breakers,
+hedging and instrumentation around each request. :func:`async_drive` runs
+calls, and rate limiter state kept in a file, in the loop's default
+executor.
+'''
+
+from .hedge import hedged, async_hedged
+
+
+class Request:
+    '''An upstream call a flow needs made.
+
+    :param str endpoint: The endpoint name, such as ``access_token``. It
+        names the span, the circuit breaker and the hedging histogram.
+    :param make: Returns ``(uri, method[, body, headers])`` for a transport.
+        It is called once per copy sent, so hedged copies can be signed
+        afresh.
+    :param parse: Takes ``(resp, content)`` and returns the value sent back
+        into the flow, or raises :class:`socialauth.Error`.
+    :param bool throttle: Whether the call waits on the rate limiter.
+    :param bool hedge: Whether the call is safe to hedge.
+    '''
+
+    __slots__ = ('endpoint', 'make', 'parse', 'throttle', 'hedge')
+
+    def __init__(self, endpoint, make, parse, throttle = True, hedge = False):
+        self.endpoint = endpoint
+        self.make     = make
+        self.parse    = parse
+        self.throttle = throttle
+        self.hedge    = hedge
+
+    def __repr__(self):
+        return 'Request({!r})'.format(self.endpoint)
+
+
+class Call:
+    '''Local work a flow needs done that may block, ``func(*args)``.
+
+    Its return value is sent back into the flow.
+    '''
+
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __repr__(self):
+        return 'Call({!r})'.format(getattr(self.func, '__name__', self.func))
+
+
+def drive(handler, steps, transport):
+    '''Run the flow ``steps`` of ``handler`` over a blocking transport.
+
+    :return: The flow's :class:`~socialauth.LoginResult`.
+    '''
+    result = None
+    while True:
+        try:
+            step = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+        if type(step) is Call:
+            result = step.func(*step.args)
+        else:
+            result = send(handler, step, transport)
+
+
+async def async_drive(handler, steps, transport):
+    '''Coroutine counterpart of :func:`drive`, over an
+    :class:`~socialauth.AsyncTransport`.'''
+    import asyncio
+
+    result = None
+    while True:
+        try:
+            step = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+        if type(step) is Call:
+            result = await asyncio.get_event_loop().run_in_executor(
+                None, step.func, *step.args)
+        else:
+            result = await async_send(handler, step, transport)
+
+
+def send(handler, request, transport):
+    with handler.instrumentation.span(handler.name + '.' + request.endpoint):
+        if request.throttle:
+            handler.throttle()
+
+        with handler.guard(request.endpoint) as upstream:
+            if request.hedge:
+                resp, content = hedged(handler.config.hedger, handler.name,
+                                       request.endpoint, transport,
+                                       request.make)
+            else:
+                resp, content = transport.request(*request.make())
+
+            upstream.observe(resp)
+
+        handler.observe(request.endpoint, resp)
+        return request.parse(resp, content)
+
+
+async def async_send(handler, request, transport):
+    with handler.instrumentation.span(handler.name + '.' + request.endpoint):
+        if request.throttle:
+            await handler.async_throttle()
+
+        with handler.guard(request.endpoint) as upstream:
+            if request.hedge:
+                resp, content = await async_hedged(
+                    handler.config.hedger, handler.name, request.endpoint,
+                    transport, request.make)
+            else:
+                resp, content = await transport.request(*request.make())
+
+            upstream.observe(resp)
+
+        await handler.async_observe(request.endpoint, resp)
+        return request.parse(resp, content)
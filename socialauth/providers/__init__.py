@@ -1,2 +1,37 @@
-from .facebook import Facebook
-from .twitter import Twitter
+# Provider modules, and the libraries they depend on, are imported on first
+# access so a process only pays for the providers it uses.
+LAZY_ATTRIBUTES = {
+    'Facebook':        'facebook',
+    'AsyncFacebook':   'facebook',
+    'FacebookConfig':  'facebook',
+    'FacebookHandler': 'facebook',
+    'Twitter':         'twitter',
+    'AsyncTwitter':    'twitter',
+    'TwitterConfig':   'twitter',
+    'TwitterHandler':  'twitter',
+    'OIDC':            'oidc',
+    'AsyncOIDC':       'oidc',
+    'OIDCConfig':      'oidc',
+    'OIDCHandler':     'oidc',
+}
+
+__all__ = sorted(LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    from importlib import import_module
+
+    if name in ('facebook', 'oidc', 'twitter'):
+        return import_module('.' + name, __name__)
+
+    if name not in LAZY_ATTRIBUTES:
+        raise AttributeError(
+            'module {!r} has no attribute {!r}'.format(__name__, name))
+
+    value = getattr(import_module('.' + LAZY_ATTRIBUTES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(LAZY_ATTRIBUTES))
@@ -2,66 +2,141 @@ import os
 import json
 from urllib.parse import quote
 
-import httplib2
-import jwt
 from socialauth import Error
-from socialauth import InvalidUsage
+from socialauth.cache import hash_key
+from socialauth.handlers import Handler, Provider, AsyncProvider, LoginResult
+from socialauth.protocol import Request
 
 
-class Facebook:
-    def __init__(self, request_url, params, token_secret, token_cookie):
-        self.request_url  = request_url
-        self.params       = params
-        self.token_cookie = token_cookie
-        self.token_secret = token_secret
+class FacebookConfig:
+    '''Facebook app credentials and URL templates, resolved once.
 
-        self.status       = False
-        self.access_token = None
-        self.user_id      = None
-        self.user_name    = None
+    :param str client_id: The Facebook app ID.
+    :param str client_secret: The Facebook app secret.
+    :param str api_version: The Graph API version to call.
+    '''
 
-        self.client_id = os.environ.get('FACEBOOK_APP_ID', None)
-        if not self.client_id:
-            raise Error('No FACEBOOK_APP_ID environment value')
+    # The environment values from_environ reads.
+    environ_keys = ('FACEBOOK_APP_ID', 'FACEBOOK_APP_SECRET',
+                    'FACEBOOK_GRAPH_API_VERSION',)
 
-        self.client_secret = os.environ.get('FACEBOOK_APP_SECRET', None)
-        if not self.client_secret:
-            raise Error('No FACEBOOK_APP_SECRET environment value')
+    def __init__(self, client_id, client_secret, api_version = 'v2.5'):
+        self.client_id     = client_id
+        self.client_secret = client_secret
+        self.api_version   = api_version
+
+        self.dialog_url = (
+            'https://www.facebook.com/dialog/oauth?client_id={}&redirect_uri='
+        ).format(client_id)
+
+        # The redirect URI and code are filled in per request.
+        self.access_token_url = (
+            'https://graph.facebook.com/{}/oauth/access_token?'
+            'client_id={}&redirect_uri='
+        ).format(api_version, client_id)
+        self.access_token_code = '&client_secret={}&code='.format(client_secret)
+
+        self.user_information_url = (
+            'https://graph.facebook.com/me?fields=id,name&access_token='
+        )
 
-        self.api_version = os.environ.get('FACEBOOK_GRAPH_API_VERSION', 'v2.5')
+        # An optional socialauth.Instrumentation overriding the global one.
+        self.instrumentation = None
 
-        if params.get('login') == 'start':
-            self.start()
-        elif 'code' in params:
-            self.finish()
-        else:
-            raise InvalidUsage('Invalid request')
+        # Optional socialauth.CircuitBreakers for the upstream endpoints.
+        self.breakers = None
 
-    def start(self):
-        url = 'https://www.facebook.com/dialog/oauth?client_id={}&redirect_uri={}'
-        url = url.format(self.client_id, quote(self.request_url))
-        self.status = 302
-        self.redirect = url
+        # An optional socialauth.ratelimit.RateLimiter shared by the app.
+        self.rate_limiter = None
 
-    def finish(self):
-        self.get_access_token()
-        self.get_user_information()
+        # An optional socialauth.TTLCache of /me lookups by access token.
+        self.profile_cache = None
 
-        if self.user_id is not None:
-            self.status = 200
+        # An optional socialauth.hedge.Hedger for /me lookups. The code
+        # exchange is never hedged.
+        self.hedger = None
 
-    def get_access_token(self):
-        qs = 'client_id={}&redirect_uri={}&client_secret={}&code={}'
-        qs = qs.format(
-            self.client_id,
-            quote(self.request_url),
-            self.client_secret,
-            self.params.get('code'))
+        # An optional socialauth.TTLCache of recently rejected codes, so
+        # replays fail without an upstream call.
+        self.rejected_cache = None
 
-        url = 'https://graph.facebook.com/{}/oauth/access_token?{}'
-        url = url.format(self.api_version, qs)
+    @classmethod
+    def from_environ(cls, environ = None):
+        '''Read ``FACEBOOK_*`` credentials from ``environ``.
+
+        :param dict environ: Defaults to :data:`os.environ`.
+        :raises socialauth.Error: If a credential is missing.
+        '''
+        if environ is None:
+            environ = os.environ
+
+        client_id = environ.get('FACEBOOK_APP_ID', None)
+        if not client_id:
+            raise Error('No FACEBOOK_APP_ID environment value')
+
+        client_secret = environ.get('FACEBOOK_APP_SECRET', None)
+        if not client_secret:
+            raise Error('No FACEBOOK_APP_SECRET environment value')
 
-        resp, content = httplib2.Http().request(url, 'GET')
+        api_version = environ.get('FACEBOOK_GRAPH_API_VERSION', 'v2.5')
+        return cls(client_id, client_secret, api_version)
+
+
+class FacebookHandler(Handler):
+    '''A long-lived, thread-safe Facebook login handler.
+
+    See :class:`~socialauth.handlers.Handler` for the arguments.
+    '''
+
+    name         = 'facebook'
+    config_class = FacebookConfig
+
+    def start_steps(self, request_url):
+        # The redirect needs no upstream call.
+        yield from ()
+        redirect = self.config.dialog_url + quote(request_url)
+        return LoginResult(302, redirect = redirect)
+
+    def finish_steps(self, request_url, params, cookie = None):
+        code = str(params.get('code'))
+        self.check_rejected(code)
+        access_token = yield Request(
+            'access_token',
+            lambda: (self.access_token_url(request_url, code), 'GET',),
+            lambda resp, content: self.parse_access_token(resp, content, code))
+
+        user = self.cached_user_information(access_token)
+        if user is None:
+            user = yield Request(
+                'user_information',
+                lambda: self.user_information_request(access_token),
+                lambda resp, content: self.parse_user_information(
+                    access_token, resp, content),
+                hedge = True)
+
+        return LoginResult(200, user_id = user[0], user_name = user[1])
+
+    def access_token_url(self, request_url, code):
+        return ''.join((
+            self.config.access_token_url,
+            quote(request_url),
+            self.config.access_token_code,
+            str(code),
+        ))
+
+    def rejects(self, resp, content):
+        # Throttling also answers 400, with codes 4, 17 or 32. Only code 100
+        # says the code itself is invalid, expired or used.
+        try:
+            error = json.loads(content.decode('utf-8')).get('error')
+            return (resp.status == 400 and
+                    error.get('type') == 'OAuthException' and
+                    error.get('code') == 100)
+        except (ValueError, AttributeError):
+            return False
+
+    def parse_access_token(self, resp, content, code):
+        self.note_rejection(resp, content, code)
         if resp.status != 200:
             raise Error('{} from Facebook'.format(resp.status))
 
@@ -70,21 +145,45 @@ class Facebook:
         if access_token is None:
             raise Error('No access token from Facebook')
 
-        self.access_token = access_token
         return access_token
 
-    def get_user_information(self):
-        url = 'https://graph.facebook.com/me?fields=id,name&access_token={}'
-        url = url.format(self.access_token, self.access_token)
+    def user_information_request(self, access_token):
+        return (self.config.user_information_url + access_token, 'GET',)
 
-        resp, content = httplib2.Http().request(url, 'GET')
+    def parse_user_information(self, access_token, resp, content):
         if resp.status != 200:
             raise Error('{} from Facebook'.format(resp.status))
 
         res = json.loads(content.decode('utf-8'))
-        self.user_id = res.get('id', None)
-        if not self.user_id:
+        user_id = res.get('id', None)
+        if not user_id:
             raise Error('No user ID from Facebook')
 
-        self.user_name = res.get('name', None)
-        return (self.user_id, self.user_name)
+        user = (user_id, res.get('name', None),)
+        if self.config.profile_cache is not None:
+            self.config.profile_cache.set(hash_key(access_token), user)
+
+        return user
+
+    def cached_user_information(self, access_token):
+        if self.config.profile_cache is None:
+            return None
+
+        return self.config.profile_cache.get(hash_key(access_token))
+
+
+class Facebook(Provider):
+    '''A Facebook login, run as the object is built.'''
+
+    name          = 'facebook'
+    config_class  = FacebookConfig
+    handler_class = FacebookHandler
+
+
+class AsyncFacebook(AsyncProvider, Facebook):
+    '''Non-blocking :class:`Facebook` for asyncio.
+
+    Construction validates the request without any I/O. ``await``
+    :meth:`run` to perform the flow over an
+    :class:`~socialauth.AsyncTransport`.
+    '''
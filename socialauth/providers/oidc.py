@@ -0,0 +1,271 @@
+import os
+import json
+import secrets
+import threading
+from urllib.parse import urlencode
+
+from socialauth import ClientError, Error
+from socialauth.handlers import Handler, Provider, AsyncProvider, LoginResult
+from socialauth.jwks import KeySet, split_token, check_claims
+from socialauth.protocol import Request
+from socialauth.state import get_codec
+
+
+class OIDCConfig:
+    '''OpenID Connect client credentials and issuer metadata.
+
+    The issuer's endpoints and signing keys are read from its discovery
+    document on first use, then kept for the life of the config.
+
+    :param str issuer: The issuer identifier, such as
+        ``https://accounts.google.com``.
+    :param str client_id: The client ID registered with the issuer.
+    :param str client_secret: The client secret.
+    :param str scope: The scopes to request. ``profile`` adds the ``name``
+        claim to the ID token.
+    :param int state_ttl: Seconds the nonce cookie stays valid between the
+        redirect to the issuer and the callback.
+    :param float jwks_ttl: Seconds signing keys are cached.
+    :param float leeway: Seconds of clock skew tolerated on ``exp``.
+    '''
+
+    # The environment values from_environ reads.
+    environ_keys = ('OIDC_ISSUER', 'OIDC_CLIENT_ID', 'OIDC_CLIENT_SECRET',
+                    'OIDC_SCOPE',)
+
+    def __init__(self, issuer, client_id, client_secret,
+                 scope = 'openid profile', state_ttl = 900, jwks_ttl = 3600.0,
+                 leeway = 60):
+        self.issuer        = issuer
+        self.client_id     = client_id
+        self.client_secret = client_secret
+        self.scope         = scope
+        self.state_ttl     = state_ttl
+        self.jwks_ttl      = jwks_ttl
+        self.leeway        = leeway
+
+        self.discovery_url = (
+            issuer.rstrip('/') + '/.well-known/openid-configuration')
+
+        # Filled in from the discovery document.
+        self.authorization_endpoint = None
+        self.token_endpoint         = None
+        self.keys                   = None
+
+        # An optional socialauth.Instrumentation overriding the global one.
+        self.instrumentation = None
+
+        # Optional socialauth.CircuitBreakers for the upstream endpoints.
+        self.breakers = None
+
+        # An optional socialauth.ratelimit.RateLimiter shared by the app.
+        self.rate_limiter = None
+
+        # An optional socialauth.TTLCache of recently rejected codes, so
+        # replays fail without an upstream call.
+        self.rejected_cache = None
+
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_environ(cls, environ = None):
+        '''Read ``OIDC_*`` credentials from ``environ``.
+
+        :param dict environ: Defaults to :data:`os.environ`.
+        :raises socialauth.Error: If a credential is missing.
+        '''
+        if environ is None:
+            environ = os.environ
+
+        issuer = environ.get('OIDC_ISSUER', None)
+        if not issuer:
+            raise Error('No OIDC_ISSUER environment value')
+
+        client_id = environ.get('OIDC_CLIENT_ID', None)
+        if not client_id:
+            raise Error('No OIDC_CLIENT_ID environment value')
+
+        client_secret = environ.get('OIDC_CLIENT_SECRET', None)
+        if not client_secret:
+            raise Error('No OIDC_CLIENT_SECRET environment value')
+
+        scope = environ.get('OIDC_SCOPE', 'openid profile')
+        return cls(issuer, client_id, client_secret, scope)
+
+    @property
+    def discovered(self):
+        return self.keys is not None
+
+    def load_discovery(self, resp, content):
+        '''Read the endpoints and ``jwks_uri`` from a discovery response.
+
+        :raises socialauth.Error: If the document is unusable or names
+            another issuer.
+        '''
+        if resp.status != 200:
+            raise Error('{} from the OpenID discovery endpoint'.format(
+                resp.status))
+
+        try:
+            document = json.loads(content.decode('utf-8'))
+            authorization_endpoint = document['authorization_endpoint']
+            token_endpoint         = document['token_endpoint']
+            jwks_uri               = document['jwks_uri']
+            issuer                 = document['issuer']
+        except (ValueError, KeyError, TypeError):
+            raise Error('Malformed OpenID discovery document')
+
+        if issuer != self.issuer:
+            raise Error('OpenID discovery document is for another issuer')
+
+        with self._lock:
+            if self.keys is None:
+                self.authorization_endpoint = authorization_endpoint
+                self.token_endpoint         = token_endpoint
+                self.keys = KeySet(jwks_uri, ttl = self.jwks_ttl)
+
+
+class OIDCHandler(Handler):
+    '''A long-lived, thread-safe OpenID Connect login handler.
+
+    See :class:`~socialauth.handlers.Handler` for the arguments.
+    '''
+
+    name         = 'oidc'
+    config_class = OIDCConfig
+
+    def start_steps(self, request_url):
+        yield from self.discover()
+        nonce = secrets.token_urlsafe(16)
+        return LoginResult(302,
+                           set_token_cookie = self.encode_nonce(nonce),
+                           redirect         = self.authorization_url(request_url,
+                                                                     nonce))
+
+    def finish_steps(self, request_url, params, cookie = None):
+        nonce = self.decode_nonce(cookie)
+        yield from self.discover()
+
+        code = str(params.get('code'))
+        self.check_rejected(code)
+        id_token = yield Request(
+            'token',
+            lambda: self.token_request(request_url, code),
+            lambda resp, content: self.parse_id_token(resp, content, code))
+
+        header, claims, message, signature = split_token(id_token)
+        if self.config.keys.needs_refresh(header.get('kid')):
+            yield Request('jwks', self.keys_request, self.config.keys.load,
+                          throttle = False)
+
+        user_id, user_name = self.check_id_token(header, claims, message,
+                                                 signature, nonce)
+        return LoginResult(200, user_id = user_id, user_name = user_name)
+
+    def discover(self):
+        '''Steps fetching the discovery document, if it is not loaded.'''
+        if not self.config.discovered:
+            yield Request('discovery', self.discovery_request,
+                          self.config.load_discovery, throttle = False)
+
+    def discovery_request(self):
+        return (self.config.discovery_url, 'GET',)
+
+    def authorization_url(self, request_url, nonce):
+        return self.config.authorization_endpoint + '?' + urlencode((
+            ('response_type', 'code'),
+            ('client_id',     self.config.client_id),
+            ('redirect_uri',  request_url),
+            ('scope',         self.config.scope),
+            ('nonce',         nonce),
+        ))
+
+    def encode_nonce(self, nonce):
+        codec = get_codec(self.token_secret, self.config.state_ttl)
+        with self.instrumentation.span('oidc.state_encode'):
+            return codec.encode(nonce.encode('ascii'))
+
+    def decode_nonce(self, cookie):
+        if not cookie:
+            raise ClientError('No token cookie given')
+
+        codec = get_codec(self.token_secret, self.config.state_ttl)
+        try:
+            with self.instrumentation.span('oidc.state_decode'):
+                return codec.decode(cookie).decode('ascii')
+        except (Error, UnicodeDecodeError):
+            raise ClientError('Failed to retrieve nonce from token')
+
+    def token_request(self, request_url, code):
+        body = urlencode((
+            ('grant_type',    'authorization_code'),
+            ('code',          str(code)),
+            ('redirect_uri',  request_url),
+            ('client_id',     self.config.client_id),
+            ('client_secret', self.config.client_secret),
+        ))
+        headers = { 'Content-Type': 'application/x-www-form-urlencoded' }
+        return (self.config.token_endpoint, 'POST', body, headers,)
+
+    def rejects(self, resp, content):
+        try:
+            error = json.loads(content.decode('utf-8')).get('error')
+        except (ValueError, AttributeError):
+            return False
+
+        return resp.status == 400 and error == 'invalid_grant'
+
+    def parse_id_token(self, resp, content, code):
+        '''The ID token from a token response, not yet verified.'''
+        self.note_rejection(resp, content, code)
+        if resp.status != 200:
+            raise Error('{} from the OpenID token endpoint'.format(resp.status))
+
+        try:
+            id_token = json.loads(content.decode('utf-8')).get('id_token')
+        except (ValueError, AttributeError):
+            id_token = None
+
+        if not id_token:
+            raise Error('No ID token from the OpenID token endpoint')
+
+        return id_token
+
+    def keys_request(self):
+        return (self.config.keys.url, 'GET',)
+
+    def check_id_token(self, header, claims, message, signature, nonce):
+        '''Verify a split ID token, returning ``(user_id, user_name)``.'''
+        with self.instrumentation.span('oidc.verify'):
+            key = self.config.keys.get(header.get('kid'))
+            if not key.verify(header.get('alg'), message, signature):
+                raise Error('Invalid ID token signature')
+
+            check_claims(claims, self.config.issuer, self.config.client_id,
+                         nonce  = nonce,
+                         leeway = self.config.leeway)
+
+        return (str(claims['sub']), claims.get('name', None),)
+
+
+class OIDC(Provider):
+    '''A generic OpenID Connect provider using the authorization code flow.
+
+    The user is read from the ``sub`` and ``name`` claims of the ID token
+    returned by the code exchange. The token is verified locally against
+    the issuer's cached signing keys, so a login makes one upstream call
+    instead of two. The protocol work is done by an :class:`OIDCHandler`.
+    '''
+
+    name          = 'oidc'
+    config_class  = OIDCConfig
+    handler_class = OIDCHandler
+
+
+class AsyncOIDC(AsyncProvider, OIDC):
+    '''Non-blocking :class:`OIDC` for asyncio.
+
+    Construction validates the request without any I/O. ``await``
+    :meth:`run` to perform the flow over an
+    :class:`~socialauth.AsyncTransport`.
+    '''
@@ -1,80 +1,274 @@
 import os
 from urllib.parse import parse_qsl
 
-import oauth2
-import jwt
+from socialauth import ClientError, Error
+from socialauth.handlers import Handler, Provider, AsyncProvider, LoginResult
+from socialauth.oauth1 import Signer
+from socialauth.protocol import Request, Call
+from socialauth.state import KeyRing, get_codec, is_legacy_token
+from socialauth.stores import is_store_key
 
-from socialauth import Error
-from socialauth import InvalidUsage
 
+class TwitterConfig:
+    '''Twitter consumer credentials and endpoints, resolved once.
 
-class Twitter:
-    def __init__(self, request_url, params, token_secret, token_cookie):
-        self.request_url  = request_url
-        self.params       = params
-        self.token_secret = token_secret
-        self.token_cookie = token_cookie
+    :param str consumer_key: The Twitter consumer key.
+    :param str consumer_secret: The Twitter consumer secret.
+    :param int state_ttl: Seconds the token cookie stays valid between the
+        redirect to Twitter and the callback.
+    '''
 
-        self.status             = False
-        self.user_id            = None
-        self.user_name          = None
+    request_token_url = 'https://api.twitter.com/oauth/request_token'
+    access_token_url  = 'https://api.twitter.com/oauth/access_token'
+    authenticate_url  = 'https://api.twitter.com/oauth/authenticate?oauth_token='
 
-        self.set_token_cookie   = None
-        self.oauth_verifier     = params.get('oauth_verifier', None)
-        self.oauth_token        = params.get('oauth_token', None)
-        self.oauth_token_secret = None
+    # The environment values from_environ reads.
+    environ_keys = ('TWITTER_CONSUMER_KEY', 'TWITTER_CONSUMER_SECRET',)
 
-        self.consumer_key = os.environ.get('TWITTER_CONSUMER_KEY', None)
-        if not self.consumer_key:
+    def __init__(self, consumer_key, consumer_secret, state_ttl = 900):
+        self.consumer_key    = consumer_key
+        self.consumer_secret = consumer_secret
+        self.state_ttl       = state_ttl
+
+        self.signer = Signer(consumer_key, consumer_secret)
+
+        # An optional socialauth.prefetch.RequestTokenPool.
+        self.prefetcher = None
+
+        # An optional socialauth.stores.StateStore keeping oauth_token_secret
+        # on the server. The token cookie then only holds its key, and each
+        # entry is taken before the access_token exchange.
+        self.state_store = None
+
+        # An optional socialauth.Instrumentation overriding the global one.
+        self.instrumentation = None
+
+        # Optional socialauth.CircuitBreakers for the upstream endpoints.
+        self.breakers = None
+
+        # An optional socialauth.ratelimit.RateLimiter shared by the app.
+        self.rate_limiter = None
+
+        # An optional socialauth.hedge.Hedger for request_token calls. Each
+        # copy is signed with its own nonce. access_token is never hedged.
+        self.hedger = None
+
+        # An optional socialauth.TTLCache of recently rejected verifiers, so
+        # replays fail without an upstream call.
+        self.rejected_cache = None
+
+    @classmethod
+    def from_environ(cls, environ = None):
+        '''Read ``TWITTER_*`` credentials from ``environ``.
+
+        :param dict environ: Defaults to :data:`os.environ`.
+        :raises socialauth.Error: If a credential is missing.
+        '''
+        if environ is None:
+            environ = os.environ
+
+        consumer_key = environ.get('TWITTER_CONSUMER_KEY', None)
+        if not consumer_key:
             raise Error('No TWITTER_CONSUMER_KEY environment value')
 
-        self.consumer_secret = os.environ.get('TWITTER_CONSUMER_SECRET', None)
-        if not self.consumer_secret:
+        consumer_secret = environ.get('TWITTER_CONSUMER_SECRET', None)
+        if not consumer_secret:
             raise Error('No TWITTER_CONSUMER_SECRET environment value')
 
-        self.consumer = oauth2.Consumer(
-            key       = self.consumer_key,
-            secret    = self.consumer_secret)
+        return cls(consumer_key, consumer_secret)
+
+    def sign(self, url, method, token = None, token_secret = None,
+             verifier = None):
+        '''Sign a request with OAuth 1.0a.
+
+        Parameters travel in the query string for ``GET`` and in a
+        form-encoded body for ``POST``.
+
+        :return: ``(url, method, body, headers)``, ready for a transport.
+        '''
+        return self.signer.sign(url, method, token, token_secret, verifier)
+
+
+def parse_request_token(resp, content):
+    '''Read ``(oauth_token, oauth_token_secret)`` from a request_token
+    response.'''
+    if resp.status != 200:
+        raise Error('{} from Twitter'.format(resp.status))
+
+    oauth_values = dict(parse_qsl(content.decode('utf-8')))
+    oauth_token        = oauth_values.get('oauth_token')
+    oauth_token_secret = oauth_values.get('oauth_token_secret')
+    if not oauth_token or not oauth_token_secret:
+        raise Error('No oauth_token or oauth_token_secret from Twitter')
+
+    return (oauth_token, oauth_token_secret,)
+
+
+class TwitterHandler(Handler):
+    '''A long-lived, thread-safe Twitter login handler.
+
+    See :class:`~socialauth.handlers.Handler` for the arguments. The
+    callback URL is the one registered with the Twitter app, so
+    ``request_url`` is not used.
+    '''
+
+    name         = 'twitter'
+    config_class = TwitterConfig
+    credential   = 'consumer_key'
+
+    def is_callback(self, params):
+        return bool(params.get('oauth_token') and params.get('oauth_verifier'))
+
+    def start_steps(self, request_url = None):
+        tokens = self.prefetched_tokens()
+        if tokens is None:
+            tokens = yield Request('request_token',
+                                   self.request_token_request,
+                                   parse_request_token,
+                                   hedge = True)
+
+        oauth_token, oauth_token_secret = tokens
+        if self.config.state_store is None:
+            cookie = self.encode_state(oauth_token_secret)
+        else:
+            cookie = yield Call(self.encode_state, oauth_token_secret)
+
+        redirect = self.config.authenticate_url + oauth_token
+        return LoginResult(302,
+                           redirect         = redirect,
+                           set_token_cookie = cookie)
+
+    def finish_steps(self, request_url, params, cookie = None):
+        oauth_token    = params.get('oauth_token')
+        oauth_verifier = params.get('oauth_verifier')
 
-        if params.get('login') == 'start':
-            self.start()
-        elif self.oauth_verifier and self.oauth_token:
-            self.finish()
+        # Checked before the state is decoded so a rejected replay does not
+        # use up a stored entry. The cookie is part of the credential, or a
+        # replay with a bad cookie would lock out the real callback.
+        credential = (oauth_token, oauth_verifier, cookie or '',)
+        self.check_rejected(*credential)
+        if self.is_stored(cookie):
+            oauth_token_secret = yield Call(self.decode_state, cookie)
         else:
-            raise InvalidUsage('Invalid request')
+            oauth_token_secret = self.decode_state(cookie)
 
-    def start(self):
-        self.get_initial_oauth_tokens()
-        self.get_redirect_with_token()
+        user_id, user_name = yield Request(
+            'access_token',
+            lambda: self.access_token_request(oauth_token, oauth_token_secret,
+                                              oauth_verifier),
+            lambda resp, content: self.parse_access_token(
+                resp, content, *credential))
 
-    def finish(self):
-        self.decode_oauth_token_secret()
-        self.get_user_information()
+        return LoginResult(200, user_id = user_id, user_name = user_name)
 
-    def decode_oauth_token_secret(self):
-        if not self.token_cookie:
-            raise Error('No token cookie given')
+    def sign(self, url, method, token = None, token_secret = None,
+             verifier = None):
+        with self.instrumentation.span('twitter.sign'):
+            return self.config.sign(url, method, token, token_secret, verifier)
 
+    def request_token_request(self):
+        return self.sign(self.config.request_token_url, 'GET')
+
+    def prefetched_tokens(self):
+        if self.config.prefetcher is None:
+            return None
+
+        return self.config.prefetcher.pop()
+
+    def encode_state(self, oauth_token_secret):
+        '''The token cookie keeping ``oauth_token_secret`` until the
+        callback. With a state store this may block, so flows yield it as a
+        :class:`~socialauth.protocol.Call`.'''
+        payload = oauth_token_secret.encode('utf-8')
+        if self.config.state_store is not None:
+            with self.instrumentation.span('twitter.state_encode', store = True):
+                return self.config.state_store.put(payload,
+                                                   self.config.state_ttl)
+
+        codec = get_codec(self.token_secret, self.config.state_ttl)
+        with self.instrumentation.span('twitter.state_encode'):
+            return codec.encode(payload)
+
+    def decode_state(self, cookie):
+        '''The ``oauth_token_secret`` kept by :meth:`encode_state`.'''
+        if not cookie:
+            raise ClientError('No token cookie given')
+
+        if is_legacy_token(cookie):
+            return self.decode_legacy_state(cookie)
+
+        if self.is_stored(cookie):
+            return self.take_state(cookie)
+
+        codec = get_codec(self.token_secret, self.config.state_ttl)
         try:
-            payload = jwt.decode(self.token_cookie,
-                                 self.token_secret,
-                                 algorithm = 'HS256')
-        except:
-            raise Error('Failed to retrieve oauth_token_secret from token')
+            with self.instrumentation.span('twitter.state_decode'):
+                payload = codec.decode(cookie)
+        except Error:
+            raise ClientError('Failed to retrieve oauth_token_secret from token')
+
+        if not payload:
+            raise ClientError('Token does not have an oauth_token_secret')
+
+        return payload.decode('utf-8')
+
+    def is_stored(self, cookie):
+        '''Whether ``cookie`` is a key into the config's state store.'''
+        return bool(self.config.state_store is not None and cookie and
+                    not is_legacy_token(cookie) and is_store_key(cookie))
 
-        self.oauth_token_secret = payload.get('data', {}).get('id', None)
-        if not self.oauth_token_secret:
-            raise Error('Token does not have an oauth_token_secret')
+    def take_state(self, cookie):
+        with self.instrumentation.span('twitter.state_decode', store = True):
+            value = self.config.state_store.take(cookie)
 
-        return self.oauth_token_secret
+        if not value:
+            raise ClientError('Failed to retrieve oauth_token_secret from token')
 
-    def get_user_information(self):
-        token = oauth2.Token(self.oauth_token, self.oauth_token_secret)
-        token.set_verifier(self.oauth_verifier)
-        client = oauth2.Client(self.consumer, token)
+        return value.decode('utf-8')
 
-        url = 'https://api.twitter.com/oauth/access_token'
-        resp, content = client.request(url, 'POST')
+    def decode_legacy_state(self, cookie):
+        # Token cookies issued with PyJWT before StateCodec remain readable
+        # until they have all expired from browsers. PyJWT is imported for
+        # them only.
+        import jwt
+
+        # They were signed with the plain secret, which a key ring keeps
+        # under the ID None.
+        secret = self.token_secret
+        if isinstance(secret, KeyRing):
+            secret = secret.secrets.get(None, secret.secrets[secret.current])
+
+        try:
+            with self.instrumentation.span('twitter.state_decode',
+                                           legacy = True):
+                payload = jwt.decode(cookie, secret,
+                                     algorithm = 'HS256')
+        except jwt.InvalidTokenError:
+            raise ClientError('Failed to retrieve oauth_token_secret from token')
+
+        try:
+            oauth_token_secret = payload['data']['id']
+        except (KeyError, TypeError):
+            oauth_token_secret = None
+
+        if not oauth_token_secret:
+            raise ClientError('Token does not have an oauth_token_secret')
+
+        return oauth_token_secret
+
+    def access_token_request(self, oauth_token, oauth_token_secret,
+                             oauth_verifier):
+        return self.sign(self.config.access_token_url, 'POST',
+                         oauth_token, oauth_token_secret, oauth_verifier)
+
+    def rejects(self, resp, content):
+        # Twitter answers an invalid or used verifier with a 401.
+        return resp.status == 401
+
+    def parse_access_token(self, resp, content, oauth_token, oauth_verifier,
+                           cookie = ''):
+        '''Read ``(user_id, user_name)`` from an access_token response.'''
+        self.note_rejection(resp, content, oauth_token, oauth_verifier, cookie)
         if resp.status != 200:
             raise Error('{} from Twitter'.format(resp.status))
 
@@ -82,39 +276,22 @@ class Twitter:
         if 'user_id' not in provider_user:
             raise Error('No user_id from Twitter')
 
-        self.status    = 200
-        self.user_id   = provider_user.get('user_id')
-        self.user_name = provider_user.get('screen_name', None)
-        return (self.user_id, self.user_name,)
+        return (provider_user.get('user_id'),
+                provider_user.get('screen_name', None),)
 
-    def get_initial_oauth_tokens(self):
-        url = 'https://api.twitter.com/oauth/request_token'
-        client = oauth2.Client(self.consumer)
-        resp, content = client.request(url, 'GET')
-        if resp.status != 200:
-            raise Error('{} from Twitter'.format(resp.status))
 
-        oauth_values = dict(parse_qsl(content.decode('utf-8')))
-        self.oauth_token        = oauth_values.get('oauth_token')
-        self.oauth_token_secret = oauth_values.get('oauth_token_secret')
-        if not self.oauth_token or not self.oauth_token_secret:
-            raise Error('No oauth_token or oauth_token_secret from Twitter')
-
-        return (self.oauth_token, self.oauth_token_secret,)
-
-    def get_redirect_with_token(self):
-        url = 'https://api.twitter.com/oauth/authenticate?oauth_token={}'
-        url = url.format(self.oauth_token)
-
-        # Formatted by JSON API spec (jsonapi.org)
-        payload = { 'data': {
-            'type': 'oauth_token_secret',
-            'id': self.oauth_token_secret
-        } }
-
-        self.set_token_cookie = jwt.encode(payload,
-                                           self.token_secret,
-                                           algorithm = 'HS256')
-        self.status   = 302
-        self.redirect = url
-        return (self.redirect, self.set_token_cookie,)
+class Twitter(Provider):
+    '''A Twitter login, run as the object is built.'''
+
+    name          = 'twitter'
+    config_class  = TwitterConfig
+    handler_class = TwitterHandler
+
+
+class AsyncTwitter(AsyncProvider, Twitter):
+    '''Non-blocking :class:`Twitter` for asyncio.
+
+    Construction validates the request without any I/O. ``await``
+    :meth:`run` to perform the flow over an
+    :class:`~socialauth.AsyncTransport`.
+    '''
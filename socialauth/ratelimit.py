@@ -0,0 +1,324 @@
+'''Client-side rate limiting of the upstream APIs, per app.
+
+Twitter and the Graph API limit calls per consumer key or app id. A
+:class:`RateLimiter` admits calls from a token bucket per app and learns the
+real allowance from the responses, so calls over the limit are rejected, or
+queued, before they cost a round trip.
+'''
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from . import Error
+from .cache import hash_key
+from .stores import FileLock, fcntl
+
+
+class RateLimited(Error):
+    '''Raised instead of calling an upstream API that is over its limit.
+
+    :ivar float retry_after: Seconds until a call would be admitted.
+    '''
+
+    status_code = 429
+
+    def __init__(self, message, retry_after = 0.0):
+        Error.__init__(self, message)
+        self.retry_after = retry_after
+
+
+# A bucket's state: tokens, last refill, blocked until, refill scale. Times
+# are Unix time so they mean the same in every process.
+TOKENS, UPDATED, BLOCKED_UNTIL, SCALE = range(4)
+
+
+class RateLimiter:
+    '''Token buckets per provider and app key.
+
+    Each bucket holds up to ``burst`` tokens and refills at ``rate`` tokens a
+    second. A call takes one token. Responses adjust the bucket:
+
+    ``x-rate-limit-remaining`` and ``x-rate-limit-reset`` (Twitter)
+        The bucket never holds more tokens than Twitter says remain, and is
+        closed until the reset time once none do.
+
+    ``X-App-Usage`` (Facebook)
+        Refills slow down in proportion to the highest usage percentage, and
+        the bucket closes for ``cooldown`` seconds at 100%. Refills return to
+        full speed when a closed bucket reopens.
+
+    A 429 response closes the bucket for its ``Retry-After``, or
+    ``cooldown``, seconds.
+
+    :param float rate: Tokens added per second.
+    :param int burst: The most tokens a bucket holds.
+    :param bool queue: Wait for a token, up to ``max_wait`` seconds, rather
+        than raising :class:`RateLimited` straight away.
+    :param float max_wait: The longest a queued call waits.
+    :param float cooldown: Seconds to stop calling after a 429 or full app
+        usage, when the response does not say.
+    :param buckets: Where bucket state lives. Defaults to this process; pass
+        :class:`SharedBuckets` to share it between processes.
+    '''
+
+    def __init__(self, rate = 10.0, burst = 20, queue = False, max_wait = 1.0,
+                 cooldown = 60.0, buckets = None):
+        self.rate     = rate
+        self.burst    = burst
+        self.queue    = queue
+        self.max_wait = max_wait
+        self.cooldown = cooldown
+        self.buckets  = buckets if buckets is not None else LocalBuckets()
+
+        self.admitted = 0
+        self.queued   = 0
+        self.rejected = 0
+
+        self._lock = threading.Lock()
+
+    def initial(self, now):
+        return [float(self.burst), now, 0.0, 1.0]
+
+    def reserve(self, provider, key, queue = None):
+        '''Take a token for a call.
+
+        :return: Seconds the caller must wait before calling.
+        :raises RateLimited: If the call is not admitted.
+        '''
+        queue = self.queue if queue is None else queue
+        now   = time.time()
+
+        def take(state):
+            self.refill(state, now)
+            if state[BLOCKED_UNTIL] > now:
+                return (state[BLOCKED_UNTIL] - now, False,)
+
+            if state[TOKENS] >= 1.0:
+                state[TOKENS] -= 1.0
+                return (0.0, True,)
+
+            rate = self.rate * state[SCALE]
+            wait = (1.0 - state[TOKENS]) / rate if rate > 0 else self.cooldown
+            if queue and wait <= self.max_wait:
+                # Queued calls borrow from the future; later ones wait longer.
+                state[TOKENS] -= 1.0
+                return (wait, True,)
+
+            return (wait, False,)
+
+        wait, admitted = self.buckets.transact((provider, key,),
+                                               self.initial(now), take)
+        with self._lock:
+            if not admitted:
+                self.rejected += 1
+            else:
+                self.admitted += 1
+                if wait > 0:
+                    self.queued += 1
+
+        if not admitted:
+            raise RateLimited('{} rate limit reached'.format(provider), wait)
+
+        return wait
+
+    def acquire(self, provider, key, queue = None):
+        '''Block until a call for ``provider`` and ``key`` may be made.'''
+        wait = self.reserve(provider, key, queue)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def async_acquire(self, provider, key, queue = None):
+        '''Coroutine counterpart of :meth:`acquire`.'''
+        import asyncio
+
+        wait = await self.offload(self.reserve, provider, key, queue)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def offload(self, func, *args):
+        # Buckets behind a file lock may keep the event loop waiting.
+        if not self.buckets.blocking:
+            return func(*args)
+
+        import asyncio
+
+        return await asyncio.get_event_loop().run_in_executor(None, func,
+                                                              *args)
+
+    def refill(self, state, now):
+        if state[BLOCKED_UNTIL] and state[BLOCKED_UNTIL] <= now:
+            # No call is made while the bucket is closed, so no response
+            # would ever lift a zero scale. Start afresh once it reopens.
+            state[BLOCKED_UNTIL] = 0.0
+            state[SCALE]         = 1.0
+
+        elapsed = max(now - state[UPDATED], 0.0)
+        state[TOKENS]  = min(state[TOKENS] + elapsed * self.rate * state[SCALE],
+                             float(self.burst))
+        state[UPDATED] = now
+
+    def observe(self, provider, key, resp):
+        '''Learn from the headers and status of an upstream response.'''
+        remaining = number(resp.get('x-rate-limit-remaining'))
+        reset     = number(resp.get('x-rate-limit-reset'))
+        usage     = app_usage(resp.get('x-app-usage'))
+        limited   = resp.status == 429
+        if remaining is None and usage is None and not limited:
+            return
+
+        now = time.time()
+
+        def learn(state):
+            self.refill(state, now)
+            if remaining is not None:
+                state[TOKENS] = min(state[TOKENS], remaining)
+                if remaining < 1 and reset is not None:
+                    state[BLOCKED_UNTIL] = max(state[BLOCKED_UNTIL], reset)
+
+            if usage is not None:
+                state[SCALE] = max(1.0 - usage / 100.0, 0.0)
+                if usage >= 100:
+                    state[BLOCKED_UNTIL] = max(state[BLOCKED_UNTIL],
+                                               now + self.cooldown)
+
+            if limited:
+                retry_after = number(resp.get('retry-after'))
+                if retry_after is None:
+                    retry_after = self.cooldown
+
+                state[BLOCKED_UNTIL] = max(state[BLOCKED_UNTIL],
+                                           now + retry_after)
+
+        self.buckets.transact((provider, key,), self.initial(now), learn)
+
+    async def async_observe(self, provider, key, resp):
+        '''Coroutine counterpart of :meth:`observe`.'''
+        await self.offload(self.observe, provider, key, resp)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                admitted = self.admitted,
+                queued   = self.queued,
+                rejected = self.rejected,
+            )
+
+
+def number(value):
+    if value is None:
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def app_usage(value):
+    '''The highest percentage in an ``X-App-Usage`` header.'''
+    if not value:
+        return None
+
+    try:
+        usage = json.loads(value)
+        return float(max(usage.values()))
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+class LocalBuckets:
+    '''Bucket state for this process only.'''
+
+    # Whether transact may wait on another process.
+    blocking = False
+
+    def __init__(self):
+        self.states = {}
+        self._lock  = threading.Lock()
+
+    def transact(self, key, initial, func):
+        '''Call ``func`` with the mutable state of bucket ``key`` under a
+        lock and return its result.'''
+        with self._lock:
+            state = self.states.get(key)
+            if state is None:
+                state = self.states[key] = initial
+
+            return func(state)
+
+
+SHARED_MAGIC  = b'SARATE01'
+SHARED_HEADER = struct.Struct('>8sI')
+SHARED_SLOT   = struct.Struct('>32sdddd')
+
+
+class SharedBuckets:
+    '''Bucket state in a memory-mapped file, shared by every process on a
+    host that opens it, including workers forked after it was built.
+    Writers take an exclusive :func:`fcntl.flock`.
+
+    :param str path: The file, created if missing.
+    :param int slots: The most buckets held.
+    :raises socialauth.Error: If ``path`` was created with another size.
+    '''
+
+    blocking = True
+
+    def __init__(self, path, slots = 64):
+        if fcntl is None:  # pragma: no cover
+            raise Error('SharedBuckets needs fcntl')
+
+        self.slots = slots
+        size = SHARED_HEADER.size + slots * SHARED_SLOT.size
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self.fd).st_size == 0:
+                    os.ftruncate(self.fd, size)
+                    os.pwrite(self.fd, SHARED_HEADER.pack(SHARED_MAGIC, slots), 0)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+            header = SHARED_HEADER.unpack(
+                os.pread(self.fd, SHARED_HEADER.size, 0))
+            if header != (SHARED_MAGIC, slots,):
+                raise Error('Rate limit file was created with another size')
+
+            self.map = mmap.mmap(self.fd, size)
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+        self.file_lock = FileLock(path)
+
+    def transact(self, key, initial, func):
+        digest = hash_key(*key)
+        home   = int.from_bytes(digest[:8], 'big') % self.slots
+        with self.file_lock:
+            for probe in range(self.slots):
+                offset = (SHARED_HEADER.size +
+                          ((home + probe) % self.slots) * SHARED_SLOT.size)
+                stored, *state = SHARED_SLOT.unpack_from(self.map, offset)
+                if stored == digest:
+                    break
+
+                if stored == bytes(32):
+                    state = initial
+                    break
+            else:
+                raise Error('Rate limit file is full')
+
+            result = func(state)
+            SHARED_SLOT.pack_into(self.map, offset, digest, *state)
+            return result
+
+    def close(self):
+        self.file_lock.close()
+        self.map.close()
+        os.close(self.fd)
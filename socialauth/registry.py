@@ -0,0 +1,148 @@
+from . import InvalidUsage
+from .authentication import (
+    DEFAULT_PROVIDERS, validate_provider, handler_class, returning_user
+)
+from .batch import http_get_provider_many
+from .singleflight import callback_key
+
+
+class ProviderRegistry:
+    '''Providers resolved and configured once, typically at startup.
+
+    Credentials, consumers and URL templates are all prepared when the
+    registry is built, so each request is a dict lookup followed by the
+    protocol work. Missing credentials raise immediately
+    rather than on the first login.
+
+    :param providers: Names of the providers to enable. Defaults to Twitter
+        and Facebook.
+    :param dict environ: Where to read credentials from. Defaults to
+        :data:`os.environ`.
+    :param transport: A :class:`~socialauth.Transport` for synchronous calls.
+        Defaults to the process-wide pooled transport.
+    :param async_transport: An :class:`~socialauth.AsyncTransport` for
+        coroutine calls. Defaults to the running event loop's transport.
+    :param singleflight: A :class:`~socialauth.SingleFlight` coalescing
+        duplicate callbacks, such as a browser hitting the callback twice.
+    :param async_singleflight: An :class:`~socialauth.AsyncSingleFlight`
+        doing the same for coroutine calls.
+    :raises socialauth.Error: If credentials for a provider are missing.
+    :raises socialauth.InvalidUsage: If a provider is not supported.
+    '''
+
+    def __init__(self, providers = None, environ = None, transport = None,
+                 async_transport = None, singleflight = None,
+                 async_singleflight = None):
+        self.transport          = transport
+        self.async_transport    = async_transport
+        self.singleflight       = singleflight
+        self.async_singleflight = async_singleflight
+        self.entries            = {}
+        self.handlers           = {}
+
+        for name in providers or DEFAULT_PROVIDERS:
+            if not validate_provider(name):
+                raise InvalidUsage('Provider not supported')
+
+            klass = handler_class(name)
+            self.entries[name] = klass.config_class.from_environ(environ)
+
+    def configure(self, **options):
+        '''Set attributes such as ``instrumentation`` or ``breakers`` on
+        every provider config that has them.'''
+        for config in self.entries.values():
+            for name, value in options.items():
+                if hasattr(config, name):
+                    setattr(config, name, value)
+
+        return self
+
+    def __contains__(self, provider):
+        return provider in self.entries
+
+    def __getitem__(self, provider):
+        '''The configuration object for ``provider``.'''
+        return self.lookup(provider)
+
+    def lookup(self, provider):
+        try:
+            return self.entries[provider]
+        except KeyError:
+            raise InvalidUsage('Provider not supported')
+
+    def handler(self, provider, token_secret):
+        '''The long-lived :class:`~socialauth.handlers.Handler` for
+        ``provider``, built on first use for each ``token_secret``.'''
+        key     = (provider, token_secret,)
+        handler = self.handlers.get(key)
+        if handler is None:
+            config  = self.lookup(provider)
+            handler = self.handlers.setdefault(key, handler_class(provider)(
+                token_secret,
+                config          = config,
+                transport       = self.transport,
+                async_transport = self.async_transport))
+
+        return handler
+
+    def http_get_provider(self, provider,
+                          request_url, params, token_secret, token_cookie = None,
+                          sessions = None, session_token = None):
+        '''Same as :func:`socialauth.http_get_provider`, using the
+        preconfigured providers.'''
+        handler = self.handler(provider, token_secret)
+
+        result = returning_user(provider, params, token_cookie, sessions,
+                                session_token)
+        if result is not None:
+            return result
+
+        def get_provider():
+            return handler.handle(request_url, params, token_cookie,
+                                  transport = self.transport).to_dict()
+
+        key = None
+        if self.singleflight is not None:
+            key = callback_key(provider, params, token_cookie)
+
+        if key is None:
+            return get_provider()
+
+        return self.singleflight.do(key, get_provider)
+
+    def http_get_provider_many(self, requests, token_secret, concurrency = 8,
+                               deadline = None):
+        '''Same as :func:`socialauth.http_get_provider_many`, using the
+        preconfigured providers.'''
+        return http_get_provider_many(requests, token_secret,
+                                      concurrency = concurrency,
+                                      deadline    = deadline,
+                                      registry    = self)
+
+    async def async_http_get_provider(self, provider,
+                                      request_url, params, token_secret,
+                                      token_cookie = None, sessions = None,
+                                      session_token = None):
+        '''Same as :func:`socialauth.async_http_get_provider`, using the
+        preconfigured providers.'''
+        handler = self.handler(provider, token_secret)
+
+        result = returning_user(provider, params, token_cookie, sessions,
+                                session_token)
+        if result is not None:
+            return result
+
+        async def get_provider():
+            result = await handler.async_handle(
+                request_url, params, token_cookie,
+                transport = self.async_transport)
+            return result.to_dict()
+
+        key = None
+        if self.async_singleflight is not None:
+            key = callback_key(provider, params, token_cookie)
+
+        if key is None:
+            return await get_provider()
+
+        return await self.async_singleflight.do(key, get_provider)
@@ -0,0 +1,167 @@
+'''Session tokens, and the fast path for users who already have one.
+
+A signed-in browser that starts another login, say after its tab was
+restored, would normally be sent through the provider again: a Twitter
+request token, a redirect and the callback's upstream calls. With
+:class:`Sessions` passed to :func:`~socialauth.http_get_provider`, a
+``login=start`` carrying a valid session for the same provider is answered
+at once from the token, at the cost of one HMAC.
+'''
+
+import json
+import threading
+import time
+
+from . import Error
+from .state import get_codec
+
+
+# The type tag of a session payload.
+SESSION = 'session'
+
+
+class Sessions:
+    '''Issues and verifies session tokens.
+
+    A session token is a :class:`~socialauth.StateCodec` token holding the
+    provider, tenant, user and the time the user last signed in with the
+    provider. It is tagged as a session, since state tokens may be signed
+    with the same secret. Returning users are only let through while their
+    session passes every check:
+
+    * the signature is valid and the token has not expired (``ttl``);
+    * it names the provider and tenant being signed in with;
+    * the provider sign-in was at most ``max_age`` seconds ago, and after
+      ``not_before``;
+    * ``revoked(session)`` is false.
+
+    Tokens failing a check are ignored and the login proceeds as usual.
+
+    :param secret: Signs the tokens, as ``str``, ``bytes`` or a
+        :class:`~socialauth.KeyRing`.
+    :param int ttl: Seconds a token stays valid after it is issued.
+    :param float max_age: Seconds after a provider sign-in during which the
+        fast path may be taken. ``None`` allows the whole ``ttl``. Reissued
+        tokens keep the original sign-in time, so the provider is visited
+        again at least this often.
+    :param float not_before: Unix time before which sign-ins are not
+        trusted, for instance the time a breach was contained.
+    :param revoked: A callable given the session dict, returning ``True``
+        if it must not be trusted, for instance by looking the user up in a
+        deny list.
+    '''
+
+    def __init__(self, secret, ttl = 30 * 24 * 60 * 60, max_age = None,
+                 not_before = None, revoked = None):
+        self.ttl        = ttl
+        self.max_age    = max_age
+        self.not_before = not_before
+        self.revoked    = revoked
+        self.codec      = get_codec(secret, ttl)
+
+        self.returning = 0
+        self.rejected  = 0
+
+        self._lock = threading.Lock()
+
+    def encode(self, provider, user_id, user_name = None, auth_time = None,
+               now = None, tenant = None):
+        '''Issue a session token.
+
+        :param float auth_time: When the user signed in with the provider.
+            Defaults to ``now``.
+        :param tenant: The tenant the user signed in with, if any.
+        '''
+        if now is None:
+            now = time.time()
+
+        payload = dict(
+            type      = SESSION,
+            provider  = provider,
+            tenant    = tenant,
+            user_id   = user_id,
+            user_name = user_name,
+            auth_time = int(now if auth_time is None else auth_time),
+        )
+        return self.codec.encode(json.dumps(payload).encode('utf-8'), now)
+
+    def encode_result(self, provider, result, tenant = None):
+        '''Issue a session token for a :func:`~socialauth.http_get_provider`
+        result.'''
+        return self.encode(provider,
+                           result['provider_user_id'],
+                           result.get('provider_user_name'),
+                           result.get('auth_time'),
+                           tenant = tenant)
+
+    def decode(self, token, now = None):
+        '''The session in ``token``, or ``None`` if it is missing, forged,
+        expired or not a session token. No other check is made.'''
+        if not token:
+            return None
+
+        try:
+            session = json.loads(self.codec.decode(token, now).decode('utf-8'))
+        except (Error, ValueError):
+            return None
+
+        if not isinstance(session, dict) or session.pop('type', None) != SESSION:
+            return None
+
+        if not session.get('user_id'):
+            return None
+
+        return session
+
+    def verify(self, token, provider, now = None, tenant = None):
+        '''The session in ``token`` if it passes every check for a sign-in
+        with ``provider`` for ``tenant``, otherwise ``None``.'''
+        if now is None:
+            now = time.time()
+
+        session = self.decode(token, now)
+        if session is None or session.get('provider') != provider:
+            return None
+
+        # Provider user IDs may be scoped to the tenant's app.
+        if session.get('tenant') != tenant:
+            return None
+
+        auth_time = session.get('auth_time') or 0
+        if self.max_age is not None and now - auth_time > self.max_age:
+            return None
+
+        if self.not_before is not None and auth_time < self.not_before:
+            return None
+
+        if self.revoked is not None and self.revoked(session):
+            return None
+
+        return session
+
+    def returning_user(self, provider, params, token, tenant = None):
+        '''The result of a ``login=start`` answered from a valid session, or
+        ``None`` if the login has to go to the provider.'''
+        if params.get('login') != 'start' or not token:
+            return None
+
+        session = self.verify(token, provider, tenant = tenant)
+        with self._lock:
+            if session is None:
+                self.rejected += 1
+                return None
+
+            self.returning += 1
+
+        result = dict(status           = 200,
+                      provider_user_id = session['user_id'],
+                      auth_time        = session.get('auth_time'),
+                      returning        = True)
+        if session.get('user_name') is not None:
+            result['provider_user_name'] = session['user_name']
+
+        return result
+
+    def stats(self):
+        with self._lock:
+            return dict(returning = self.returning, rejected = self.rejected)
@@ -0,0 +1,151 @@
+import threading
+
+from . import Error
+from .cache import TTLCache, hash_key
+
+
+MISSING = object()
+
+
+class Interrupted(Error):
+    '''The call a waiter depended on was cancelled or interrupted.'''
+
+
+class Call:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event  = threading.Event()
+        self.result = None
+        self.error  = None
+
+
+class SingleFlight:
+    '''Runs one call per key at a time and shares its outcome.
+
+    Callers arriving while a call for their key is in flight wait for it and
+    receive its result, or its exception. The outcome is then remembered for
+    ``ttl`` seconds, so a duplicate arriving just after the first finished
+    gets the same answer without repeating the work.
+
+    :param float ttl: Seconds a finished outcome is reused.
+    :param int maxsize: The most finished outcomes to remember.
+    '''
+
+    def __init__(self, ttl = 10.0, maxsize = 4096):
+        self.results  = TTLCache(maxsize = maxsize, ttl = ttl)
+        self.inflight = {}
+        self.shared   = 0
+
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        '''Return ``func()``, or the outcome of an identical call.'''
+        with self._lock:
+            outcome = self.results.get(key, MISSING)
+            if outcome is MISSING:
+                call   = self.inflight.get(key)
+                leader = call is None
+                if leader:
+                    call = self.inflight[key] = Call()
+            else:
+                self.shared += 1
+
+        if outcome is not MISSING:
+            return unwrap(outcome)
+
+        if not leader:
+            call.event.wait()
+            with self._lock:
+                self.shared += 1
+
+            return unwrap((call.result, call.error,))
+
+        # Waiters see this if the call is interrupted by a BaseException.
+        call.error = Interrupted('Coalesced call was interrupted')
+        try:
+            call.result = func()
+            call.error  = None
+        except Exception as e:
+            call.error = e
+        finally:
+            with self._lock:
+                del self.inflight[key]
+                if not isinstance(call.error, Interrupted):
+                    self.results.set(key, (call.result, call.error,))
+
+            call.event.set()
+
+        return unwrap((call.result, call.error,))
+
+
+class AsyncSingleFlight:
+    '''The asyncio counterpart of :class:`SingleFlight`.
+
+    Use one per event loop.
+    '''
+
+    def __init__(self, ttl = 10.0, maxsize = 4096):
+        self.results  = TTLCache(maxsize = maxsize, ttl = ttl)
+        self.inflight = {}
+        self.shared   = 0
+
+    async def do(self, key, func):
+        '''Return ``await func()``, or the outcome of an identical call.'''
+        import asyncio
+
+        outcome = self.results.get(key, MISSING)
+        if outcome is not MISSING:
+            self.shared += 1
+            return unwrap(outcome)
+
+        future = self.inflight.get(key)
+        if future is not None:
+            self.shared += 1
+            return unwrap(await asyncio.shield(future))
+
+        future  = self.inflight[key] = asyncio.get_event_loop().create_future()
+        outcome = (None, Interrupted('Coalesced call was interrupted'),)
+        try:
+            outcome = (await func(), None,)
+        except Exception as e:
+            outcome = (None, e,)
+        finally:
+            del self.inflight[key]
+            if not isinstance(outcome[1], Interrupted):
+                self.results.set(key, outcome)
+
+            future.set_result(outcome)
+
+        return unwrap(outcome)
+
+
+def unwrap(outcome):
+    result, error = outcome
+    if error is not None:
+        raise error
+
+    # Callers get their own copy of a result dict.
+    return dict(result) if isinstance(result, dict) else result
+
+
+def callback_key(provider, params, token_cookie = None):
+    '''The single-flight key for a provider callback, or ``None`` when the
+    request is not a callback and must not be coalesced.
+
+    The key covers ``token_cookie``, so an outcome is only shared with
+    callers presenting the same state cookie: a duplicate without the
+    victim's cookie must not skip its check, nor poison the real callback.
+    '''
+    if params.get('login') == 'start':
+        return None
+
+    cookie = token_cookie or ''
+    if provider in ('facebook', 'oidc') and params.get('code'):
+        return (provider, hash_key(params['code'], cookie),)
+
+    if params.get('oauth_token') and params.get('oauth_verifier'):
+        return (provider, hash_key(params['oauth_token'],
+                                   params['oauth_verifier'], cookie),)
+
+    return None
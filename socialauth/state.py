@@ -0,0 +1,336 @@
+import base64
+import hashlib
+import hmac
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from . import Error
+
+
+HEADER        = struct.Struct('>BI')
+VERSION       = 1
+KEYED_VERSION = 2
+MAC_SIZE      = 16
+
+
+class StateCodec:
+    '''Compact signed tokens for short-lived flow state.
+
+    A token is the URL-safe base64 encoding, without padding, of::
+
+        version (1 byte) | expiry (4 bytes, Unix time) | payload | MAC (16 bytes)
+
+    The MAC is HMAC-SHA256 truncated to 128 bits. The keyed HMAC state is
+    computed once per codec and copied for each token, so encoding and
+    decoding only hash the token itself.
+
+    A codec with a ``kid`` writes version 2 tokens, which name the key
+    after the expiry (1 byte of length, then the ``kid``) so a
+    :class:`KeyRing` can find it without trying each secret.
+
+    :param secret: The signing secret, as ``str`` or ``bytes``.
+    :param int ttl: Seconds a token stays valid after it is encoded.
+    :param str kid: The key ID to write into tokens, up to 255 ASCII
+        characters.
+    '''
+
+    def __init__(self, secret, ttl = 900, kid = None):
+        if isinstance(secret, str):
+            secret = secret.encode('utf-8')
+
+        self.ttl  = ttl
+        self.kid  = kid
+        self._mac = hmac.new(secret, digestmod = hashlib.sha256)
+
+        self._kid_field = b''
+        if kid is not None:
+            kid = kid.encode('ascii')
+            self._kid_field = bytes((len(kid),)) + kid
+
+    def sign(self, message):
+        mac = self._mac.copy()
+        mac.update(message)
+        return mac.digest()[:MAC_SIZE]
+
+    def encode(self, payload, now = None):
+        '''Sign ``payload`` (``bytes``) into a token string.'''
+        if now is None:
+            now = time.time()
+
+        if self.kid is None:
+            message = HEADER.pack(VERSION, int(now) + self.ttl) + payload
+        else:
+            message = (HEADER.pack(KEYED_VERSION, int(now) + self.ttl) +
+                       self._kid_field + payload)
+
+        token = base64.urlsafe_b64encode(message + self.sign(message))
+        return token.rstrip(b'=').decode('ascii')
+
+    def decode(self, token, now = None):
+        '''Verify ``token`` and return its payload as ``bytes``.
+
+        :raises socialauth.Error: If the token is malformed, was not signed
+            with this secret, or has expired.
+        '''
+        message, mac = split_token(token)
+        return self.verify(message, mac, now)
+
+    def verify(self, message, mac, now = None):
+        '''Check the ``mac`` and expiry of a split token and return its
+        payload.'''
+        if not hmac.compare_digest(self.sign(message), mac):
+            raise Error('Invalid state token signature')
+
+        version, expires = HEADER.unpack_from(message)
+        offset = HEADER.size
+        if version == KEYED_VERSION:
+            offset += 1 + message[offset]
+        elif version != VERSION:
+            raise Error('Unsupported state token version')
+
+        if now is None:
+            now = time.time()
+
+        if now > expires:
+            raise Error('Expired state token')
+
+        return message[offset:]
+
+
+def split_token(token):
+    '''Split a token into its signed message and MAC, unverified.
+
+    :raises socialauth.Error: If the token is malformed.
+    '''
+    if isinstance(token, str):
+        token = token.encode('ascii', 'replace')
+
+    try:
+        raw = base64.urlsafe_b64decode(token + b'=' * (-len(token) % 4))
+    except ValueError:
+        raise Error('Malformed state token')
+
+    if len(raw) < HEADER.size + MAC_SIZE:
+        raise Error('Malformed state token')
+
+    message = raw[:-MAC_SIZE]
+    if message[0] == KEYED_VERSION and (
+            len(message) <= HEADER.size or
+            len(message) < HEADER.size + 1 + message[HEADER.size]):
+        raise Error('Malformed state token')
+
+    return (message, raw[-MAC_SIZE:],)
+
+
+def token_kid(message):
+    '''The key ID named in a split token, or ``None`` for version 1.'''
+    if message[0] != KEYED_VERSION:
+        return None
+
+    size = message[HEADER.size]
+    return message[HEADER.size + 1:HEADER.size + 1 + size].decode(
+        'ascii', 'replace')
+
+
+class KeyRing:
+    '''State and session token secrets, indexed by key ID.
+
+    Tokens are signed with the current key and name it in their header, so
+    verifying one is a dict lookup and a single HMAC, however many keys the
+    ring holds. Pass a key ring wherever a token secret is taken, such as
+    :func:`socialauth.http_get_provider` or :class:`socialauth.Sessions`.
+
+    :meth:`rotate` adds a new current key and schedules the previous one to
+    retire after ``window`` seconds, so tokens already in flight still
+    verify. Set ``window`` to at least the longest token lifetime signed
+    with the ring: the state TTL, or the session TTL when sessions share it.
+
+    A key under the ID ``None`` verifies version 1 tokens and the PyJWT
+    cookies of earlier versions, which carry no key ID. Put the old plain
+    secret there when moving to a ring.
+
+    :param dict keys: Secrets by key ID, as ``str`` or ``bytes``.
+    :param str current: The ID of the key to sign with. Defaults to the
+        last key in ``keys``.
+    :param float window: Seconds a key keeps verifying after rotation.
+    :raises socialauth.Error: If ``current`` is not in ``keys``.
+    '''
+
+    def __init__(self, keys, current = None, window = 3600):
+        self.window    = window
+        self.secrets   = {}
+        self.retire_at = {}
+        self.current   = None
+
+        self._verifiers = {}
+        self._signers   = {}
+        self._codecs    = {}
+        self._lock      = threading.Lock()
+
+        if not keys:
+            raise Error('No state token keys')
+
+        for kid, secret in keys.items():
+            self.add(kid, secret)
+
+        if current is None:
+            current = list(keys)[-1]
+
+        self.use(current)
+
+    def add(self, kid, secret):
+        '''Add a key that verifies tokens but does not sign them yet.'''
+        with self._lock:
+            secrets = dict(self.secrets)
+            secrets[kid] = secret
+            verifiers = dict(self._verifiers)
+            verifiers[kid] = StateCodec(secret, kid = kid)
+            self.secrets, self._verifiers = secrets, verifiers
+
+    def use(self, kid):
+        '''Sign new tokens with the key ``kid``.'''
+        if kid is None or kid not in self.secrets:
+            raise Error('No state token key {!r}'.format(kid))
+
+        with self._lock:
+            self.current  = kid
+            self._signers = {}
+
+    def retire(self, kid, at = None):
+        '''Stop verifying tokens signed with ``kid`` after the Unix time
+        ``at``, by default once ``window`` seconds have passed.'''
+        if at is None:
+            at = time.time() + self.window
+
+        with self._lock:
+            retire_at = dict(self.retire_at)
+            retire_at[kid] = at
+            self.retire_at = retire_at
+
+    def rotate(self, kid, secret, now = None):
+        '''Sign with a new key from now on, retiring the current one after
+        ``window`` seconds. Keys already past retirement are dropped.'''
+        if now is None:
+            now = time.time()
+
+        previous = self.current
+        self.add(kid, secret)
+        self.use(kid)
+        self.retire(previous, now + self.window)
+        self.prune(now)
+
+    def prune(self, now = None):
+        '''Drop keys past their retirement.'''
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            expired = [kid for kid, at in self.retire_at.items()
+                       if now > at and kid != self.current]
+            if not expired:
+                return
+
+            secrets, verifiers, retire_at = (
+                dict(self.secrets), dict(self._verifiers), dict(self.retire_at))
+            for kid in expired:
+                secrets.pop(kid, None)
+                verifiers.pop(kid, None)
+                retire_at.pop(kid)
+
+            self.secrets, self._verifiers, self.retire_at = (
+                secrets, verifiers, retire_at)
+
+    def codec(self, ttl = 900):
+        '''A codec signing with the current key, whichever it is at the
+        time, for ``ttl`` seconds and verifying with every live key.'''
+        codec = self._codecs.get(ttl)
+        if codec is None:
+            with self._lock:
+                codec = self._codecs.setdefault(ttl, KeyRingCodec(self, ttl))
+
+        return codec
+
+    def encode(self, payload, now = None, ttl = 900):
+        '''Sign ``payload`` with the current key.'''
+        signer = self._signers.get(ttl)
+        if signer is None:
+            with self._lock:
+                signer = self._signers.setdefault(ttl, StateCodec(
+                    self.secrets[self.current], ttl, kid = self.current))
+
+        return signer.encode(payload, now)
+
+    def decode(self, token, now = None):
+        '''Verify ``token`` with the key it names and return its payload.
+
+        :raises socialauth.Error: If the key is unknown or retired, or the
+            token is invalid.
+        '''
+        if now is None:
+            now = time.time()
+
+        message, mac = split_token(token)
+        kid      = token_kid(message)
+        verifier = self._verifiers.get(kid)
+        if verifier is None:
+            raise Error('Unknown state token key')
+
+        retire_at = self.retire_at.get(kid)
+        if retire_at is not None and now > retire_at:
+            raise Error('Retired state token key')
+
+        return verifier.verify(message, mac, now)
+
+
+class KeyRingCodec:
+    '''The :class:`StateCodec` interface over a :class:`KeyRing`.'''
+
+    def __init__(self, ring, ttl):
+        self.ring = ring
+        self.ttl  = ttl
+
+    def encode(self, payload, now = None):
+        return self.ring.encode(payload, now, self.ttl)
+
+    def decode(self, token, now = None):
+        return self.ring.decode(token, now)
+
+
+# One codec per token secret, so a worker serving many tenants keeps one
+# each for the recently active ones.
+CODEC_CACHE_SIZE = 4096
+
+_codecs     = OrderedDict()
+_codec_lock = threading.Lock()
+
+
+def get_codec(secret, ttl = 900):
+    '''Return a cached :class:`StateCodec` for ``secret`` and ``ttl``, or
+    the codec of a :class:`KeyRing`.'''
+    if isinstance(secret, KeyRing):
+        return secret.codec(ttl)
+
+    key = (secret, ttl,)
+    with _codec_lock:
+        codec = _codecs.get(key)
+        if codec is not None:
+            _codecs.move_to_end(key)
+            return codec
+
+    codec = StateCodec(secret, ttl)
+    with _codec_lock:
+        _codecs[key] = codec
+        while len(_codecs) > CODEC_CACHE_SIZE:
+            _codecs.popitem(last = False)
+
+    return codec
+
+
+def is_legacy_token(token):
+    '''Whether ``token`` is a PyJWT token from before :class:`StateCodec`.'''
+    if isinstance(token, bytes):
+        return b'.' in token
+
+    return '.' in token
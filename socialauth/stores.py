@@ -0,0 +1,353 @@
+'''Server-side storage for the Twitter ``oauth_token_secret``.
+
+With a store on :class:`~socialauth.providers.TwitterConfig`, the token
+cookie only carries a random key. The secret stays on the server and is
+removed the first time it is read.
+'''
+
+import base64
+import mmap
+import os
+import secrets
+import sqlite3
+import struct
+import threading
+import time
+
+from . import Error
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+KEY_BYTES  = 16
+KEY_LENGTH = 22
+
+
+def new_key():
+    '''A random, URL-safe key of :data:`KEY_LENGTH` characters.'''
+    return secrets.token_urlsafe(KEY_BYTES)
+
+
+def is_store_key(token):
+    '''Whether ``token`` has the shape of a store key.
+
+    Keys are shorter than any :class:`~socialauth.StateCodec` token, so the
+    two kinds of cookie can be told apart while migrating.
+    '''
+    return len(token) <= KEY_LENGTH
+
+
+class StateStore:
+    '''The interface of a state store.
+
+    Values are ``bytes``. Implementations must be safe to use from several
+    threads.
+    '''
+
+    def put(self, value, ttl):
+        '''Keep ``value`` for ``ttl`` seconds and return its key.'''
+        raise NotImplementedError
+
+    def take(self, key):
+        '''Remove and return the value for ``key``, or ``None`` if it is
+        unknown or expired.'''
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryStore(StateStore):
+    '''Keeps values in a dict within this process.
+
+    Expiry is driven by a timing wheel: every entry is filed in the slot of
+    the tick it expires on, and each call sweeps only the slots whose ticks
+    have passed since the last one. The cost is proportional to what
+    expired, not to the number of entries.
+
+    :param float resolution: Seconds per tick.
+    :param int wheel_size: The number of slots. Entries living longer than
+        ``resolution * wheel_size`` are skipped until their turn comes round.
+    '''
+
+    def __init__(self, resolution = 1.0, wheel_size = 1024):
+        self.resolution = resolution
+        self.wheel      = [set() for _ in range(wheel_size)]
+        self.entries    = {}
+        self.tick       = self.tick_of(time.monotonic())
+
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def tick_of(self, moment):
+        return int(moment / self.resolution)
+
+    def slot(self, expires):
+        # The first tick starting after the entry expires.
+        return self.wheel[(self.tick_of(expires) + 1) % len(self.wheel)]
+
+    def put(self, value, ttl):
+        key     = new_key()
+        now     = time.monotonic()
+        expires = now + ttl
+        with self._lock:
+            self.advance(now)
+            self.entries[key] = (expires, value,)
+            self.slot(expires).add(key)
+
+        return key
+
+    def take(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self.advance(now)
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+
+            self.slot(entry[0]).discard(key)
+
+        if entry[0] <= now:
+            return None
+
+        return entry[1]
+
+    def advance(self, now):
+        tick  = self.tick_of(now)
+        ticks = min(tick - self.tick, len(self.wheel))
+        for offset in range(1, ticks + 1):
+            bucket  = self.wheel[(self.tick + offset) % len(self.wheel)]
+            expired = [key for key in bucket if self.entries[key][0] <= now]
+            for key in expired:
+                bucket.discard(key)
+                del self.entries[key]
+
+        self.tick = tick
+
+
+class SQLiteStore(StateStore):
+    '''Keeps values in a SQLite database.
+
+    A database file can be shared by every process on a host.
+
+    :param str path: The database file, or ``':memory:'``.
+    :param float purge_interval: Seconds between deleting expired rows.
+    '''
+
+    def __init__(self, path = ':memory:', purge_interval = 60.0):
+        self.purge_interval = purge_interval
+        self.purged_at      = 0.0
+
+        self.connection = sqlite3.connect(path, timeout = 5.0,
+                                          isolation_level = None,
+                                          check_same_thread = False)
+        if path != ':memory:':
+            self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS socialauth_state ('
+            'key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)')
+
+        self._lock = threading.Lock()
+
+    def put(self, value, ttl):
+        key = new_key()
+        now = time.time()
+        with self._lock:
+            self.connection.execute(
+                'INSERT INTO socialauth_state VALUES (?, ?, ?)',
+                (key, value, now + ttl,))
+            if now - self.purged_at >= self.purge_interval:
+                self.purged_at = now
+                self.connection.execute(
+                    'DELETE FROM socialauth_state WHERE expires <= ?', (now,))
+
+        return key
+
+    def take(self, key):
+        with self._lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.connection.execute(
+                    'SELECT value, expires FROM socialauth_state WHERE key = ?',
+                    (key,)).fetchone()
+                if row is not None:
+                    self.connection.execute(
+                        'DELETE FROM socialauth_state WHERE key = ?', (key,))
+            finally:
+                self.connection.execute('COMMIT')
+
+        if row is None or row[1] <= time.time():
+            return None
+
+        return bytes(row[0])
+
+    def close(self):
+        self.connection.close()
+
+
+MMAP_MAGIC  = b'SASTATE1'
+MMAP_HEADER = struct.Struct('>8sII')
+MMAP_SLOT   = struct.Struct('>16sdH')
+
+
+class MmapStore(StateStore):
+    '''Keeps values in a memory-mapped file shared by processes on a host,
+    such as the workers of one gunicorn master.
+
+    The file is a fixed-size open-addressing hash table. Keys are random, so
+    their leading bytes pick the slot. Writers take an exclusive
+    :func:`fcntl.flock` on the file, opened again in each process so that
+    workers forked after the store was built still exclude each other. Only
+    available where :mod:`fcntl` is.
+
+    :param str path: The file, created if missing.
+    :param int slots: The most values held at once.
+    :param int value_size: The largest value, in bytes.
+    :param int probes: Slots tried after the home slot before giving up.
+    :raises socialauth.Error: If ``path`` was created with other sizes.
+    '''
+
+    def __init__(self, path, slots = 65536, value_size = 128, probes = 16):
+        if fcntl is None:  # pragma: no cover
+            raise Error('MmapStore needs fcntl')
+
+        self.slots      = slots
+        self.value_size = value_size
+        self.probes     = probes
+        self.slot_size  = MMAP_SLOT.size + value_size
+
+        size = MMAP_HEADER.size + slots * self.slot_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self.fd).st_size == 0:
+                    os.ftruncate(self.fd, size)
+                    os.pwrite(self.fd, MMAP_HEADER.pack(MMAP_MAGIC, slots,
+                                                        value_size), 0)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+            header = MMAP_HEADER.unpack(os.pread(self.fd, MMAP_HEADER.size, 0))
+            if header != (MMAP_MAGIC, slots, value_size,):
+                raise Error('State file was created with other sizes')
+
+            self.map = mmap.mmap(self.fd, size)
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+        self.file_lock = FileLock(path)
+
+    def offsets(self, raw):
+        home = int.from_bytes(raw[:8], 'big') % self.slots
+        for probe in range(self.probes + 1):
+            yield (MMAP_HEADER.size +
+                   ((home + probe) % self.slots) * self.slot_size)
+
+    def locked(self):
+        return self.file_lock
+
+    def put(self, value, ttl):
+        if len(value) > self.value_size:
+            raise Error('State value is too large')
+
+        key = new_key()
+        raw = decode_key(key)
+        now = time.time()
+        with self.locked():
+            for offset in self.offsets(raw):
+                stored, expires, length = MMAP_SLOT.unpack_from(self.map, offset)
+                if length == 0 or expires <= now:
+                    MMAP_SLOT.pack_into(self.map, offset, raw, now + ttl,
+                                        len(value) + 1)
+                    start = offset + MMAP_SLOT.size
+                    self.map[start:start + len(value)] = value
+                    return key
+
+        raise Error('State store is full')
+
+    def take(self, key):
+        raw = decode_key(key)
+        if raw is None:
+            return None
+
+        with self.locked():
+            for offset in self.offsets(raw):
+                stored, expires, length = MMAP_SLOT.unpack_from(self.map, offset)
+                if length and stored == raw:
+                    start = offset + MMAP_SLOT.size
+                    value = self.map[start:start + length - 1]
+                    MMAP_SLOT.pack_into(self.map, offset, bytes(16), 0.0, 0)
+                    if expires <= time.time():
+                        return None
+
+                    return value
+
+        return None
+
+    def close(self):
+        self.file_lock.close()
+        self.map.close()
+        os.close(self.fd)
+
+
+class FileLock:
+    '''An exclusive :func:`fcntl.flock` on ``path`` that also excludes the
+    threads of a process.
+
+    A flock belongs to the open file description, which ``fork()`` shares,
+    so a descriptor inherited from the parent would not exclude it. The
+    file is opened again in each process that takes the lock.
+    '''
+
+    __slots__ = ('path', 'fd', 'pid', '_lock',)
+
+    def __init__(self, path):
+        self.path  = path
+        self.fd    = None
+        self.pid   = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            pid = os.getpid()
+            if self.pid != pid:
+                # The parent's descriptor is left open for the parent.
+                self.fd  = os.open(self.path, os.O_RDWR)
+                self.pid = pid
+
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except BaseException:
+            self._lock.release()
+            raise
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self._lock.release()
+        return False
+
+    def close(self):
+        if self.fd is not None and self.pid == os.getpid():
+            os.close(self.fd)
+        self.fd = self.pid = None
+
+
+def decode_key(key):
+    if len(key) != KEY_LENGTH:
+        return None
+
+    try:
+        raw = base64.urlsafe_b64decode(key + '==')
+    except ValueError:
+        return None
+
+    return raw if len(raw) == KEY_BYTES else None
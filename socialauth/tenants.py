@@ -0,0 +1,97 @@
+import threading
+from collections import OrderedDict
+
+from . import InvalidUsage
+
+
+class Tenants:
+    '''Provider configs for many tenants, built on first use.
+
+    Each tenant has its own credentials, laid out like the environment
+    variables a single-tenant process reads::
+
+        tenants = socialauth.Tenants({
+            'brand-a': { 'FACEBOOK_APP_ID': '...', 'FACEBOOK_APP_SECRET': '...' },
+            'brand-b': { 'TWITTER_CONSUMER_KEY': '...', ... },
+        })
+
+    Configs hold everything derived from the credentials, such as the OAuth
+    signer and URL templates, and are kept in an LRU cache. Connection pools
+    are per upstream host, so tenants share the transport's pool.
+
+    :param credentials: A mapping of tenant to credentials. Any object whose
+        ``__getitem__`` raises :class:`KeyError` for unknown tenants works,
+        for instance one loading from a database.
+    :param int maxsize: The most configs to keep.
+    :param options: Attributes such as ``instrumentation``, ``breakers`` or
+        ``rate_limiter`` set on every config that has them.
+    '''
+
+    def __init__(self, credentials, maxsize = 4096, **options):
+        self.credentials = credentials
+        self.maxsize     = maxsize
+        self.options     = options
+
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+
+        self._configs = OrderedDict()
+        self._lock    = threading.Lock()
+
+    def __len__(self):
+        return len(self._configs)
+
+    def config(self, klass, tenant):
+        '''The config of provider class ``klass`` for ``tenant``.
+
+        :raises socialauth.InvalidUsage: If the tenant is unknown.
+        :raises socialauth.Error: If the tenant lacks credentials for the
+            provider.
+        '''
+        key = (klass.name, tenant,)
+        with self._lock:
+            config = self._configs.get(key)
+            if config is not None:
+                self._configs.move_to_end(key)
+                self.hits += 1
+                return config
+
+            self.misses += 1
+
+        if tenant is None:
+            raise InvalidUsage('No tenant given')
+
+        try:
+            environ = self.credentials[tenant]
+        except KeyError:
+            raise InvalidUsage('Unknown tenant')
+
+        config = klass.config_class.from_environ(environ)
+        for name, value in self.options.items():
+            if hasattr(config, name):
+                setattr(config, name, value)
+
+        with self._lock:
+            self._configs[key] = config
+            while len(self._configs) > self.maxsize:
+                self._configs.popitem(last = False)
+                self.evictions += 1
+
+        return config
+
+    def invalidate(self, tenant):
+        '''Forget the configs of ``tenant``, for instance after its
+        credentials change.'''
+        with self._lock:
+            for key in [key for key in self._configs if key[1] == tenant]:
+                del self._configs[key]
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                size      = len(self._configs),
+                hits      = self.hits,
+                misses    = self.misses,
+                evictions = self.evictions,
+            )
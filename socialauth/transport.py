@@ -0,0 +1,419 @@
+import ssl
+import threading
+import time
+import weakref
+from collections import deque
+from urllib.parse import urlsplit, urlunsplit
+
+import httplib2
+
+
+class Transport:
+    '''A thread-safe pool of keep-alive HTTP connections shared by providers.
+
+    Every upstream host (scheme and authority) gets its own stack of idle
+    :class:`httplib2.Http` clients. A client is checked out for the duration
+    of a single request and checked back in afterwards, so its underlying
+    socket is reused by the next request to the same host instead of paying
+    for a new TCP and TLS handshake.
+
+    :param int max_idle_per_host: How many idle connections to keep per host.
+        Connections returned beyond this limit are closed.
+    :param float idle_timeout: Seconds an idle connection may sit in the pool
+        before it is evicted.
+    :param float timeout: Socket timeout handed to httplib2, in seconds.
+    :param dict hosts: Maps an upstream host to a replacement base URL, for
+        instance ``{'graph.facebook.com': 'http://127.0.0.1:8000'}``. Useful
+        for pointing providers at a local stand-in server.
+    :param str ca_certs: A PEM bundle of CA certificates to trust instead of
+        the default ones.
+    '''
+
+    def __init__(self, max_idle_per_host = 4, idle_timeout = 30.0,
+                 timeout = None, hosts = None, ca_certs = None):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout      = idle_timeout
+        self.timeout           = timeout
+        self.hosts             = dict(hosts or {})
+        self.ca_certs          = ca_certs
+
+        self.created = 0
+        self.reused  = 0
+        self.evicted = 0
+
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def resolve(self, url):
+        '''Rewrite ``url`` according to :attr:`hosts`.'''
+        if not self.hosts:
+            return url
+
+        parts = urlsplit(url)
+        base  = self.hosts.get(parts.netloc)
+        if base is None:
+            return url
+
+        base = urlsplit(base)
+        return urlunsplit((base.scheme, base.netloc) + parts[2:])
+
+    def request(self, url, method = 'GET', body = None, headers = None):
+        '''Perform a request over a pooled connection.
+
+        :return: A ``(response, content)`` tuple, as from httplib2.
+        '''
+        url  = self.resolve(url)
+        key  = urlsplit(url)[:2]
+        http = self.checkout(key)
+        try:
+            resp, content = http.request(url, method,
+                                         body    = body,
+                                         headers = headers)
+        except Exception:
+            self.close(http)
+            raise
+
+        self.checkin(key, http)
+        return (resp, content,)
+
+    def preconnect(self, url, count = 1):
+        '''Open ``count`` new connections to the host of ``url`` and leave
+        them idle in the pool, up to :attr:`max_idle_per_host`.
+
+        httplib2 connects lazily, so each connection is opened with an
+        ``OPTIONS`` request for ``url``; its status does not matter. (httplib2
+        closes the connection after a ``HEAD``.)
+
+        :return: The number of connections added to the pool.
+        '''
+        url   = self.resolve(url)
+        key   = urlsplit(url)[:2]
+        conns = []
+        try:
+            for _ in range(min(count, self.max_idle_per_host)):
+                http = httplib2.Http(timeout = self.timeout,
+                                     ca_certs = self.ca_certs)
+                conns.append(http)
+                http.request(url, 'OPTIONS')
+        except Exception:
+            for http in conns:
+                self.close(http)
+            raise
+
+        with self._lock:
+            self.created += len(conns)
+
+        for http in conns:
+            self.checkin(key, http)
+
+        return len(conns)
+
+    def checkout(self, key):
+        conn = self.take_idle(key)
+        if conn is None:
+            conn = httplib2.Http(timeout = self.timeout,
+                                 ca_certs = self.ca_certs)
+
+        return conn
+
+    def take_idle(self, key):
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get(key)
+            while idle:
+                last_used, conn = idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    self.reused += 1
+                    return conn
+
+                self.evicted += 1
+                self.close(conn)
+
+            self.created += 1
+
+        return None
+
+    def checkin(self, key, conn):
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.setdefault(key, deque())
+            self.evict(idle, now)
+            if len(idle) >= self.max_idle_per_host:
+                self.close(conn)
+                return
+
+            idle.append((now, conn,))
+
+    def evict(self, idle, now):
+        # Least recently used connections sit at the left of each deque.
+        while idle and now - idle[0][0] > self.idle_timeout:
+            self.evicted += 1
+            self.close(idle.popleft()[1])
+
+    def clear(self):
+        '''Close every idle connection.'''
+        with self._lock:
+            for idle in self._idle.values():
+                while idle:
+                    self.close(idle.pop()[1])
+
+            self._idle.clear()
+
+    def close(self, http):
+        for conn in http.connections.values():
+            conn.close()
+
+        http.connections.clear()
+
+    def idle_count(self, host = None):
+        '''Number of idle connections, optionally for a single host.'''
+        with self._lock:
+            return sum(
+                len(idle) for key, idle in self._idle.items()
+                if host is None or key[1] == host
+            )
+
+
+class NoResponse(ConnectionError):
+    '''The connection failed before any response arrived.'''
+
+
+class AsyncTransport(Transport):
+    '''A non-blocking counterpart of :class:`Transport` for asyncio.
+
+    Speaks just enough HTTP/1.1 to talk to the providers: requests carry a
+    ``Content-Length`` and responses are read by ``Content-Length``, chunked
+    encoding, or until the server closes the connection. Idle connections are
+    pooled per host with the same limits and eviction as :class:`Transport`.
+    A request on an idle connection the server has since closed is retried
+    once on a new connection.
+
+    Connections belong to the event loop that opened them, so use one
+    :class:`AsyncTransport` per loop. :mod:`asyncio` itself is only imported
+    once an :class:`AsyncTransport` is used.
+
+    :param ssl_context: An :class:`ssl.SSLContext` for ``https`` hosts.
+        Defaults to :func:`ssl.create_default_context` trusting ``ca_certs``.
+    '''
+
+    def __init__(self, max_idle_per_host = 4, idle_timeout = 30.0,
+                 timeout = None, hosts = None, ca_certs = None,
+                 ssl_context = None):
+        Transport.__init__(self,
+                           max_idle_per_host = max_idle_per_host,
+                           idle_timeout      = idle_timeout,
+                           timeout           = timeout,
+                           hosts             = hosts,
+                           ca_certs          = ca_certs)
+        self.ssl_context = ssl_context
+
+    async def request(self, url, method = 'GET', body = None, headers = None):
+        '''Perform a request over a pooled connection.
+
+        :return: A ``(response, content)`` tuple, where ``response`` is an
+            :class:`httplib2.Response`.
+        '''
+        url    = self.resolve(url)
+        parts  = urlsplit(url)
+        key    = parts[:2]
+        conn   = self.take_idle(key)
+        reused = conn is not None
+        if not reused:
+            conn = await self.connect(parts)
+
+        try:
+            resp, content, keep_alive = await self.send(conn, parts, method,
+                                                        body, headers)
+        except NoResponse:
+            if not reused:
+                raise
+
+            # The server closed the idle connection before the request
+            # reached it. Retry once on a new one, as httplib2 does.
+            conn = await self.connect(parts)
+            with self._lock:
+                self.created += 1
+
+            resp, content, keep_alive = await self.send(conn, parts, method,
+                                                        body, headers)
+
+        if keep_alive:
+            self.checkin(key, conn)
+        else:
+            self.close(conn)
+
+        return (resp, content,)
+
+    async def send(self, conn, parts, method, body, headers):
+        import asyncio
+
+        try:
+            return await asyncio.wait_for(
+                self.exchange(conn, parts, method, body, headers),
+                self.timeout)
+        except BaseException:
+            self.close(conn)
+            raise
+
+    async def preconnect(self, url, count = 1):
+        '''Coroutine counterpart of :meth:`Transport.preconnect`. The
+        connections are opened concurrently and without a request.'''
+        import asyncio
+
+        parts   = urlsplit(self.resolve(url))
+        results = await asyncio.gather(
+            *[self.connect(parts)
+              for _ in range(min(count, self.max_idle_per_host))],
+            return_exceptions = True)
+
+        conns  = [conn for conn in results if not isinstance(conn, BaseException)]
+        errors = [error for error in results if isinstance(error, BaseException)]
+        if errors:
+            for conn in conns:
+                self.close(conn)
+            raise errors[0]
+
+        with self._lock:
+            self.created += len(conns)
+
+        for conn in conns:
+            self.checkin(parts[:2], conn)
+
+        return len(conns)
+
+    async def connect(self, parts):
+        import asyncio
+
+        context = None
+        if parts.scheme == 'https':
+            context = self.ssl_context or ssl.create_default_context(
+                cafile = self.ca_certs)
+
+        port = parts.port or (443 if context is not None else 80)
+        return await asyncio.wait_for(
+            asyncio.open_connection(parts.hostname, port, ssl = context),
+            self.timeout)
+
+    async def exchange(self, conn, parts, method, body, headers):
+        reader, writer = conn
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        body = body or b''
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        lines = [
+            '{} {} HTTP/1.1'.format(method, path),
+            'Host: {}'.format(parts.netloc),
+            'Content-Length: {}'.format(len(body)),
+        ]
+        for name, value in (headers or {}).items():
+            lines.append('{}: {}'.format(name, value))
+
+        head = '\r\n'.join(lines) + '\r\n\r\n'
+        try:
+            writer.write(head.encode('latin-1') + body)
+            await writer.drain()
+            status_line = await reader.readline()
+        except ConnectionError as e:
+            raise NoResponse(str(e) or 'Connection lost to {}'.format(
+                parts.netloc))
+
+        if not status_line:
+            raise NoResponse('Connection closed by {}'.format(parts.netloc))
+
+        version, status = status_line.decode('latin-1').split(None, 2)[:2]
+        info = { 'status': status }
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+
+            name, _, value = line.decode('latin-1').partition(':')
+            info[name.strip().lower()] = value.strip()
+
+        keep_alive = (
+            version == 'HTTP/1.1' and
+            info.get('connection', '').lower() != 'close'
+        )
+        if method == 'HEAD' or status in ('204', '304'):
+            content = b''
+        elif info.get('transfer-encoding', '').lower() == 'chunked':
+            content = await read_chunked(reader)
+        elif 'content-length' in info:
+            content = await reader.readexactly(int(info['content-length']))
+        else:
+            content    = await reader.read()
+            keep_alive = False
+
+        return (httplib2.Response(info), content, keep_alive,)
+
+    def close(self, conn):
+        conn[1].close()
+
+
+async def read_chunked(reader):
+    chunks = []
+    while True:
+        size = int((await reader.readline()).split(b';')[0], 16)
+        if size == 0:
+            break
+
+        chunks.append(await reader.readexactly(size))
+        await reader.readline()
+
+    # Discard trailers.
+    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+        pass
+
+    return b''.join(chunks)
+
+
+# Upstream calls must not hang a worker forever when a provider degrades.
+DEFAULT_TIMEOUT = 10.0
+
+_default_transport = None
+_default_lock      = threading.Lock()
+
+
+def get_default_transport():
+    '''Return the process-wide :class:`Transport`, creating it if needed.'''
+    global _default_transport
+    if _default_transport is None:
+        with _default_lock:
+            if _default_transport is None:
+                _default_transport = Transport(timeout = DEFAULT_TIMEOUT)
+
+    return _default_transport
+
+
+def set_default_transport(transport):
+    '''Replace the process-wide :class:`Transport` used by all providers.'''
+    global _default_transport
+    with _default_lock:
+        _default_transport = transport
+
+
+_default_async_transports = weakref.WeakKeyDictionary()
+
+
+def get_default_async_transport():
+    '''Return the :class:`AsyncTransport` for the running event loop.'''
+    import asyncio
+
+    loop = asyncio.get_event_loop()
+    transport = _default_async_transports.get(loop)
+    if transport is None:
+        transport = _default_async_transports[loop] = AsyncTransport(
+            timeout = DEFAULT_TIMEOUT)
+
+    return transport
+
+
+def set_default_async_transport(transport):
+    '''Replace the :class:`AsyncTransport` used on the running event loop.'''
+    import asyncio
+
+    _default_async_transports[asyncio.get_event_loop()] = transport
@@ -0,0 +1,75 @@
+'''A WSGI application serving ``/auth/<provider>``.
+
+Serve it on its own::
+
+    application = socialauth.wsgi.AuthApp(os.environ['TOKEN_SECRET'])
+
+or in front of another WSGI application, which receives every other path::
+
+    app.wsgi_app = socialauth.wsgi.AuthApp(secret, app = app.wsgi_app)
+'''
+
+from http import HTTPStatus
+
+from .endpoint import AuthEndpoint
+
+
+STATUS_LINES = dict(
+    (status.value, '{} {}'.format(status.value, status.phrase))
+    for status in HTTPStatus
+)
+
+NOT_FOUND = (404, [('Content-Type', 'text/plain',)], b'Not Found',)
+
+
+class AuthApp:
+    '''Handles ``/auth/<provider>`` without a web framework.
+
+    Takes the same keyword arguments as
+    :class:`~socialauth.endpoint.AuthEndpoint`.
+
+    :param token_secret: Signs the state and session cookies. A ``str`` or a
+        :class:`~socialauth.KeyRing`.
+    :param app: A WSGI application for every other path. Without one they
+        get a 404.
+    '''
+
+    def __init__(self, token_secret, app = None, **options):
+        self.endpoint = AuthEndpoint(token_secret, **options)
+        self.app      = app
+
+    def __call__(self, environ, start_response):
+        path     = environ.get('PATH_INFO', '')
+        provider = self.endpoint.route(path)
+        if provider is None:
+            if self.app is not None:
+                return self.app(environ, start_response)
+
+            status, headers, body = NOT_FOUND
+        else:
+            status, headers, body = self.endpoint.handle(
+                provider,
+                request_url(environ, path),
+                environ.get('QUERY_STRING', ''),
+                environ.get('HTTP_COOKIE'),
+                environ.get('wsgi.url_scheme') == 'https')
+
+        headers = headers + [('Content-Length', str(len(body)),)]
+        start_response(STATUS_LINES[status], headers)
+        return [body]
+
+    def read_session(self, environ):
+        '''Decode the request's session cookie. See
+        :meth:`socialauth.endpoint.AuthEndpoint.read_session`.'''
+        return self.endpoint.read_session(environ.get('HTTP_COOKIE'))
+
+
+def request_url(environ, path):
+    '''The URL of the request without its query string, used as the OAuth
+    callback.'''
+    host = environ.get('HTTP_HOST')
+    if not host:
+        host = '{}:{}'.format(environ['SERVER_NAME'], environ['SERVER_PORT'])
+
+    return '{}://{}{}{}'.format(environ.get('wsgi.url_scheme', 'http'), host,
+                                environ.get('SCRIPT_NAME', ''), path)
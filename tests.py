@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import os
+import time
+import asyncio
 import unittest
 from unittest.mock import patch
 from urllib.parse import urlparse, parse_qs
@@ -9,6 +11,7 @@ from contextlib import contextmanager
 import jwt
 import httplib2
 import socialauth
+from socialauth.bench.servers import FakeProviderServer
 
 
 twitter_base_url  = 'https://test.socialauth.foo/auth/twitter'
@@ -60,6 +63,2041 @@ def no_env(key):
     os.environ[key] = value
 
 
+class TestTransport(unittest.TestCase):
+    def test_resolve(self):
+        transport = socialauth.Transport(hosts = {
+            'graph.facebook.com': 'http://127.0.0.1:8000'
+        })
+        self.assertEqual(
+            transport.resolve('https://graph.facebook.com/me?fields=id'),
+            'http://127.0.0.1:8000/me?fields=id')
+        self.assertEqual(
+            transport.resolve('https://api.twitter.com/oauth/request_token'),
+            'https://api.twitter.com/oauth/request_token')
+
+    def test_connections_are_reused(self):
+        with FakeProviderServer() as server:
+            transport = server.transport()
+            for i in range(3):
+                res = socialauth.http_get_provider(
+                    'facebook', facebook_base_url, { 'code': 'foo' },
+                    'sekret', transport = transport)
+                self.assertEqual(res['provider_user_id'], '987')
+
+            self.assertEqual(server.connections, 1)
+            self.assertEqual(transport.created, 1)
+            self.assertEqual(transport.reused, 5)
+            self.assertEqual(transport.idle_count('127.0.0.1:{}'.format(
+                server.server_address[1])), 1)
+
+    def test_twitter_through_stand_in(self):
+        with FakeProviderServer() as server:
+            transport = server.transport()
+            res = socialauth.http_get_provider(
+                'twitter', twitter_base_url, { 'login': 'start' },
+                'sekret', transport = transport)
+            self.assertEqual(res['status'], 302)
+
+            args = { 'oauth_token': 'foo', 'oauth_verifier': 'foo' }
+            res  = socialauth.http_get_provider(
+                'twitter', twitter_base_url, args, 'sekret',
+                res['set_token_cookie'], transport = transport)
+            self.assertEqual(res['provider_user_id'], '987')
+            self.assertEqual(server.connections, 1)
+
+    def test_idle_eviction(self):
+        with FakeProviderServer() as server:
+            transport = server.transport(idle_timeout = 0)
+            for i in range(2):
+                socialauth.http_get_provider(
+                    'facebook', facebook_base_url, { 'code': 'foo' },
+                    'sekret', transport = transport)
+
+            self.assertEqual(transport.reused, 0)
+            self.assertGreater(transport.evicted, 0)
+
+    def test_max_idle_per_host(self):
+        transport = socialauth.Transport(max_idle_per_host = 1)
+        key = ('https', 'graph.facebook.com')
+        transport.checkin(key, transport.checkout(key))
+        transport.checkin(key, httplib2.Http())
+        self.assertEqual(transport.idle_count(), 1)
+
+        transport.clear()
+        self.assertEqual(transport.idle_count(), 0)
+
+    def test_default_transport(self):
+        default = socialauth.get_default_transport()
+        self.assertIs(socialauth.get_default_transport(), default)
+
+        transport = socialauth.Transport()
+        socialauth.set_default_transport(transport)
+        try:
+            self.assertIs(socialauth.get_default_transport(), transport)
+        finally:
+            socialauth.set_default_transport(default)
+
+
+def run_async(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class TestAsyncHTTPGetProvider(unittest.TestCase):
+    def test_invalid_provider(self):
+        with self.assertRaises(socialauth.InvalidUsage):
+            run_async(socialauth.async_http_get_provider('foobar!', '', {}, ''))
+
+    def test_facebook_flow(self):
+        async def flow(transport):
+            res = await socialauth.async_http_get_provider(
+                'facebook', facebook_base_url, { 'login': 'start' }, 'sekret',
+                transport = transport)
+            self.assertEqual(res['status'], 302)
+
+            return await asyncio.gather(*[
+                socialauth.async_http_get_provider(
+                    'facebook', facebook_base_url, { 'code': 'foo' }, 'sekret',
+                    transport = transport)
+                for i in range(3)
+            ])
+
+        with FakeProviderServer() as server:
+            transport = server.transport(socialauth.AsyncTransport)
+            for res in run_async(flow(transport)):
+                self.assertEqual(res['status'], 200)
+                self.assertEqual(res['provider_user_id'], '987')
+                self.assertEqual(res['provider_user_name'], 'test')
+
+            self.assertEqual(server.connections, transport.created)
+            self.assertEqual(transport.created + transport.reused, 6)
+
+    def test_twitter_flow(self):
+        async def flow(transport):
+            res = await socialauth.async_http_get_provider(
+                'twitter', twitter_base_url, { 'login': 'start' }, 'sekret',
+                transport = transport)
+            self.assertEqual(res['status'], 302)
+
+            args = { 'oauth_token': 'foo', 'oauth_verifier': 'foo' }
+            return await socialauth.async_http_get_provider(
+                'twitter', twitter_base_url, args, 'sekret',
+                res['set_token_cookie'], transport = transport)
+
+        with FakeProviderServer() as server:
+            transport = server.transport(socialauth.AsyncTransport)
+            res = run_async(flow(transport))
+            self.assertEqual(res['provider_user_id'], '987')
+            self.assertEqual(server.connections, 1)
+
+    def test_upstream_failure(self):
+        with FakeProviderServer() as server:
+            transport = server.transport(socialauth.AsyncTransport)
+            with self.assertRaisesRegex(socialauth.Error, '400 from Facebook'):
+                run_async(socialauth.async_http_get_provider(
+                    'facebook', facebook_base_url, { 'code': 'bad' }, 'sekret',
+                    transport = transport))
+
+    def test_retries_closed_idle_connection(self):
+        async def answer_once(reader, writer):
+            await reader.readuntil(b'\r\n\r\n')
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+            await writer.drain()
+            writer.close()
+
+        async def requests():
+            server = await asyncio.start_server(answer_once, '127.0.0.1', 0)
+            url = 'http://127.0.0.1:{}/'.format(server.sockets[0].getsockname()[1])
+            transport = socialauth.AsyncTransport()
+            try:
+                results = [await transport.request(url) for i in range(2)]
+            finally:
+                server.close()
+
+            return transport, results
+
+        transport, results = run_async(requests())
+        self.assertEqual([content for resp, content in results], [b'ok'] * 2)
+        self.assertEqual((transport.created, transport.reused,), (2, 1,))
+
+    def test_read_chunked(self):
+        async def read():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b'3\r\nfoo\r\n4;ext=1\r\nbarz\r\n0\r\n\r\n')
+            reader.feed_eof()
+            return await socialauth.transport.read_chunked(reader)
+
+        self.assertEqual(run_async(read()), b'foobarz')
+
+
+credentials = {
+    'TWITTER_CONSUMER_KEY': 'foobar',
+    'TWITTER_CONSUMER_SECRET': 'foobar',
+    'FACEBOOK_APP_ID': '1234',
+    'FACEBOOK_APP_SECRET': 'foobar',
+}
+
+
+class TestProviderRegistry(unittest.TestCase):
+    def test_fails_fast(self):
+        with self.assertRaisesRegex(socialauth.Error, 'No FACEBOOK_APP_SECRET'):
+            socialauth.ProviderRegistry(('facebook',),
+                                        environ = { 'FACEBOOK_APP_ID': '1234' })
+
+        with self.assertRaisesRegex(socialauth.Error, 'No TWITTER_CONSUMER_KEY'):
+            socialauth.ProviderRegistry(('twitter',), environ = {})
+
+        registry = socialauth.ProviderRegistry(('facebook',), environ = credentials)
+        self.assertNotIn('twitter', registry)
+
+    def test_unsupported_provider(self):
+        with self.assertRaises(socialauth.InvalidUsage):
+            socialauth.ProviderRegistry(('foobar!',), environ = credentials)
+
+        registry = socialauth.ProviderRegistry(environ = credentials)
+        with self.assertRaises(socialauth.InvalidUsage):
+            registry.http_get_provider('foobar!', '', {}, '')
+
+    def test_config_built_once(self):
+        environ  = dict(credentials, FACEBOOK_GRAPH_API_VERSION = 'v9.9')
+        registry = socialauth.ProviderRegistry(environ = environ)
+        config   = registry['facebook']
+        self.assertEqual(config.api_version, 'v9.9')
+
+        with no_env('FACEBOOK_APP_ID'):
+            res = registry.http_get_provider(
+                'facebook', facebook_base_url, { 'login': 'start' }, 'sekret')
+
+        self.assertIn('client_id=1234', res['redirect'])
+        self.assertIs(registry['facebook'], config)
+
+    @patch('httplib2.Http.request', mock_valid_requests)
+    def test_flow(self):
+        registry = socialauth.ProviderRegistry(environ = credentials)
+        res = registry.http_get_provider(
+            'twitter', twitter_base_url, { 'login': 'start' }, 'sekret')
+        self.assertEqual(res['status'], 302)
+
+        args = { 'oauth_token': 'foo', 'oauth_verifier': 'foo' }
+        res  = registry.http_get_provider(
+            'twitter', twitter_base_url, args, 'sekret', res['set_token_cookie'])
+        self.assertEqual(res['provider_user_id'], '987')
+
+        res = registry.http_get_provider(
+            'facebook', facebook_base_url, { 'code': 'foo' }, 'sekret')
+        self.assertEqual(res['provider_user_id'], '987')
+
+    def test_async_flow(self):
+        with FakeProviderServer() as server:
+            registry = socialauth.ProviderRegistry(
+                environ         = credentials,
+                async_transport = server.transport(socialauth.AsyncTransport))
+            res = run_async(registry.async_http_get_provider(
+                'facebook', facebook_base_url, { 'code': 'foo' }, 'sekret'))
+            self.assertEqual(res['provider_user_id'], '987')
+
+
+class TestHandlers(unittest.TestCase):
+    def test_flow(self):
+        with FakeProviderServer() as server:
+            registry = socialauth.ProviderRegistry(
+                environ = credentials, transport = server.transport())
+            handler = registry.handler('twitter', 'sekret')
+            self.assertIs(registry.handler('twitter', 'sekret'), handler)
+
+            res = handler.start(twitter_base_url)
+            self.assertIsInstance(res, socialauth.LoginResult)
+            self.assertEqual(res.status, 302)
+            self.assertIn('/oauth/authenticate?oauth_token=foo', res.redirect)
+
+            args = { 'oauth_token': 'foo', 'oauth_verifier': 'foo' }
+            res  = handler.finish(twitter_base_url, args, res.set_token_cookie)
+
+        self.assertEqual((res.status, res.user_id, res.user_name,),
+                         (200, '987', 'test',))
+        self.assertEqual(res.to_dict(), dict(status             = 200,
+                                             provider_user_id   = '987',
+                                             provider_user_name = 'test'))
+        with self.assertRaises(AttributeError):
+            res.extra = True
+
+    def test_shared_across_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        with FakeProviderServer() as server:
+            handler = socialauth.providers.FacebookHandler(
+                'sekret',
+                config    = socialauth.providers.FacebookConfig('1234', 'foo'),
+                transport = server.transport())
+            with ThreadPoolExecutor(max_workers = 8) as executor:
+                results = list(executor.map(
+                    lambda i: handler.handle(facebook_base_url,
+                                             { 'code': str(i) }),
+                    range(32)))
+
+        self.assertEqual(set(res.user_id for res in results), set(('987',)))
+
+    def test_invalid_request(self):
+        handler = socialauth.providers.TwitterHandler(
+            'sekret', config = socialauth.providers.TwitterConfig('a', 'b'))
+        with self.assertRaises(socialauth.InvalidUsage):
+            handler.handle(twitter_base_url, { 'oauth_token': 'foo' })
+
+        with self.assertRaisesRegex(socialauth.Error, 'No token cookie'):
+            handler.finish(twitter_base_url,
+                           { 'oauth_token': 'foo', 'oauth_verifier': 'foo' })
+
+    def test_module_functions_keep_a_handler(self):
+        from socialauth.authentication import default_handler
+        handler = default_handler('facebook', 'sekret')
+        self.assertIs(default_handler('facebook', 'sekret'), handler)
+        self.assertIsNot(default_handler('facebook', 'other'), handler)
+
+    def test_alloc_bench(self):
+        from socialauth.bench import alloc
+        results = alloc.run(logins = 10)
+        for provider in ('twitter', 'facebook'):
+            self.assertLess(results[provider]['handler'],
+                            results[provider]['per_request'])
+
+
+class TestProtocol(unittest.TestCase):
+    def test_steps_without_io(self):
+        from socialauth.bench.servers import GRAPH_TOKEN, GRAPH_ME
+        handler = socialauth.providers.FacebookHandler(
+            'sekret', socialauth.providers.FacebookConfig('1234', 'b'))
+        steps   = handler.steps('finish', facebook_base_url, { 'code': 'foo' })
+
+        request = next(steps)
+        self.assertEqual(request.endpoint, 'access_token')
+        self.assertIn('code=foo', request.make()[0])
+        ok = httplib2.Response(dict(status = 200))
+
+        request = steps.send(request.parse(ok, GRAPH_TOKEN))
+        self.assertEqual(request.endpoint, 'user_information')
+        self.assertTrue(request.hedge)
+        self.assertTrue(request.make()[0].endswith('access_token=foobar'))
+
+        with self.assertRaises(StopIteration) as stop:
+            steps.send(request.parse(ok, GRAPH_ME))
+
+        self.assertEqual(stop.exception.value.user_id, '987')
+
+    def test_stand_in_transports(self):
+        from socialauth.bench.alloc import ReplayTransport
+
+        class AsyncReplayTransport(ReplayTransport):
+            async def request(self, *args):
+                return ReplayTransport.request(self, *args)
+
+        handler = socialauth.providers.TwitterHandler(
+            'sekret', socialauth.providers.TwitterConfig('a', 'b'))
+        res = handler.handle(twitter_base_url, { 'login': 'start' },
+                             transport = ReplayTransport())
+        self.assertEqual(res.status, 302)
+
+        args = { 'oauth_token': 'foo', 'oauth_verifier': 'foo' }
+        res  = run_async(handler.async_handle(
+            twitter_base_url, args, res.set_token_cookie,
+            transport = AsyncReplayTransport()))
+        self.assertEqual((res.status, res.user_id,), (200, '987',))
+
+    def test_blocking_work_leaves_the_loop(self):
+        import threading
+        from socialauth.bench.alloc import ReplayTransport
+        from socialauth.protocol import Call
+        from socialauth.ratelimit import LocalBuckets, RateLimiter
+        threads = []
+
+        class Store(socialauth.stores.MemoryStore):
+            def put(self, value, ttl):
+                threads.append(threading.current_thread())
+                return socialauth.stores.MemoryStore.put(self, value, ttl)
+
+            def take(self, key):
+                threads.append(threading.current_thread())
+                return socialauth.stores.MemoryStore.take(self, key)
+
+        class Buckets(LocalBuckets):
+            blocking = True
+
+            def transact(self, key, initial, func):
+                threads.append(threading.current_thread())
+                return LocalBuckets.transact(self, key, initial, func)
+
+        class AsyncReplayTransport(ReplayTransport):
+            async def request(self, *args):
+                return ReplayTransport.request(self, *args)
+
+        config = socialauth.providers.TwitterConfig('a', 'b')
+        config.state_store  = Store()
+        config.rate_limiter = RateLimiter(buckets = Buckets())
+        handler = socialauth.providers.TwitterHandler('sekret', config)
+
+        steps = handler.steps('start', twitter_base_url, { 'login': 'start' })
+        tokens = (b'oauth_token=foo&oauth_token_secret=bar&'
+                  b'oauth_callback_confirmed=true')
+        request = next(steps)
+        call = steps.send(request.parse(httplib2.Response(dict(status = 200)),
+                                        tokens))
+        self.assertIsInstance(call, Call)
+
+        async def login():
+            transport = AsyncReplayTransport()
+            res = await handler.async_handle(
+                twitter_base_url, { 'login': 'start' }, transport = transport)
+            args = { 'oauth_token': 'foo', 'oauth_verifier': 'foo' }
+            return await handler.async_handle(
+                twitter_base_url, args, res.set_token_cookie,
+                transport = transport)
+
+        self.assertEqual(run_async(login()).user_id, '987')
+        self.assertEqual(len(threads), 4)
+        self.assertNotIn(threading.main_thread(), threads)
+
+
+class TestHTTPGetProviderMany(unittest.TestCase):
+    def test_order(self):
+        requests = [
+            ('facebook', facebook_base_url, { 'code': 'foo' }),
+            ('facebook', facebook_base_url, { 'code': 'bad' }),
+            ('github', facebook_base_url, { 'code': 'foo' }),
+            ('twitter', twitter_base_url, { 'login': 'start' }, None),
+        ]
+        with FakeProviderServer() as server:
+            results = socialauth.http_get_provider_many(
+                requests, 'sekret', concurrency = 2,
+                transport = server.transport())
+
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[0]['provider_user_id'], '987')
+        self.assertIsInstance(results[1], socialauth.Error)
+        self.assertIsInstance(results[2], socialauth.InvalidUsage)
+        self.assertEqual(results[3]['status'], 302)
+
+    def test_registry(self):
+        with FakeProviderServer() as server:
+            registry = socialauth.ProviderRegistry(
+                environ = credentials, transport = server.transport())
+            results = registry.http_get_provider_many(
+                [('facebook', facebook_base_url, { 'code': str(i) })
+                 for i in range(10)], 'sekret', concurrency = 4)
+
+        self.assertEqual([result['provider_user_id'] for result in results],
+                         ['987'] * 10)
+        self.assertLessEqual(server.connections, 4)
+
+    def test_deadline(self):
+        requests = [('facebook', facebook_base_url, { 'code': 'foo' })] * 3
+        with FakeProviderServer(latency = 0.2) as server:
+            registry = socialauth.ProviderRegistry(
+                environ = credentials, transport = server.transport())
+            began   = time.monotonic()
+            results = registry.http_get_provider_many(
+                requests, 'sekret', concurrency = 1, deadline = 0.05)
+            elapsed = time.monotonic() - began
+            time.sleep(0.3)
+
+        self.assertLess(elapsed, 0.2)
+        for result in results:
+            self.assertIsInstance(result, socialauth.DeadlineExceeded)
+
+        # Only the first login, a token exchange and a /me lookup, started.
+        self.assertLessEqual(server.requests, 2)
+
+    def test_empty(self):
+        self.assertEqual(socialauth.http_get_provider_many([], 'sekret'), [])
+
+
+class TestAuthApps(unittest.TestCase):
+    def wsgi(self, app, path, query_string = '', cookie = None):
+        from wsgiref.util import setup_testing_defaults
+        environ = dict(PATH_INFO = path, QUERY_STRING = query_string)
+        if cookie is not None:
+            environ['HTTP_COOKIE'] = cookie
+        setup_testing_defaults(environ)
+
+        started = []
+        body    = b''.join(app(environ, lambda *args: started.extend(args)))
+        return (started[0], started[1], body,)
+
+    def test_wsgi_flow(self):
+        from socialauth.wsgi import AuthApp
+        with FakeProviderServer() as server:
+            app = AuthApp('sekret', registry = socialauth.ProviderRegistry(
+                environ = credentials, transport = server.transport()))
+
+            status, headers, body = self.wsgi(app, '/auth/twitter', 'login=start')
+            self.assertEqual(status, '302 Found')
+            headers = dict(headers)
+            self.assertIn('oauth_token=foo', headers['Location'])
+            state = headers['Set-Cookie'].split(';')[0]
+            self.assertTrue(state.startswith('socialauth_state='))
+            self.assertIn('HttpOnly', headers['Set-Cookie'])
+            self.assertNotIn('Secure', headers['Set-Cookie'])
+
+            status, headers, body = self.wsgi(
+                app, '/auth/twitter', 'oauth_token=foo&oauth_verifier=foo',
+                'other=1; ' + state)
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(body, b'{"status":"success"}')
+
+        cookies = [value.split(';')[0]
+                   for name, value in headers if name == 'Set-Cookie']
+        session = app.read_session(dict(HTTP_COOKIE = cookies[0]))
+        self.assertLessEqual(abs(session.pop('auth_time') - time.time()), 5)
+        self.assertEqual(session, dict(provider = 'twitter', tenant = None,
+                                       user_id = '987', user_name = 'test'))
+        self.assertEqual(cookies[1], 'socialauth_state=')
+        self.assertIsNone(app.read_session(dict(HTTP_COOKIE = 'x=y')))
+        self.assertIsNone(app.read_session(
+            dict(HTTP_COOKIE = 'socialauth_session=forged')))
+
+    def test_fast_path(self):
+        from socialauth.wsgi import AuthApp
+        sessions = socialauth.Sessions('sekret')
+        registry = socialauth.ProviderRegistry(environ = credentials)
+        app      = AuthApp('sekret', registry = registry, sessions = sessions)
+        cookie   = 'socialauth_session=' + sessions.encode('facebook', '987')
+
+        async def start():
+            return await registry.async_http_get_provider(
+                'facebook', facebook_base_url, { 'login': 'start' }, 'sekret',
+                sessions = sessions, session_token = cookie.split('=', 1)[1])
+
+        status, headers, body = self.wsgi(
+            app, '/auth/facebook', 'login=start', cookie)
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(headers[1][1].startswith('socialauth_session='))
+        self.assertTrue(run_async(start())['returning'])
+
+        # Without sessions, AuthApp always sends users to the provider.
+        app = AuthApp('sekret', registry = registry)
+        status, headers, body = self.wsgi(
+            app, '/auth/facebook', 'login=start', cookie)
+        self.assertEqual(status, '302 Found')
+
+    def test_wsgi_errors(self):
+        from socialauth.wsgi import AuthApp
+        with FakeProviderServer() as server:
+            app = AuthApp('sekret', secure = True,
+                          registry = socialauth.ProviderRegistry(
+                              environ = credentials,
+                              transport = server.transport()))
+
+            status, headers, body = self.wsgi(app, '/auth/facebook', 'code=bad')
+            self.assertEqual(status, '502 Bad Gateway')
+
+            status, headers, body = self.wsgi(app, '/auth/facebook')
+            self.assertEqual(status, '400 Bad Request')
+            self.assertIn(b'Invalid request', body)
+
+            status, headers, body = self.wsgi(app, '/auth/github', 'code=foo')
+            self.assertEqual(status, '400 Bad Request')
+
+            status, headers, body = self.wsgi(
+                app, '/auth/twitter', 'oauth_token=foo&oauth_verifier=foo')
+            self.assertEqual(status, '400 Bad Request')
+            self.assertIn(b'No token cookie', body)
+
+            status, headers, body = self.wsgi(app, '/auth/facebook', 'code=foo')
+            self.assertIn('Secure', dict(headers)['Set-Cookie'])
+
+        self.assertEqual(self.wsgi(app, '/other')[0], '404 Not Found')
+
+    def test_wsgi_mount(self):
+        from socialauth.wsgi import AuthApp
+
+        def other(environ, start_response):
+            start_response('200 OK', [])
+            return [b'other']
+
+        app = AuthApp('sekret', app = other,
+                      registry = socialauth.ProviderRegistry(environ = credentials))
+        self.assertEqual(self.wsgi(app, '/whoami')[2], b'other')
+        self.assertEqual(self.wsgi(app, '/auth/twitter/x')[2], b'other')
+
+    def test_asgi(self):
+        from socialauth.asgi import AsyncAuthApp
+
+        async def request(app, path, query_string):
+            sent  = []
+            scope = dict(type = 'http', path = path, scheme = 'https',
+                         query_string = query_string,
+                         headers = [(b'host', b'example.com')])
+
+            async def send(message):
+                sent.append(message)
+
+            await app(scope, None, send)
+            return (sent[0]['status'], dict(sent[0]['headers']), sent[1]['body'],)
+
+        async def flow(server):
+            app = AsyncAuthApp('sekret', registry = socialauth.ProviderRegistry(
+                environ         = credentials,
+                async_transport = server.transport(socialauth.AsyncTransport)))
+
+            status, headers, body = await request(app, '/auth/facebook', b'code=foo')
+            self.assertEqual(status, 200)
+            self.assertIn(b'Secure', headers[b'set-cookie'])
+
+            status, headers, body = await request(app, '/auth/facebook', b'')
+            self.assertEqual(status, 400)
+
+            status, headers, body = await request(app, '/nope', b'')
+            self.assertEqual(status, 404)
+
+        with FakeProviderServer() as server:
+            run_async(flow(server))
+
+    def test_error_statuses(self):
+        from socialauth.asgi import header_map
+        from socialauth.endpoint import AuthEndpoint
+        from socialauth.ratelimit import RateLimited
+        endpoint = AuthEndpoint('sekret', registry = socialauth.ProviderRegistry(
+            environ = credentials))
+        for error, status, retry_after in (
+                (socialauth.Error('500 from Twitter'), 502, None,),
+                (socialauth.ClientError('No token cookie given'), 400, None,),
+                (RateLimited('twitter rate limit reached', 1.5), 429, '2',),
+                (socialauth.CircuitOpenError('Circuit open', 30), 503, '30',),):
+            result, headers, body = endpoint.error(error)
+            self.assertEqual(result, status)
+            self.assertEqual(dict(headers).get('Retry-After'), retry_after)
+
+        headers = header_map(dict(headers = [(b'cookie', b'a=1'),
+                                             (b'host', b'example.com'),
+                                             (b'cookie', b'b=2')]))
+        self.assertEqual(headers[b'cookie'], b'a=1; b=2')
+
+
+class TestTenants(unittest.TestCase):
+    credentials = {
+        'a': dict(TWITTER_CONSUMER_KEY = 'key-a', TWITTER_CONSUMER_SECRET = 'x',
+                  FACEBOOK_APP_ID = 'app-a', FACEBOOK_APP_SECRET = 'x'),
+        'b': dict(TWITTER_CONSUMER_KEY = 'key-b', TWITTER_CONSUMER_SECRET = 'y'),
+    }
+
+    def test_configs(self):
+        from socialauth.providers import Twitter, AsyncTwitter, Facebook
+        tenants = socialauth.Tenants(self.credentials, breakers = 'breakers')
+        config  = tenants.config(Twitter, 'a')
+        self.assertEqual(config.consumer_key, 'key-a')
+        self.assertEqual(config.breakers, 'breakers')
+        self.assertIs(tenants.config(AsyncTwitter, 'a'), config)
+        self.assertEqual(tenants.config(Twitter, 'b').consumer_key, 'key-b')
+
+        with self.assertRaises(socialauth.InvalidUsage):
+            tenants.config(Twitter, 'c')
+        with self.assertRaises(socialauth.InvalidUsage):
+            tenants.config(Twitter, None)
+        with self.assertRaises(socialauth.Error):
+            tenants.config(Facebook, 'b')
+
+        tenants.invalidate('a')
+        self.assertIsNot(tenants.config(Twitter, 'a'), config)
+        self.assertEqual(tenants.stats(),
+                         dict(size = 2, hits = 1, misses = 6, evictions = 0))
+
+    def test_lru(self):
+        from socialauth.providers import Twitter
+        tenants = socialauth.Tenants(self.credentials, maxsize = 1)
+        config  = tenants.config(Twitter, 'a')
+        tenants.config(Twitter, 'b')
+        self.assertEqual(len(tenants), 1)
+        self.assertIsNot(tenants.config(Twitter, 'a'), config)
+        self.assertEqual(tenants.stats()['evictions'], 2)
+
+    def test_http_get_provider(self):
+        tenants = socialauth.Tenants(self.credentials)
+        with FakeProviderServer() as server:
+            transport = server.transport()
+            for tenant in ('a', 'b'):
+                res = socialauth.http_get_provider(
+                    'twitter', twitter_base_url, { 'login': 'start' }, 'sekret',
+                    transport = transport, tenant = tenant, tenants = tenants)
+                self.assertEqual(res['status'], 302)
+
+            res = run_async(socialauth.async_http_get_provider(
+                'facebook', facebook_base_url, { 'code': 'foo' }, 'sekret',
+                transport = server.transport(socialauth.AsyncTransport),
+                tenant = 'a', tenants = tenants))
+            self.assertEqual(res['provider_user_id'], '987')
+
+        with self.assertRaises(socialauth.InvalidUsage):
+            socialauth.http_get_provider(
+                'twitter', twitter_base_url, { 'login': 'start' }, 'sekret',
+                tenant = 'a')
+
+    @patch('httplib2.Http.request')
+    def test_signs_with_tenant_credentials(self, request):
+        request.side_effect = lambda *a, **k: mock_valid_requests(None, *a, **k)
+        tenants = socialauth.Tenants(self.credentials)
+        socialauth.http_get_provider(
+            'twitter', twitter_base_url, { 'login': 'start' }, 'sekret',
+            tenant = 'b', tenants = tenants)
+
+        url = request.call_args[0][0]
+        self.assertEqual(parse_qs(urlparse(url).query)['oauth_consumer_key'],
+                         ['key-b'])
+
+
+class TestSessions(unittest.TestCase):
+    def test_returning_user(self):
+        sessions = socialauth.Sessions('sekret')
+        token    = sessions.encode('twitter', '987', 'test')
+        with patch('httplib2.Http.request') as request:
+            res = socialauth.http_get_provider(
+                'twitter', twitter_base_url, { 'login': 'start' }, 'sekret',
+                token, sessions = sessions)
+            self.assertFalse(request.called)
+
+        self.assertEqual(res['status'], 200)
+        self.assertEqual(res['provider_user_id'], '987')
+        self.assertEqual(res['provider_user_name'], 'test')
+        self.assertTrue(res['returning'])
+
+        # Reissued tokens keep the time of the provider sign-in.
+        session = sessions.decode(sessions.encode_result('twitter', res))
+        self.assertEqual(session['auth_time'], res['auth_time'])
+
+    @patch('httplib2.Http.request')
+    def test_falls_back_to_provider(self, request):
+        request.side_effect = lambda *a, **k: mock_valid_requests(None, *a, **k)
+        now      = time.time()
+        revoked  = set(['666'])
+        sessions = socialauth.Sessions(
+            'sekret', max_age = 3600, not_before = now - 7200,
+            revoked = lambda session: session['user_id'] in revoked)
+
+        for token in (None,
+                      'forged',
+                      socialauth.Sessions('other').encode('twitter', '987'),
+                      sessions.encode('facebook', '987'),
+                      sessions.encode('twitter', '987', auth_time = now - 4000),
+                      sessions.encode('twitter', '987', auth_time = now - 8000),
+                      sessions.encode('twitter', '666'),):
+            res = socialauth.http_get_provider(
+                'twitter', twitter_base_url, { 'login': 'start' }, 'sekret',
+                token, sessions = sessions)
+            self.assertEqual(res['status'], 302)
+
+        self.assertEqual(sessions.stats(), dict(returning = 0, rejected = 6))
+
+        # Only login=start is answered from the session.
+        with self.assertRaises(socialauth.InvalidUsage):
+            socialauth.http_get_provider(
+                'twitter', twitter_base_url, {}, 'sekret',
+                sessions.encode('twitter', '987'), sessions = sessions)
+
+    def test_bound_to_tenant_and_kind(self):
+        import json
+        tenants  = socialauth.Tenants(TestTenants.credentials)
+        sessions = socialauth.Sessions('sekret')
+        token    = sessions.encode('twitter', '987', tenant = 'a')
+        with patch('httplib2.Http.request') as request:
+            res = socialauth.http_get_provider(
+                'twitter', twitter_base_url, { 'login': 'start' }, 'sekret',
+                token, tenant = 'a', tenants = tenants, sessions = sessions)
+            self.assertFalse(request.called)
+        self.assertTrue(res['returning'])
+
+        self.assertIsNone(sessions.verify(token, 'twitter', tenant = 'b'))
+        self.assertIsNone(sessions.verify(token, 'twitter'))
+
+        # Other tokens signed with the secret are not sessions.
+        untyped = socialauth.StateCodec('sekret').encode(json.dumps(dict(
+            provider = 'twitter', user_id = '987')).encode('utf-8'))
+        self.assertIsNone(sessions.decode(untyped))
+
+    def test_expiry(self):
+        sessions = socialauth.Sessions('sekret', ttl = 60)
+        token    = sessions.encode('twitter', '987', now = time.time() - 61)
+        self.assertIsNone(sessions.decode(token))
+        self.assertIsNone(sessions.verify(token, 'twitter'))
+
+
+class TestWarmup(unittest.TestCase):
+    def test_warmup(self):
+        with FakeProviderServer() as server:
+            transport = server.transport()
+            report    = socialauth.warmup(transport = transport, connections = 2)
+            self.assertEqual(report['connect']['connections'],
+                             dict(twitter = 2, facebook = 2))
+            self.assertEqual(report['resolve']['addresses'],
+                             { '127.0.0.1': ['127.0.0.1'] })
+            self.assertIn('socialauth.providers.twitter',
+                          report['imports']['modules'])
+            # Both upstream hosts point at the one stand-in server.
+            self.assertEqual(transport.idle_count('127.0.0.1:{}'.format(
+                server.server_address[1])), 4)
+            self.assertGreaterEqual(report['seconds'],
+                                    report['connect']['seconds'])
+
+            connections = server.connections
+            socialauth.http_get_provider(
+                'facebook', facebook_base_url, { 'code': 'foo' }, 'sekret',
+                transport = transport)
+            self.assertEqual(server.connections, connections)
+            self.assertEqual(transport.created, 4)
+
+    def test_reports_failures(self):
+        with FakeProviderServer() as server:
+            hosts = dict(server.hosts, **{ 'api.twitter.com': 'http://127.0.0.1:1' })
+        report = socialauth.warmup(['twitter'],
+                                   transport = socialauth.Transport(hosts = hosts))
+        self.assertIn('twitter', report['connect']['errors'])
+        self.assertEqual(report['connect']['connections'], {})
+
+        with self.assertRaises(socialauth.InvalidUsage):
+            socialauth.warmup(['myspace'])
+
+    def test_async_warmup(self):
+        async def warm_then_login(server):
+            transport = server.transport(socialauth.AsyncTransport)
+            report    = await socialauth.async_warmup(transport = transport)
+            await socialauth.async_http_get_provider(
+                'facebook', facebook_base_url, { 'code': 'foo' }, 'sekret',
+                transport = transport)
+            return report, transport
+
+        with FakeProviderServer() as server:
+            report, transport = run_async(warm_then_login(server))
+            self.assertEqual(report['connect']['connections'],
+                             dict(twitter = 1, facebook = 1))
+            self.assertEqual(transport.created, 2)
+
+
+class TestStateCodec(unittest.TestCase):
+    def test_round_trip(self):
+        codec = socialauth.StateCodec('sekret')
+        token = codec.encode(b'oauth token secret')
+        self.assertNotIn('.', token)
+        self.assertNotIn('=', token)
+        self.assertEqual(codec.decode(token), b'oauth token secret')
+        self.assertEqual(socialauth.StateCodec(b'sekret').decode(token.encode()),
+                         b'oauth token secret')
+
+    def test_smaller_than_jwt(self):
+        secret  = 'Z6eEdO8MOmk394WozF5oKyuAv855l4Mlqo7hhlSLik'
+        legacy  = jwt.encode(
+            { 'data': { 'type': 'oauth_token_secret', 'id': secret } },
+            'sekret', algorithm = 'HS256')
+        compact = socialauth.StateCodec('sekret').encode(secret.encode())
+        self.assertLess(len(compact) * 2, len(legacy))
+
+    def test_expiry(self):
+        codec = socialauth.StateCodec('sekret', ttl = 60)
+        token = codec.encode(b'foo', now = 1000)
+        self.assertEqual(codec.decode(token, now = 1060), b'foo')
+        with self.assertRaisesRegex(socialauth.Error, 'Expired'):
+            codec.decode(token, now = 1061)
+
+    def test_rejects_tampering(self):
+        codec = socialauth.StateCodec('sekret')
+        token = codec.encode(b'foo')
+        with self.assertRaisesRegex(socialauth.Error, 'signature'):
+            socialauth.StateCodec('other').decode(token)
+
+        tampered = ('A' if token[8] != 'A' else 'B').join((token[:8], token[9:]))
+        with self.assertRaisesRegex(socialauth.Error, 'signature'):
+            codec.decode(tampered)
+
+        for token in ('', 'abc', 'a'):
+            with self.assertRaisesRegex(socialauth.Error, 'Malformed'):
+                codec.decode(token)
+
+    def test_cached_codec(self):
+        from socialauth.state import get_codec
+        self.assertIs(get_codec('sekret'), get_codec('sekret'))
+        self.assertIsNot(get_codec('sekret'), get_codec('sekret', ttl = 5))
+
+    def test_key_ring_rotation(self):
+        ring  = socialauth.KeyRing({ 'a': 'first' }, window = 60)
+        codec = socialauth.state.get_codec(ring)
+        old   = codec.encode(b'foo', now = 1000)
+        self.assertEqual(socialauth.state.token_kid(
+            socialauth.state.split_token(old)[0]), 'a')
+
+        ring.rotate('b', 'second', now = 1000)
+        new = codec.encode(b'bar', now = 1000)
+        self.assertEqual(codec.decode(old, now = 1030), b'foo')
+        self.assertEqual(codec.decode(new, now = 1030), b'bar')
+        self.assertEqual(socialauth.StateCodec('second').decode(new, 1030),
+                         b'bar')
+
+        with self.assertRaisesRegex(socialauth.Error, 'Retired'):
+            codec.decode(old, now = 1061)
+
+        ring.rotate('c', 'third', now = 1100)
+        self.assertEqual(sorted(ring.secrets), ['b', 'c'])
+        with self.assertRaisesRegex(socialauth.Error, 'Unknown state token key'):
+            codec.decode(old, now = 1100)
+
+    def test_key_ring_migration(self):
+        legacy = socialauth.StateCodec('sekret').encode(b'foo')
+        ring   = socialauth.KeyRing({ None: 'sekret', '2024': 'new' })
+        self.assertEqual(ring.current, '2024')
+        self.assertEqual(ring.decode(legacy), b'foo')
+
+        forged = socialauth.StateCodec('other', kid = '2024').encode(b'foo')
+        with self.assertRaisesRegex(socialauth.Error, 'signature'):
+            ring.decode(forged)
+
+        with self.assertRaisesRegex(socialauth.Error, 'No state token key'):
+            socialauth.KeyRing({ 'a': 'first' }, current = 'b')
+
+    @patch('httplib2.Http.request', mock_valid_requests)
+    def test_key_ring_login(self):
+        ring = socialauth.KeyRing({ 'a': 'first' })
+        res  = socialauth.http_get_provider(
+            'twitter', twitter_base_url, { 'login': 'start' }, ring)
+
+        ring.rotate('b', 'second')
+        args = { 'oauth_token': 'foo', 'oauth_verifier': 'foo' }
+        res  = socialauth.http_get_provider(
+            'twitter', twitter_base_url, args, ring, res['set_token_cookie'])
+        self.assertEqual(res['provider_user_id'], '987')
+
+    def test_benchmark(self):
+        from socialauth.bench import state
+        results = state.run(number = 10)
+        self.assertEqual(set(results), { 'StateCodec', 'PyJWT' })
+        for result in results.values():
+            self.assertGreater(result['ops_per_second'], 0)
+            self.assertGreater(result['token_bytes'], 0)
+
+
+class TestOAuth1(unittest.TestCase):
+    # RFC 5849, section 1.2.
+    photos_url = 'http://photos.example.net/photos?file=vacation.jpg&size=original'
+    photos_params = [
+        ('oauth_consumer_key',     'dpf43f3p2l4k3l03'),
+        ('oauth_token',            'nnch734d00sl2jdk'),
+        ('oauth_signature_method', 'HMAC-SHA1'),
+        ('oauth_timestamp',        '137131202'),
+        ('oauth_nonce',            'chapoH'),
+    ]
+
+    def test_rfc_signature(self):
+        from socialauth.oauth1 import Signer
+        signer = Signer('dpf43f3p2l4k3l03', 'kd94hf93k423kf44')
+        self.assertEqual(
+            signer.signature('GET', self.photos_url, self.photos_params,
+                             'pfkkdhi9sl3r4s00'),
+            'MdpQcU8iPSUjWoN/UDMsK2sui9I=')
+
+    def test_rfc_base_string(self):
+        # RFC 5849, section 3.4.1.1.
+        from socialauth.oauth1 import base_string
+        params = [
+            ('c2', ''), ('a3', '2 q'),
+            ('oauth_consumer_key',     '9djdj82h48djs9d2'),
+            ('oauth_token',            'kkk9d7dh3k39sjv7'),
+            ('oauth_signature_method', 'HMAC-SHA1'),
+            ('oauth_timestamp',        '137131201'),
+            ('oauth_nonce',            '7d8f3e4a'),
+        ]
+        self.assertEqual(
+            base_string('POST',
+                        'http://EXAMPLE.COM:80/request'
+                        '?b5=%3D%253D&a3=a&c%40=&a2=r%20b',
+                        params),
+            'POST&http%3A%2F%2Fexample.com%2Frequest&a2%3Dr%2520b%26a3%3D2%2520q'
+            '%26a3%3Da%26b5%3D%253D%25253D%26c%2540%3D%26c2%3D%26oauth_consumer_'
+            'key%3D9djdj82h48djs9d2%26oauth_nonce%3D7d8f3e4a%26oauth_signature_'
+            'method%3DHMAC-SHA1%26oauth_timestamp%3D137131201%26oauth_token%3D'
+            'kkk9d7dh3k39sjv7')
+
+    def test_escape(self):
+        from socialauth.oauth1 import escape
+        self.assertEqual(escape('abc-._~123'), 'abc-._~123')
+        self.assertEqual(escape('a b&c=d/e+f'), 'a%20b%26c%3Dd%2Fe%2Bf')
+        self.assertEqual(escape('\u00e9'), '%C3%A9')
+
+    def test_sign(self):
+        from socialauth.oauth1 import Signer
+        signer = Signer('key', 'secret')
+
+        url, method, body, headers = signer.sign(
+            'https://api.twitter.com/oauth/request_token?x=1')
+        params = parse_qs(urlparse(url).query)
+        self.assertEqual(params['x'], ['1'])
+        self.assertEqual(params['oauth_consumer_key'], ['key'])
+        self.assertIn('oauth_signature', params)
+        self.assertIsNone(body)
+
+        url, method, body, headers = signer.sign(
+            'https://api.twitter.com/oauth/access_token', 'POST',
+            'token', 'token secret', 'verifier')
+        params = parse_qs(body)
+        self.assertEqual(params['oauth_token'], ['token'])
+        self.assertEqual(params['oauth_verifier'], ['verifier'])
+        self.assertEqual(headers['Content-Type'],
+                         'application/x-www-form-urlencoded')
+
+    def test_matches_oauth2(self):
+        try:
+            import oauth2
+        except ImportError:
+            self.skipTest('oauth2 is not installed')
+
+        from socialauth.oauth1 import Signer
+        consumer = oauth2.Consumer('key', 'secret')
+        token    = oauth2.Token('token', 'token secret')
+        token.set_verifier('verifier')
+        req = oauth2.Request.from_consumer_and_token(
+            consumer,
+            token           = token,
+            http_method     = 'POST',
+            http_url        = 'https://api.twitter.com/oauth/access_token',
+            is_form_encoded = True)
+        req['oauth_timestamp'] = '1300000000'
+        req['oauth_nonce']     = 'nonce'
+        req.sign_request(oauth2.SignatureMethod_HMAC_SHA1(), consumer, token)
+
+        url, method, body, headers = Signer('key', 'secret').sign(
+            'https://api.twitter.com/oauth/access_token', 'POST',
+            'token', 'token secret', 'verifier',
+            timestamp = 1300000000, nonce = 'nonce')
+        self.assertEqual(parse_qs(body)['oauth_signature'],
+                         [req['oauth_signature'].decode('ascii')])
+
+
+def assert_excludes_forked_worker(test, lock, hold = 0.3):
+    '''Fork a worker that holds ``lock`` for ``hold`` seconds and check the
+    parent waits for it.'''
+    ready, signal = os.pipe()
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        try:
+            with lock:
+                os.write(signal, b'x')
+                time.sleep(hold)
+        finally:
+            os._exit(0)
+
+    os.close(signal)
+    os.read(ready, 1)
+    os.close(ready)
+    started = time.monotonic()
+    with lock:
+        waited = time.monotonic() - started
+    os.waitpid(pid, 0)
+    test.assertGreater(waited, hold / 2)
+
+
+class TestStateStores(unittest.TestCase):
+    def stores(self):
+        import tempfile
+        from socialauth import stores
+        directory = tempfile.mkdtemp()
+        return [
+            stores.MemoryStore(resolution = 0.01),
+            stores.SQLiteStore(),
+            stores.SQLiteStore(os.path.join(directory, 'state.db')),
+            stores.MmapStore(os.path.join(directory, 'state'), slots = 64),
+        ]
+
+    def test_take_once(self):
+        for store in self.stores():
+            key = store.put(b'secret', 60)
+            self.assertEqual(len(key), 22)
+            self.assertEqual(store.take(key), b'secret')
+            self.assertIsNone(store.take(key))
+            self.assertIsNone(store.take('A' * 22))
+            self.assertIsNone(store.take('unknown'))
+            store.close()
+
+    def test_expiry(self):
+        for store in self.stores():
+            key = store.put(b'secret', -1)
+            self.assertIsNone(store.take(key))
+            store.close()
+
+    def test_timer_wheel(self):
+        from socialauth.stores import MemoryStore
+        store = MemoryStore(resolution = 0.01, wheel_size = 8)
+        store.put(b'short', 0.01)
+        long_lived = store.put(b'long', 0.2)
+        time.sleep(0.05)
+        store.put(b'new', 60)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.take(long_lived), b'long')
+
+    def test_mmap_shared(self):
+        import tempfile
+        from socialauth.stores import MmapStore
+        path  = os.path.join(tempfile.mkdtemp(), 'state')
+        first = MmapStore(path, slots = 4, value_size = 8, probes = 1)
+        other = MmapStore(path, slots = 4, value_size = 8, probes = 1)
+        self.assertEqual(other.take(first.put(b'12345678', 60)), b'12345678')
+
+        with self.assertRaises(socialauth.Error):
+            first.put(b'123456789', 60)
+        with self.assertRaises(socialauth.Error):
+            MmapStore(path, slots = 8, value_size = 8)
+        with self.assertRaises(socialauth.Error):
+            for i in range(5):
+                first.put(b'x', 60)
+
+        first.close()
+        other.close()
+
+    def test_mmap_excludes_forked_workers(self):
+        import tempfile
+        from socialauth.stores import MmapStore
+        store = MmapStore(os.path.join(tempfile.mkdtemp(), 'state'), slots = 4)
+        store.put(b'secret', 60)
+        assert_excludes_forked_worker(self, store.locked())
+        store.close()
+
+    @patch('httplib2.Http.request', mock_valid_requests)
+    def test_twitter_flow(self):
+        from socialauth.stores import MemoryStore
+        registry = socialauth.ProviderRegistry(environ = credentials)
+        registry.configure(state_store = MemoryStore())
+
+        res = registry.http_get_provider(
+            'twitter', twitter_base_url, { 'login': 'start' }, 'sekret')
+        self.assertEqual(len(res['set_token_cookie']), 22)
+        self.assertEqual(len(registry['twitter'].state_store), 1)
+
+        args = { 'oauth_token': 'foo', 'oauth_verifier': 'foo' }
+        res  = registry.http_get_provider(
+            'twitter', twitter_base_url, args, 'sekret', res['set_token_cookie'])
+        self.assertEqual(res['provider_user_id'], '987')
+
+        with self.assertRaises(socialauth.Error):
+            registry.http_get_provider(
+                'twitter', twitter_base_url, args, 'sekret', 'A' * 22)
+
+        # Cookies issued before the store was configured remain valid.
+        cookie = socialauth.StateCodec('sekret').encode(b'bar')
+        res    = registry.http_get_provider(
+            'twitter', twitter_base_url, args, 'sekret', cookie)
+        self.assertEqual(res['provider_user_id'], '987')
+
+
+class TestRequestTokenPool(unittest.TestCase):
+    def config(self):
+        return socialauth.providers.TwitterConfig('foobar', 'foobar')
+
+    @patch('httplib2.Http.request', mock_valid_requests)
+    def test_pop(self):
+        pool = socialauth.RequestTokenPool(self.config(), size = 2)
+        self.assertIsNone(pool.pop())
+        for i in range(3):
+            pool.fill()
+
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(pool.pop(), ('foo', 'bar'))
+        self.assertEqual(pool.stats(), dict(
+            size = 1, hits = 1, misses = 1, expired = 0, refills = 3, errors = 0))
+
+    @patch('httplib2.Http.request', mock_valid_requests)
+    def test_ttl(self):
+        pool = socialauth.RequestTokenPool(self.config(), ttl = -1)
+        pool.fill()
+        self.assertIsNone(pool.pop())
+        self.assertEqual(pool.expired, 1)
+        self.assertEqual(pool.misses, 1)
+
+    def test_twitter_start_uses_pool(self):
+        config = self.config()
+        pool   = socialauth.RequestTokenPool(config)
+        pool._tokens.append((time.monotonic(), ('pooled', 'secret'),))
+        config.prefetcher = pool
+
+        with patch('httplib2.Http.request',
+                   mock_request_with('request_token', 500)):
+            provider = socialauth.providers.Twitter(
+                twitter_base_url, { 'login': 'start' }, 'sekret', None,
+                config = config)
+            self.assertTrue(provider.redirect.endswith('oauth_token=pooled'))
+
+            # An empty pool falls back to a live call.
+            with self.assertRaisesRegex(socialauth.Error, '500 from Twitter'):
+                socialauth.providers.Twitter(
+                    twitter_base_url, { 'login': 'start' }, 'sekret', None,
+                    config = config)
+
+        self.assertEqual((pool.hits, pool.misses), (1, 1))
+
+    def test_background_refill(self):
+        from socialauth.prefetch import prefetch
+        config = socialauth.providers.TwitterConfig('prefetch-test', 'foobar')
+        with FakeProviderServer() as server:
+            pool = prefetch(config, transport = server.transport(),
+                            size = 3, min_interval = 0.01)
+            try:
+                self.assertIs(config.prefetcher, pool)
+                self.assertIs(prefetch(config, start = False), pool)
+
+                deadline = time.monotonic() + 5
+                while len(pool) < 3 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+
+                self.assertEqual(len(pool), 3)
+                self.assertIsNotNone(pool.pop())
+
+                while len(pool) < 3 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+
+                self.assertEqual(pool.refills, 4)
+            finally:
+                pool.stop()
+
+    def test_refill_errors_back_off(self):
+        config = self.config()
+        with patch('httplib2.Http.request',
+                   mock_request_with('request_token', 500)):
+            pool = socialauth.RequestTokenPool(config, min_interval = 0.01,
+                                               max_backoff = 0.02).start()
+            time.sleep(0.1)
+            pool.stop()
+
+        self.assertGreater(pool.errors, 0)
+        self.assertLess(pool.errors, 10)
+        self.assertEqual(len(pool), 0)
+
+
+class TestBench(unittest.TestCase):
+    def test_percentile(self):
+        from socialauth.bench.load import percentile
+        ordered = list(range(1, 101))
+        self.assertEqual(percentile(ordered, 0.50), 50)
+        self.assertEqual(percentile(ordered, 0.95), 95)
+        self.assertEqual(percentile(ordered, 0.99), 99)
+        self.assertEqual(percentile([7], 0.99), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_load(self):
+        from socialauth.bench import load
+        for provider in ('twitter', 'facebook'):
+            with FakeProviderServer() as server:
+                report = load.run(provider, logins = 20, concurrency = 4,
+                                  transport = server.transport())
+
+            self.assertEqual(report['login']['count'], 20)
+            self.assertEqual(report['login']['errors'], 0)
+            self.assertGreater(report['start']['throughput'], 0)
+            self.assertLessEqual(report['finish']['p50'], report['finish']['p99'])
+            self.assertLessEqual(server.connections, 4)
+            self.assertIn('p99 ms', load.format_report(report))
+
+    def test_fault_injection(self):
+        from socialauth.bench import load
+        with FakeProviderServer(latency = 0.01, error_rate = 1.0) as server:
+            report = load.run('facebook', logins = 5, concurrency = 5,
+                              transport = server.transport())
+
+        self.assertEqual(report['login']['count'], 0)
+        self.assertEqual(report['login']['errors'], 5)
+        self.assertEqual(server.requests, 5)
+
+
+class TestLazyImports(unittest.TestCase):
+    def test_bare_import_loads_no_dependencies(self):
+        from socialauth.bench import imports
+        result = imports.measure('socialauth')
+        self.assertEqual(result['loaded'], [])
+
+    def test_provider_loads_only_its_dependencies(self):
+        from socialauth.bench import imports
+        result = imports.measure('socialauth.providers.facebook')
+        self.assertNotIn('oauth2', result['loaded'])
+        self.assertNotIn('jwt', result['loaded'])
+
+    def test_attributes(self):
+        from socialauth.providers import facebook
+        self.assertIs(socialauth.providers.Facebook, facebook.Facebook)
+        self.assertIs(socialauth.StateCodec, socialauth.state.StateCodec)
+        self.assertIn('ProviderRegistry', dir(socialauth))
+        with self.assertRaises(AttributeError):
+            socialauth.Nonexistent
+
+
+class RecordingInstrumentation(socialauth.Instrumentation):
+    def __init__(self):
+        self.spans    = []
+        self.counters = []
+
+    def record(self, name, seconds, error = None, **tags):
+        self.spans.append((name, error, tags))
+
+    def count(self, name, value = 1, **tags):
+        self.counters.append((name, value, tags))
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.recorder = RecordingInstrumentation()
+        socialauth.set_instrumentation(self.recorder)
+
+    def tearDown(self):
+        socialauth.set_instrumentation(None)
+
+    def span_names(self):
+        return [span[0] for span in self.recorder.spans]
+
+    def test_null_default(self):
+        from socialauth.instrumentation import NullInstrumentation, NULL_SPAN
+        socialauth.set_instrumentation(None)
+        instrumentation = socialauth.get_instrumentation()
+        self.assertIsInstance(instrumentation, NullInstrumentation)
+        self.assertIs(instrumentation.span('twitter.sign'), NULL_SPAN)
+
+    @patch('httplib2.Http.request', mock_valid_requests)
+    def test_twitter_spans(self):
+        res = socialauth.http_get_provider(
+            'twitter', twitter_base_url, { 'login': 'start' }, 'sekret')
+        self.assertEqual(self.span_names(), [
+            'twitter.sign', 'twitter.request_token', 'twitter.state_encode',
+            'twitter.start',
+        ])
+
+        self.recorder.spans = []
+        args = { 'oauth_token': 'foo', 'oauth_verifier': 'foo' }
+        socialauth.http_get_provider(
+            'twitter', twitter_base_url, args, 'sekret', res['set_token_cookie'])
+        self.assertEqual(self.span_names(), [
+            'twitter.state_decode', 'twitter.sign', 'twitter.access_token',
+            'twitter.finish',
+        ])
+        self.assertEqual(self.recorder.counters, [
+            ('twitter.status', 1, dict(endpoint = 'request_token', status = 200)),
+            ('twitter.status', 1, dict(endpoint = 'access_token', status = 200)),
+        ])
+
+    @patch('httplib2.Http.request', mock_request_with('/me', 400))
+    def test_errors(self):
+        with self.assertRaises(socialauth.Error):
+            socialauth.http_get_provider(
+                'facebook', facebook_base_url, { 'code': 'foo' }, 'sekret')
+
+        self.assertEqual(self.recorder.spans, [
+            ('facebook.access_token', None, {}),
+            ('facebook.user_information', 'Error', {}),
+            ('facebook.finish', 'Error', {}),
+        ])
+        self.assertEqual(self.recorder.counters[-1], (
+            'facebook.status', 1, dict(endpoint = 'user_information', status = 400)))
+
+    @patch('httplib2.Http.request', mock_valid_requests)
+    def test_config_override(self):
+        socialauth.set_instrumentation(None)
+        registry = socialauth.ProviderRegistry(environ = credentials)
+        registry['facebook'].instrumentation = self.recorder
+        registry.http_get_provider(
+            'facebook', facebook_base_url, { 'code': 'foo' }, 'sekret')
+        self.assertEqual(self.span_names(), [
+            'facebook.access_token', 'facebook.user_information',
+            'facebook.finish',
+        ])
+
+    def test_async_spans(self):
+        with FakeProviderServer() as server:
+            run_async(socialauth.async_http_get_provider(
+                'twitter', twitter_base_url, { 'login': 'start' }, 'sekret',
+                transport = server.transport(socialauth.AsyncTransport)))
+
+        self.assertEqual(self.span_names(), [
+            'twitter.sign', 'twitter.request_token', 'twitter.state_encode',
+            'twitter.start',
+        ])
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_after_failures(self):
+        breaker = socialauth.CircuitBreaker('test', failure_threshold = 2,
+                                            reset_timeout = 60)
+        for i in range(2):
+            with self.assertRaises(ValueError):
+                with breaker.guard():
+                    raise ValueError()
+
+        self.assertEqual(breaker.state, 'open')
+        with self.assertRaisesRegex(socialauth.CircuitOpenError,
+                                    'test circuit is open') as cm:
+            with breaker.guard():
+                self.fail('Called through an open circuit')
+
+        self.assertIsInstance(cm.exception, socialauth.Error)
+        self.assertGreater(cm.exception.retry_after, 0)
+        self.assertEqual(breaker.stats(), dict(state = 'open', failures = 2,
+                                               rejected = 1))
+
+    def test_success_resets_failures(self):
+        breaker = socialauth.CircuitBreaker(failure_threshold = 2)
+        breaker.failure()
+        with breaker.guard() as upstream:
+            upstream.observe(httplib2.Response(dict(status = 404)))
+
+        breaker.failure()
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_server_errors_and_latency_are_failures(self):
+        breaker = socialauth.CircuitBreaker(failure_threshold = 1)
+        with breaker.guard() as upstream:
+            upstream.observe(httplib2.Response(dict(status = 503)))
+
+        self.assertEqual(breaker.state, 'open')
+
+        breaker = socialauth.CircuitBreaker(failure_threshold = 1,
+                                            latency_threshold = 0.01)
+        with breaker.guard():
+            time.sleep(0.02)
+
+        self.assertEqual(breaker.state, 'open')
+
+    def test_half_open(self):
+        breaker = socialauth.CircuitBreaker(failure_threshold = 1,
+                                            reset_timeout = 0)
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+
+        # One probe at a time while half-open.
+        breaker.before()
+        self.assertEqual(breaker.state, 'half-open')
+        with self.assertRaises(socialauth.CircuitOpenError):
+            breaker.before()
+
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+
+        with breaker.guard():
+            pass
+
+        self.assertEqual(breaker.state, 'closed')
+
+    @patch('httplib2.Http.request', mock_request_with('/me', 500))
+    def test_provider_fails_fast(self):
+        breakers = socialauth.CircuitBreakers(failure_threshold = 2,
+                                              reset_timeout = 60)
+        registry = socialauth.ProviderRegistry(environ = credentials)
+        registry.configure(breakers = breakers)
+        self.assertIs(registry['twitter'].breakers, breakers)
+
+        def login():
+            return registry.http_get_provider(
+                'facebook', facebook_base_url, { 'code': 'foo' }, 'sekret')
+
+        for i in range(2):
+            with self.assertRaisesRegex(socialauth.Error, '500 from Facebook'):
+                login()
+
+        with patch('httplib2.Http.request') as request:
+            request.side_effect = lambda *args, **kwargs: \
+                mock_valid_requests(None, *args, **kwargs)
+            with self.assertRaises(socialauth.CircuitOpenError):
+                login()
+
+            self.assertEqual(request.call_count, 1)
+
+        self.assertEqual(breakers.states(), {
+            'facebook.access_token': 'closed',
+            'facebook.user_information': 'open',
+        })
+
+
+class TestHedging(unittest.TestCase):
+    def sender(self, delays, errors = ()):
+        calls = []
+
+        def send():
+            calls.append(len(calls))
+            index = calls[-1]
+            time.sleep(delays[index])
+            if index in errors:
+                raise socialauth.Error('failed {}'.format(index))
+            return index
+
+        return (send, calls,)
+
+    def test_histogram(self):
+        from socialauth.hedge import LatencyHistogram
+        histogram = LatencyHistogram(window = 60.0, slices = 6)
+        for ms in range(1, 101):
+            histogram.record(ms / 1000.0, now = 100.0)
+
+        seconds, samples = histogram.quantile(0.95, now = 100.0)
+        self.assertEqual(samples, 100)
+        self.assertGreaterEqual(seconds, 0.095)
+        self.assertLessEqual(seconds, 0.095 * histogram.growth)
+
+        # Latencies age out with their slice of the window.
+        self.assertEqual(histogram.quantile(0.95, now = 155.0)[1], 100)
+        self.assertEqual(histogram.quantile(0.95, now = 161.0), (None, 0,))
+
+    def test_adaptive_delay(self):
+        from socialauth.hedge import Hedger
+        hedger    = Hedger(min_samples = 10, min_delay = 0.001, max_delay = 0.5)
+        histogram = hedger.histogram('facebook', 'user_information')
+        self.assertEqual(hedger.delay(histogram), 0.5)
+        for _ in range(20):
+            histogram.record(0.01)
+        self.assertLess(hedger.delay(histogram), 0.02)
+
+    def test_hedge_wins(self):
+        from socialauth.hedge import Hedger
+        hedger      = Hedger(max_delay = 0.02)
+        send, calls = self.sender([0.5, 0.0])
+        began = time.monotonic()
+        self.assertEqual(hedger.request('twitter', 'request_token', send), 1)
+        self.assertLess(time.monotonic() - began, 0.4)
+        self.assertEqual(hedger.stats(),
+                         dict(requests = 1, hedged = 1, wins = 1, denied = 0))
+
+        send, calls = self.sender([0.0])
+        self.assertEqual(hedger.request('twitter', 'request_token', send), 0)
+        self.assertEqual(len(calls), 1)
+        hedger.close()
+
+    def test_budget(self):
+        from socialauth.hedge import Hedger
+        hedger      = Hedger(max_delay = 0.01, budget = 0.0, burst = 0.0)
+        send, calls = self.sender([0.05, 0.0])
+        self.assertEqual(hedger.request('twitter', 'request_token', send), 0)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(hedger.stats()['denied'], 1)
+        hedger.close()
+
+    def test_errors(self):
+        from socialauth.hedge import Hedger
+        hedger      = Hedger(max_delay = 0.01)
+        send, calls = self.sender([0.05, 0.0], errors = (1,))
+        self.assertEqual(hedger.request('twitter', 'request_token', send), 0)
+
+        send, calls = self.sender([0.05, 0.0], errors = (0, 1,))
+        with self.assertRaisesRegex(socialauth.Error, 'failed'):
+            hedger.request('twitter', 'request_token', send)
+        hedger.close()
+
+    def test_async_hedge_wins(self):
+        from socialauth.hedge import Hedger
+        hedger    = Hedger(max_delay = 0.02)
+        cancelled = []
+
+        async def send():
+            first = not cancelled
+            cancelled.append(False)
+            try:
+                await asyncio.sleep(0.5 if first else 0.0)
+            except asyncio.CancelledError:
+                cancelled[0] = True
+                raise
+            return 'slow' if first else 'fast'
+
+        async def request():
+            result = await hedger.async_request('facebook', 'me', send)
+            await asyncio.sleep(0)
+            return result
+
+        self.assertEqual(run_async(request()), 'fast')
+        self.assertEqual(cancelled, [True, False])
+        self.assertEqual(hedger.stats()['wins'], 1)
+
+        # The cancelled copy's latency is kept, as a lower bound.
+        histogram = hedger.histogram('facebook', 'me')
+        self.assertEqual(histogram.quantile(0.5)[1], 2)
+
+    def test_saturated_pool(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from socialauth.hedge import Hedger
+        hedger = Hedger(max_delay = 0.2, max_workers = 2)
+
+        def request(i):
+            began = time.monotonic()
+            hedger.request('facebook', 'me', lambda: time.sleep(0.1))
+            return time.monotonic() - began
+
+        with ThreadPoolExecutor(max_workers = 8) as executor:
+            latencies = list(executor.map(request, range(8)))
+
+        # Callers beyond the pool run unhedged rather than queue for it.
+        self.assertEqual(hedger.stats()['hedged'], 0)
+        self.assertLess(max(latencies), 0.19)
+        hedger.close()
+
+    def test_providers(self):
+        from socialauth.hedge import Hedger
+        hedger = Hedger(max_delay = 0.01)
+        with FakeProviderServer(latency = 0.03) as server:
+            registry = socialauth.ProviderRegistry(
+                environ = credentials, transport = server.transport())
+            registry.configure(hedger = hedger)
+
+            res = registry.http_get_provider(
+                'facebook', facebook_base_url, { 'code': 'foo' }, 'sekret')
+            self.assertEqual(res['provider_user_id'], '987')
+            self.assertEqual(hedger.stats()['requests'], 1)
+            self.assertEqual(list(hedger.histograms),
+                             [('facebook', 'user_information',)])
+
+            res = registry.http_get_provider(
+                'twitter', twitter_base_url, { 'login': 'start' }, 'sekret')
+            self.assertEqual(res['status'], 302)
+            self.assertEqual(hedger.stats()['hedged'], 2)
+
+        hedger.close()
+
+    def test_copies_are_signed_afresh(self):
+        from socialauth.hedge import Hedger, hedged
+
+        class SlowFirst:
+            def __init__(self):
+                self.urls = []
+
+            def request(self, url, method = 'GET', body = None, headers = None):
+                self.urls.append(url)
+                time.sleep(0.2 if len(self.urls) == 1 else 0.0)
+                return (httplib2.Response(dict(status = 200)), b'')
+
+        config    = socialauth.providers.TwitterConfig('key', 'secret')
+        transport = SlowFirst()
+        hedger    = Hedger(max_delay = 0.01)
+        hedged(hedger, 'twitter', 'request_token', transport,
+               lambda: config.sign(config.request_token_url, 'GET'))
+        hedger.close()
+
+        nonces = [parse_qs(urlparse(url).query)['oauth_nonce'][0]
+                  for url in transport.urls]
+        self.assertEqual(len(set(nonces)), 2)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_token_bucket(self):
+        from socialauth.ratelimit import RateLimiter, RateLimited
+        limiter = RateLimiter(rate = 1, burst = 2)
+        limiter.acquire('twitter', 'key')
+        limiter.acquire('twitter', 'key')
+        with self.assertRaises(RateLimited) as cm:
+            limiter.acquire('twitter', 'key')
+        self.assertAlmostEqual(cm.exception.retry_after, 1.0, places = 1)
+
+        limiter.acquire('twitter', 'other key')
+        self.assertEqual(limiter.stats(),
+                         dict(admitted = 3, queued = 0, rejected = 1))
+
+    def test_queue(self):
+        from socialauth.ratelimit import RateLimiter, RateLimited
+        limiter = RateLimiter(rate = 100, burst = 1, queue = True,
+                              max_wait = 0.025)
+        self.assertEqual(limiter.reserve('facebook', 'app'), 0.0)
+        self.assertAlmostEqual(limiter.reserve('facebook', 'app'), 0.01, places = 2)
+        self.assertAlmostEqual(limiter.reserve('facebook', 'app'), 0.02, places = 2)
+        with self.assertRaises(RateLimited):
+            limiter.reserve('facebook', 'app')
+
+        began = time.monotonic()
+        run_async(RateLimiter(rate = 100, burst = 1, queue = True).async_acquire(
+            'facebook', 'app'))
+        self.assertLess(time.monotonic() - began, 0.1)
+
+    def test_learns_twitter_headers(self):
+        from socialauth.ratelimit import RateLimiter, RateLimited
+        limiter = RateLimiter()
+        limiter.observe('twitter', 'key', httplib2.Response({
+            'status': 200,
+            'x-rate-limit-remaining': '0',
+            'x-rate-limit-reset': str(int(time.time()) + 60),
+        }))
+        with self.assertRaises(RateLimited) as cm:
+            limiter.acquire('twitter', 'key')
+        self.assertGreater(cm.exception.retry_after, 55)
+
+        limiter.observe('twitter', 'other', httplib2.Response({
+            'status': 200, 'x-rate-limit-remaining': '1' }))
+        limiter.acquire('twitter', 'other')
+        with self.assertRaises(RateLimited):
+            limiter.acquire('twitter', 'other')
+
+    def test_learns_app_usage(self):
+        from socialauth.ratelimit import RateLimiter, RateLimited
+        limiter = RateLimiter(cooldown = 30)
+        limiter.observe('facebook', 'app', httplib2.Response({
+            'status': 200,
+            'x-app-usage': '{"call_count":100,"total_time":20,"total_cputime":5}',
+        }))
+        with self.assertRaises(RateLimited) as cm:
+            limiter.acquire('facebook', 'app')
+        self.assertAlmostEqual(cm.exception.retry_after, 30, places = 0)
+
+        limiter.observe('facebook', 'other', httplib2.Response({
+            'status': 429, 'retry-after': '5' }))
+        with self.assertRaises(RateLimited) as cm:
+            limiter.acquire('facebook', 'other')
+        self.assertAlmostEqual(cm.exception.retry_after, 5, places = 0)
+
+        limiter.observe('facebook', 'app', httplib2.Response({ 'status': 200 }))
+
+    def test_recovers_from_full_app_usage(self):
+        from socialauth.ratelimit import RateLimiter, RateLimited, SCALE
+        limiter = RateLimiter(rate = 100, burst = 1, cooldown = 0.05)
+        limiter.acquire('facebook', 'app')
+        limiter.observe('facebook', 'app', httplib2.Response({
+            'status': 200, 'x-app-usage': '{"call_count":100}' }))
+        with self.assertRaises(RateLimited):
+            limiter.acquire('facebook', 'app')
+
+        time.sleep(0.1)
+        limiter.acquire('facebook', 'app')
+        self.assertEqual(limiter.buckets.states[('facebook', 'app',)][SCALE], 1.0)
+
+    def test_shared_buckets(self):
+        import tempfile
+        from socialauth.ratelimit import RateLimiter, RateLimited, SharedBuckets
+        path   = os.path.join(tempfile.mkdtemp(), 'limits')
+        first  = RateLimiter(rate = 0.001, burst = 2, buckets = SharedBuckets(path))
+        second = RateLimiter(rate = 0.001, burst = 2, buckets = SharedBuckets(path))
+        first.acquire('twitter', 'key')
+        second.acquire('twitter', 'key')
+        with self.assertRaises(RateLimited):
+            first.acquire('twitter', 'key')
+
+        with self.assertRaises(socialauth.Error):
+            SharedBuckets(path, slots = 8)
+
+        first.buckets.close()
+        second.buckets.close()
+
+    def test_shared_buckets_exclude_forked_workers(self):
+        import tempfile
+        from socialauth.ratelimit import RateLimiter, SharedBuckets
+        path    = os.path.join(tempfile.mkdtemp(), 'limits')
+        limiter = RateLimiter(buckets = SharedBuckets(path))
+        limiter.acquire('twitter', 'key')
+        assert_excludes_forked_worker(self, limiter.buckets.file_lock)
+        limiter.buckets.close()
+
+    def test_concurrent_stats(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from socialauth.ratelimit import RateLimiter, RateLimited
+        limiter = RateLimiter(rate = 0.001, burst = 500)
+
+        def call(i):
+            try:
+                limiter.reserve('twitter', 'key')
+            except RateLimited:
+                pass
+
+        with ThreadPoolExecutor(max_workers = 8) as executor:
+            list(executor.map(call, range(1000)))
+
+        stats = limiter.stats()
+        self.assertEqual((stats['admitted'], stats['rejected'],), (500, 500,))
+
+    def test_rejects_before_network(self):
+        from socialauth.ratelimit import RateLimiter, RateLimited
+        with FakeProviderServer() as server:
+            registry = socialauth.ProviderRegistry(
+                environ = credentials, transport = server.transport())
+            registry.configure(rate_limiter = RateLimiter(rate = 0.001, burst = 2))
+            registry.http_get_provider(
+                'facebook', facebook_base_url, { 'code': 'foo' }, 'sekret')
+            with self.assertRaises(RateLimited):
+                registry.http_get_provider(
+                    'facebook', facebook_base_url, { 'code': 'foo' }, 'sekret')
+
+        self.assertEqual(server.requests, 2)
+
+
+class TestTTLCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = socialauth.TTLCache(maxsize = 2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), dict(
+            size = 2, hits = 3, misses = 1, evictions = 1, expirations = 0))
+
+    def test_expiry(self):
+        cache = socialauth.TTLCache(ttl = -1)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl = 60)
+        self.assertEqual(cache.get('a', 'gone'), 'gone')
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.expirations, 1)
+
+        self.assertEqual(cache.pop('b'), 2)
+        self.assertIsNone(cache.pop('b'))
+        self.assertEqual(len(cache), 0)
+
+    def test_hash_key(self):
+        from socialauth.cache import hash_key
+        self.assertEqual(len(hash_key('token')), 32)
+        self.assertEqual(hash_key('token'), hash_key(b'token'))
+        self.assertNotEqual(hash_key('ab', 'c'), hash_key('a', 'bc'))
+
+
+class TestProfileCache(unittest.TestCase):
+    def test_hit_skips_graph_me(self):
+        registry = socialauth.ProviderRegistry(environ = credentials)
+        registry['facebook'].profile_cache = cache = socialauth.TTLCache()
+
+        with patch('httplib2.Http.request') as request:
+            request.side_effect = lambda *args, **kwargs: \
+                mock_valid_requests(None, *args, **kwargs)
+            for i in range(3):
+                res = registry.http_get_provider(
+                    'facebook', facebook_base_url, { 'code': 'foo' }, 'sekret')
+                self.assertEqual(res['provider_user_id'], '987')
+                self.assertEqual(res['provider_user_name'], 'test')
+
+            paths = [urlparse(call[0][0])[2] for call in request.call_args_list]
+
+        self.assertEqual(paths.count('/me'), 1)
+        self.assertEqual(len(paths), 4)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_async_hit(self):
+        registry = socialauth.ProviderRegistry(environ = credentials)
+        registry['facebook'].profile_cache = socialauth.TTLCache()
+
+        async def login():
+            for i in range(2):
+                res = await registry.async_http_get_provider(
+                    'facebook', facebook_base_url, { 'code': 'foo' }, 'sekret')
+
+            return res
+
+        with FakeProviderServer() as server:
+            registry.async_transport = server.transport(socialauth.AsyncTransport)
+            res = run_async(login())
+
+        self.assertEqual(res['provider_user_id'], '987')
+        self.assertEqual(server.requests, 3)
+
+
+class TestRejectedCache(unittest.TestCase):
+    def test_replayed_code(self):
+        with FakeProviderServer() as server:
+            registry = socialauth.ProviderRegistry(
+                environ         = credentials,
+                transport       = server.transport(),
+                async_transport = server.transport(socialauth.AsyncTransport))
+            registry.configure(rejected_cache = socialauth.TTLCache())
+
+            with self.assertRaisesRegex(socialauth.Error, '400 from Facebook'):
+                registry.http_get_provider(
+                    'facebook', facebook_base_url, { 'code': 'bad' }, 'sekret')
+
+            with self.assertRaisesRegex(socialauth.Error, 'already rejected'):
+                registry.http_get_provider(
+                    'facebook', facebook_base_url, { 'code': 'bad' }, 'sekret')
+
+            with self.assertRaisesRegex(socialauth.Error, 'already rejected'):
+                run_async(registry.async_http_get_provider(
+                    'facebook', facebook_base_url, { 'code': 'bad' }, 'sekret'))
+
+            res = registry.http_get_provider(
+                'facebook', facebook_base_url, { 'code': 'foo' }, 'sekret')
+            self.assertEqual(res['provider_user_id'], '987')
+            self.assertEqual(server.requests, 3)
+
+        stats = registry['facebook'].rejected_cache.stats()
+        self.assertEqual((stats['size'], stats['hits'],), (1, 2,))
+
+    def test_server_errors_not_remembered(self):
+        registry = socialauth.ProviderRegistry(environ = credentials)
+        registry.configure(rejected_cache = socialauth.TTLCache())
+        args  = { 'oauth_token': 'foo', 'oauth_verifier': 'foo' }
+        token = socialauth.StateCodec('sekret').encode(b'bar')
+        for status, size in ((500, 0,), (401, 1,)):
+            with patch('httplib2.Http.request',
+                       mock_request_with('access_token', status)):
+                with self.assertRaisesRegex(socialauth.Error, 'from Twitter'):
+                    registry.http_get_provider(
+                        'twitter', twitter_base_url, args, 'sekret', token)
+
+            self.assertEqual(len(registry['twitter'].rejected_cache), size)
+
+    def test_throttling_not_remembered(self):
+        registry = socialauth.ProviderRegistry(environ = credentials)
+        registry.configure(rejected_cache = socialauth.TTLCache())
+        throttled = b'{"error":{"type":"OAuthException","code":4}}'
+        invalid   = b'{"error":{"type":"OAuthException","code":100}}'
+        for status, body, size in ((429, invalid, 0,), (400, throttled, 0,),
+                                   (400, invalid, 1,),):
+            with patch('httplib2.Http.request',
+                       mock_request_with('access_token', status, body)):
+                with self.assertRaisesRegex(socialauth.Error, 'from Facebook'):
+                    registry.http_get_provider(
+                        'facebook', facebook_base_url, { 'code': 'foo' },
+                        'sekret')
+
+            self.assertEqual(len(registry['facebook'].rejected_cache), size)
+
+    def test_replay_with_another_cookie(self):
+        registry = socialauth.ProviderRegistry(environ = credentials)
+        registry.configure(rejected_cache = socialauth.TTLCache())
+        args   = { 'oauth_token': 'foo', 'oauth_verifier': 'foo' }
+        forged = socialauth.StateCodec('sekret').encode(b'wrong')
+        with patch('httplib2.Http.request',
+                   mock_request_with('access_token', 401)):
+            with self.assertRaisesRegex(socialauth.Error, '401 from Twitter'):
+                registry.http_get_provider(
+                    'twitter', twitter_base_url, args, 'sekret', forged)
+
+        with patch('httplib2.Http.request', mock_valid_requests):
+            token = socialauth.StateCodec('sekret').encode(b'bar')
+            res   = registry.http_get_provider(
+                'twitter', twitter_base_url, args, 'sekret', token)
+
+        self.assertEqual(res['provider_user_id'], '987')
+
+    def test_rejected_replay_keeps_stored_state(self):
+        from socialauth.cache import hash_key
+        from socialauth.stores import MemoryStore
+        registry = socialauth.ProviderRegistry(environ = credentials)
+        registry.configure(rejected_cache = socialauth.TTLCache(),
+                           state_store    = MemoryStore())
+        config = registry['twitter']
+        token  = config.state_store.put(b'secret', 60)
+        config.rejected_cache.set(hash_key('twitter', 'foo', 'bar', token), True)
+        args   = { 'oauth_token': 'foo', 'oauth_verifier': 'bar' }
+        with self.assertRaisesRegex(socialauth.ClientError, 'already rejected'):
+            registry.http_get_provider(
+                'twitter', twitter_base_url, args, 'sekret', token)
+
+        self.assertEqual(len(config.state_store), 1)
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_calls_share_one(self):
+        from concurrent.futures import ThreadPoolExecutor
+        flight = socialauth.SingleFlight()
+        calls  = []
+
+        def work():
+            calls.append(1)
+            time.sleep(0.05)
+            return { 'status': 200 }
+
+        with ThreadPoolExecutor(max_workers = 5) as executor:
+            results = list(executor.map(lambda i: flight.do('key', work), range(5)))
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{ 'status': 200 }] * 5)
+        self.assertIsNot(results[0], results[1])
+
+        # Near-simultaneous duplicates reuse the finished outcome.
+        self.assertEqual(flight.do('key', work), { 'status': 200 })
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.shared, 5)
+
+    def test_errors_are_shared(self):
+        flight = socialauth.SingleFlight()
+
+        def fail():
+            raise socialauth.Error('400 from Facebook')
+
+        for i in range(2):
+            with self.assertRaisesRegex(socialauth.Error, '400 from Facebook'):
+                flight.do('key', fail)
+
+        self.assertEqual(flight.shared, 1)
+
+    def test_expiry(self):
+        flight = socialauth.SingleFlight(ttl = -1)
+        self.assertEqual(flight.do('key', lambda: 1), 1)
+        self.assertEqual(flight.do('key', lambda: 2), 2)
+
+    def test_callback_key(self):
+        from socialauth.singleflight import callback_key
+        self.assertIsNone(callback_key('twitter', { 'login': 'start' }))
+        self.assertIsNone(callback_key('twitter', { 'oauth_token': 'foo' }))
+        self.assertEqual(callback_key('facebook', { 'code': 'foo' }),
+                         callback_key('facebook', { 'code': 'foo' }))
+        self.assertNotEqual(
+            callback_key('twitter', { 'oauth_token': 'a', 'oauth_verifier': 'b' }),
+            callback_key('twitter', { 'oauth_token': 'a', 'oauth_verifier': 'c' }))
+        self.assertNotEqual(callback_key('oidc', { 'code': 'foo' }, 'a'),
+                            callback_key('oidc', { 'code': 'foo' }, 'b'))
+
+    def test_cookie_is_not_shared(self):
+        with FakeProviderServer() as server:
+            registry = socialauth.ProviderRegistry(
+                environ      = credentials,
+                transport    = server.transport(),
+                singleflight = socialauth.SingleFlight())
+            args = { 'oauth_token': 'foo', 'oauth_verifier': 'foo' }
+            res  = registry.http_get_provider(
+                'twitter', twitter_base_url, { 'login': 'start' }, 'sekret')
+            cookie = res['set_token_cookie']
+
+            # A forged duplicate failing first does not poison the callback.
+            with self.assertRaises(socialauth.Error):
+                registry.http_get_provider(
+                    'twitter', twitter_base_url, args, 'sekret', 'forged')
+
+            res = registry.http_get_provider(
+                'twitter', twitter_base_url, args, 'sekret', cookie)
+            self.assertEqual(res['provider_user_id'], '987')
+
+            # Nor does a duplicate without the cookie get the user.
+            for other in (None, 'forged',):
+                with self.assertRaises(socialauth.Error):
+                    registry.http_get_provider(
+                        'twitter', twitter_base_url, args, 'sekret', other)
+
+    def test_registry_coalesces_callbacks(self):
+        from concurrent.futures import ThreadPoolExecutor
+        with FakeProviderServer(latency = 0.05) as server:
+            registry = socialauth.ProviderRegistry(
+                environ      = credentials,
+                transport    = server.transport(),
+                singleflight = socialauth.SingleFlight())
+
+            def callback(i):
+                return registry.http_get_provider(
+                    'facebook', facebook_base_url, { 'code': 'foo' }, 'sekret')
+
+            with ThreadPoolExecutor(max_workers = 4) as executor:
+                results = list(executor.map(callback, range(4)))
+
+            self.assertEqual(server.requests, 2)
+            for res in results:
+                self.assertEqual(res['provider_user_id'], '987')
+
+            registry.http_get_provider(
+                'facebook', facebook_base_url, { 'login': 'start' }, 'sekret')
+            callback(4)
+            self.assertEqual(server.requests, 2)
+
+    def test_async_coalesces_callbacks(self):
+        async def callbacks(registry):
+            args = { 'oauth_token': 'foo', 'oauth_verifier': 'foo' }
+            res  = await registry.async_http_get_provider(
+                'twitter', twitter_base_url, { 'login': 'start' }, 'sekret')
+            return await asyncio.gather(*[
+                registry.async_http_get_provider(
+                    'twitter', twitter_base_url, args, 'sekret',
+                    res['set_token_cookie'])
+                for i in range(4)
+            ])
+
+        with FakeProviderServer(latency = 0.02) as server:
+            registry = socialauth.ProviderRegistry(
+                environ            = credentials,
+                async_transport    = server.transport(socialauth.AsyncTransport),
+                async_singleflight = socialauth.AsyncSingleFlight())
+            results = run_async(callbacks(registry))
+
+        self.assertEqual([res['provider_user_id'] for res in results], ['987'] * 4)
+        self.assertEqual(server.requests, 2)
+        self.assertEqual(registry.async_singleflight.shared, 3)
+
+
 class TestHTTPGetProvider(unittest.TestCase):
     def test_invalid_provider(self):
         with self.assertRaises(socialauth.InvalidUsage):
@@ -138,6 +2176,46 @@ class TestTwitterProvider(unittest.TestCase):
         with self.assertRaisesRegex(socialauth.Error, 'No user_id'):
             self.get_provider(args, token)
 
+    @patch('httplib2.Http.request', mock_valid_requests)
+    def test_legacy_web_token(self):
+        args  = { 'oauth_token': 'foo', 'oauth_verifier': 'foo' }
+        token = jwt.encode(
+            { 'data': { 'type': 'oauth_token_secret', 'id': 'foo' } }, 'sekret')
+        res   = self.get_provider(args, token.decode('utf-8'))
+        self.assertEqual(res['provider_user_id'], '987')
+
+    def test_malformed_legacy_web_token(self):
+        args = { 'oauth_token': 'foo', 'oauth_verifier': 'foo' }
+        with self.assertRaisesRegex(socialauth.ClientError, 'Failed to retrieve'):
+            self.get_provider(args, 'not.a.token')
+
+        for payload in ({ 'data': 'foo' }, { 'other': 1 },):
+            token = jwt.encode(payload, 'sekret').decode('utf-8')
+            with self.assertRaisesRegex(socialauth.ClientError,
+                                        'does not have an oauth_token_secret'):
+                self.get_provider(args, token)
+
+    @patch('httplib2.Http.request', mock_valid_requests)
+    def test_legacy_web_token_with_key_ring(self):
+        args  = { 'oauth_token': 'foo', 'oauth_verifier': 'foo' }
+        token = jwt.encode({ 'data': { 'id': 'foo' } }, 'sekret').decode('utf-8')
+        ring  = socialauth.KeyRing({ None: 'sekret', '2024': 'new' })
+        res   = socialauth.http_get_provider('twitter', twitter_base_url, args,
+                                             ring, token)
+        self.assertEqual(res['provider_user_id'], '987')
+
+    @patch('httplib2.Http.request', mock_valid_requests)
+    def test_invalid_state_token(self):
+        args  = { 'oauth_token': 'foo', 'oauth_verifier': 'foo' }
+        token = socialauth.StateCodec('invalid secret').encode(b'foo')
+        with self.assertRaisesRegex(socialauth.Error, 'Failed to retrieve'):
+            self.get_provider(args, token)
+
+        token = socialauth.StateCodec('sekret').encode(b'')
+        with self.assertRaisesRegex(socialauth.Error,
+                                    'does not have an oauth_token_secret'):
+            self.get_provider(args, token)
+
     @patch('httplib2.Http.request', mock_request_with('request_token', 400, ''))
     def test_request_token_failure(self):
         with self.assertRaisesRegex(socialauth.Error, '400 from Twitter'):
@@ -155,8 +2233,8 @@ class TestTwitterProvider(unittest.TestCase):
         self.assertEqual(res['status'], 302)
         self.assertIn('/oauth/authenticate?oauth_token', res.get('redirect'))
 
-        payload = jwt.decode(res['set_token_cookie'], 'sekret', algorithm = 'HS256')
-        self.assertEqual(payload['data']['type'], 'oauth_token_secret')
+        payload = socialauth.StateCodec('sekret').decode(res['set_token_cookie'])
+        self.assertEqual(payload, b'bar')
 
         # Second leg
         args = {
@@ -239,6 +2317,157 @@ class TestFacebookProvider(unittest.TestCase):
         self.assertEqual(res['provider_user_name'], 'test')
 
 
+class TestOIDCProvider(unittest.TestCase):
+    base_url = 'https://test.socialauth.foo/auth/oidc'
+
+    def setUp(self):
+        from socialauth.bench.servers import ISSUER
+        self.server = FakeProviderServer().start()
+        self.addCleanup(self.server.stop)
+        self.registry = socialauth.ProviderRegistry(
+            ['oidc'],
+            environ   = dict(OIDC_ISSUER = ISSUER, OIDC_CLIENT_ID = 'client',
+                             OIDC_CLIENT_SECRET = 'secret'),
+            transport = self.server.transport())
+
+    def login(self, provider = 'oidc', token_secret = 'sekret'):
+        res = self.registry.http_get_provider(
+            provider, self.base_url, { 'login': 'start' }, token_secret)
+        self.assertEqual(res['status'], 302)
+        query = urlparse(self.server.authorize(res['redirect'])).query
+        return (dict((k, v[0]) for k, v in parse_qs(query).items()),
+                res['set_token_cookie'],)
+
+    def test_login(self):
+        params, cookie = self.login()
+        res = self.registry.http_get_provider(
+            'oidc', self.base_url, params, 'sekret', cookie)
+        self.assertEqual(res, dict(status = 200, provider_user_id = '987',
+                                   provider_user_name = 'test'))
+
+        # Discovery and keys are fetched once; later logins make one call.
+        requests = self.server.requests
+        params, cookie = self.login()
+        self.registry.http_get_provider('oidc', self.base_url, params,
+                                        'sekret', cookie)
+        self.assertEqual(self.server.requests, requests + 1)
+        self.assertEqual(self.registry['oidc'].keys.fetches, 1)
+
+    def test_plain_entry_point(self):
+        from socialauth.bench.servers import ISSUER
+        environ = dict(OIDC_ISSUER = ISSUER, OIDC_CLIENT_ID = 'plain',
+                       OIDC_CLIENT_SECRET = 'secret')
+        transport = self.server.transport()
+
+        def login():
+            res = socialauth.http_get_provider(
+                'oidc', self.base_url, { 'login': 'start' }, 'sekret',
+                transport = transport)
+            query  = urlparse(self.server.authorize(res['redirect'])).query
+            params = dict((k, v[0]) for k, v in parse_qs(query).items())
+            return socialauth.http_get_provider(
+                'oidc', self.base_url, params, 'sekret',
+                res['set_token_cookie'], transport = transport)
+
+        with patch.dict(os.environ, environ):
+            self.assertEqual(login()['provider_user_id'], '987')
+
+            # Discovery and keys outlive the call; a later login is one call.
+            requests = self.server.requests
+            self.assertEqual(login()['provider_user_id'], '987')
+            self.assertEqual(self.server.requests, requests + 1)
+
+    def test_async_login(self):
+        async def login(params, cookie):
+            return await self.registry.async_http_get_provider(
+                'oidc', self.base_url, params, 'sekret', cookie)
+
+        self.registry.async_transport = self.server.transport(
+            socialauth.AsyncTransport)
+        params, cookie = self.login()
+        res = run_async(login(params, cookie))
+        self.assertEqual(res['provider_user_id'], '987')
+
+    def test_key_rotation(self):
+        params, cookie = self.login()
+        self.registry.http_get_provider('oidc', self.base_url, params,
+                                        'sekret', cookie)
+
+        keys = self.registry['oidc'].keys
+        keys.fetched_at -= keys.refresh_interval
+        self.server.rotate_key()
+        params, cookie = self.login()
+        res = self.registry.http_get_provider('oidc', self.base_url, params,
+                                              'sekret', cookie)
+        self.assertEqual(res['status'], 200)
+        self.assertEqual(keys.fetches, 2)
+        self.assertEqual(sorted(keys.keys), ['key-1', 'key-2'])
+
+    def test_unknown_kid_refreshes_at_most_once(self):
+        params, cookie = self.login()
+        self.registry.http_get_provider('oidc', self.base_url, params,
+                                        'sekret', cookie)
+
+        # The new key is not published until the refresh interval passes.
+        self.server.rotate_key()
+        params, cookie = self.login()
+        with self.assertRaisesRegex(socialauth.Error, 'Unknown ID token'):
+            self.registry.http_get_provider('oidc', self.base_url, params,
+                                            'sekret', cookie)
+        self.assertEqual(self.registry['oidc'].keys.fetches, 1)
+
+    def test_rejects_other_nonce(self):
+        params, cookie = self.login()
+        other_params, other_cookie = self.login()
+        with self.assertRaisesRegex(socialauth.Error, 'wrong nonce'):
+            self.registry.http_get_provider('oidc', self.base_url, params,
+                                            'sekret', other_cookie)
+
+        with self.assertRaisesRegex(socialauth.Error, 'No token cookie'):
+            self.registry.http_get_provider('oidc', self.base_url,
+                                            other_params, 'sekret', None)
+
+    def test_bad_code(self):
+        params, cookie = self.login()
+        with self.assertRaisesRegex(socialauth.Error, '400 from the OpenID'):
+            self.registry.http_get_provider('oidc', self.base_url,
+                                            { 'code': 'bad' }, 'sekret', cookie)
+
+    def test_verification(self):
+        from socialauth import jwks
+        key = self.server.signing_key()
+        now = time.time()
+        claims = dict(iss = 'issuer', aud = 'client', sub = '987',
+                      exp = now + 60, nonce = 'n')
+        token  = key.sign(claims)
+        header, decoded, message, signature = jwks.split_token(token)
+        public = jwks.RSAKey.from_jwk(key.jwk())
+        self.assertTrue(public.verify('RS256', message, signature))
+        self.assertFalse(public.verify('RS256', message + b'x', signature))
+        self.assertFalse(public.verify('none', message, signature))
+        self.assertFalse(public.verify('HS256', message, signature))
+
+        self.assertEqual(jwks.check_claims(decoded, 'issuer', 'client', 'n'),
+                         claims)
+        for changes, error in ((dict(iss = 'other'), 'issuer'),
+                               (dict(aud = ['other']), 'audience'),
+                               (dict(aud = ['client', 'other']), 'party'),
+                               (dict(exp = now - 120), 'Expired'),
+                               (dict(nonce = 'm'), 'nonce'),
+                               (dict(sub = ''), 'subject'),):
+            with self.assertRaisesRegex(socialauth.Error, error):
+                jwks.check_claims(dict(claims, **changes), 'issuer', 'client',
+                                  'n')
+
+        for token in ('', 'a.b', 'a.b.c', token.replace('.', '', 1)):
+            with self.assertRaisesRegex(socialauth.Error, 'Malformed'):
+                jwks.split_token(token)
+
+    def test_no_env(self):
+        with self.assertRaisesRegex(socialauth.Error, 'No OIDC_ISSUER'):
+            socialauth.providers.OIDC('', { 'login': 'start' }, '', '')
+
+
 if __name__ == '__main__':
     os.environ['TWITTER_CONSUMER_KEY']    = 'foobar'
     os.environ['TWITTER_CONSUMER_SECRET'] = 'foobar'